@@ -0,0 +1,447 @@
+import argparse
+import configparser
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import build_conf
+import build_host
+import build_transfer
+
+'''
+Benchmark of the build orchestration: build_prod.py is run end to end
+against local stand-ins instead of the network and a real Yocto build:
+- fake repo, which "syncs" a few meta layers and the build environment
+script, the product layer being a clone of a local git repository
+- fake bitbake, which writes a synthetic deploy, buildhistory and log
+tree of the configured size, and fake bitbake-layers
+- local bare git repository for the build history
+- fake GitHub API for the pull requests
+Workspace setup and teardown and every build phase of the build report
+(artifacts population, build history commit etc.) are timed over
+a number of runs and the results are saved as JSON, which can be compared
+with the results of another run of the benchmark.
+'''
+
+RESULTS_VERSION = 1
+
+# --product, build_prod makes it prod-bench for the manifest and layer names
+PRODUCT = 'bench'
+PRODUCT_TYPE = 'prod-' + PRODUCT
+MACHINE = 'bench-machine'
+DOMAINS = ['dom0-image-bench', 'domd-image-bench', 'domu-image-bench']
+LAYERS = ['meta-bench-bsp', 'meta-bench-distro']
+
+FAKE_REPO = r'''#!/usr/bin/env python3
+import os, subprocess, sys
+remotes = os.environ['BENCH_REMOTES']
+args = sys.argv[1:]
+cmd = args[0]
+if cmd == 'init':
+    os.makedirs('.repo', exist_ok=True)
+    manifest = args[args.index('-m') + 1]
+    with open(os.path.join('.repo', 'bench-manifest'), 'w') as f:
+        f.write(manifest[:-len('.xml')])
+elif cmd == 'sync':
+    with open(os.path.join('.repo', 'bench-manifest')) as f:
+        product = f.read()
+    os.makedirs('xt-distro', exist_ok=True)
+    with open(os.path.join('xt-distro', 'oe-init-build-env'), 'w') as f:
+        f.write('mkdir -p build/conf && cd build && touch conf/local.conf conf/bblayers.conf\n')
+    for layer in os.environ['BENCH_LAYERS'].split():
+        os.makedirs(os.path.join(layer, 'conf'), exist_ok=True)
+    layer = 'meta-xt-' + product
+    if not os.path.isdir(layer):
+        subprocess.check_call(['git', 'clone', '-q',
+                               os.path.join(remotes, 'xen-troops', layer), layer])
+    else:
+        subprocess.check_call(['git', '-C', layer, 'checkout', '-q', '--detach', 'origin/master'])
+elif cmd == 'forall':
+    for name in os.listdir('.'):
+        if os.path.isdir(os.path.join(name, '.git')):
+            subprocess.check_call(['bash', '-c', args[args.index('-c') + 1]], cwd=name)
+elif cmd == 'manifest':
+    with open(args[args.index('-o') + 1], 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<manifest>\n')
+        for name in sorted(os.listdir('.')):
+            if name.startswith('meta-'):
+                f.write('  <project name="%s" revision="%s"/>\n' % (name, '0' * 40))
+        f.write('</manifest>\n')
+'''
+
+FAKE_BITBAKE_LAYERS = r'''#!/usr/bin/env python3
+import os, sys
+with open(os.path.join('conf', 'bblayers.conf'), 'a') as f:
+    for layer in sys.argv[2:]:
+        f.write('BBLAYERS += "%s"\n' % os.path.abspath(layer))
+'''
+
+FAKE_BITBAKE = r'''#!/usr/bin/env python3
+import os, random, re
+conf = {}
+with open(os.path.join('conf', 'local.conf')) as f:
+    for line in f:
+        m = re.match(r'^(\w+) = "(.*)"$', line.strip())
+        if m:
+            conf[m.group(1)] = m.group(2)
+deploy = conf.get('DEPLOY_DIR', os.path.abspath('deploy'))
+history = conf.get('BUILDHISTORY_DIR', os.path.abspath('buildhistory'))
+log = conf.get('LOG_DIR', os.path.abspath('log'))
+machine = conf.get('MACHINE', 'bench')
+env = os.environ
+image_files = int(env['BENCH_IMAGE_FILES'])
+image_size = int(env['BENCH_IMAGE_SIZE'])
+log_files = int(env['BENCH_LOG_FILES'])
+log_size = int(env['BENCH_LOG_SIZE'])
+for domain in env['BENCH_DOMAINS'].split():
+    print('NOTE: Running task 1 of 1 (%s:do_image_complete)' % domain, flush=True)
+    images = os.path.join(deploy, domain, 'images', machine)
+    os.makedirs(images, exist_ok=True)
+    for i in range(image_files):
+        with open(os.path.join(images, 'image-%d.bin' % i), 'wb') as f:
+            f.write(os.urandom(image_size))
+    domain_history = os.path.join(history, domain)
+    os.makedirs(domain_history, exist_ok=True)
+    for name in ['build-versions.inc', 'metadata-revs']:
+        with open(os.path.join(domain_history, name), 'w') as f:
+            for i in range(20):
+                f.write('layer-%d = "%040x"\n' % (i, random.getrandbits(160)))
+    for i in range(log_files):
+        task_log = os.path.join(log, domain, 'recipe-%d' % (i // 50), 'log.do_task.%d' % i)
+        os.makedirs(os.path.dirname(task_log), exist_ok=True)
+        with open(task_log, 'w') as f:
+            written = 0
+            while written < log_size:
+                line = 'DEBUG: Executing shell function do_task step %d\n' % random.randint(0, 1000)
+                f.write(line)
+                written += len(line)
+os.makedirs(os.path.join(log, 'cooker', machine), exist_ok=True)
+with open(os.path.join(log, 'cooker', machine, 'console-latest.log'), 'w') as f:
+    f.write('NOTE: Tasks Summary: all succeeded\n')
+'''
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # /repos/<owner>/<repo>/pulls/<number>
+        number = int(self.path.rsplit('/', 1)[1])
+        etag = '"bench-%d"' % number
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps({'number': number, 'title': 'Bench pull request %d' % number,
+                           'state': 'open', 'base': {'ref': 'master'}}).encode()
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def git(args, cwd=None):
+    subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost'] +
+                          args, cwd=cwd, stdout=subprocess.DEVNULL)
+
+
+@contextlib.contextmanager
+def redirect_output(path):
+    # output of the build and of its commands goes to the log
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(path, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+class Bench(object):
+    def __init__(self, root, args):
+        self.__root = root
+        self.__args = args
+        self.__results = {}
+
+    def get_dir_remotes(self):
+        return os.path.join(self.__root, 'remotes')
+
+    def get_file_log(self):
+        return os.path.join(self.__root, 'bench.log')
+
+    def __setup_remotes(self):
+        remotes = self.get_dir_remotes()
+        # build history
+        history = os.path.join(remotes, 'build-history.git')
+        git(['init', '-q', '--bare', '-b', 'master', history])
+        work = os.path.join(self.__root, 'tmp-history')
+        git(['init', '-q', '-b', 'master', work])
+        with open(os.path.join(work, 'README'), 'w') as f:
+            f.write('Build history\n')
+        git(['add', 'README'], cwd=work)
+        git(['commit', '-q', '-m', 'Initial commit'], cwd=work)
+        git(['push', '-q', history, 'HEAD:master'], cwd=work)
+        shutil.rmtree(work)
+        # product layer with the pull requests
+        layer = os.path.join(remotes, 'xen-troops', 'meta-xt-' + PRODUCT_TYPE)
+        git(['init', '-q', '--bare', '-b', 'master', layer])
+        work = os.path.join(self.__root, 'tmp-layer')
+        git(['init', '-q', '-b', 'master', work])
+        os.makedirs(os.path.join(work, 'doc'))
+        with open(os.path.join(work, 'doc', 'local.conf.' + PRODUCT_TYPE), 'w') as f:
+            f.write('DISTRO = "bench"\n')
+        git(['add', '.'], cwd=work)
+        git(['commit', '-q', '-m', 'Initial commit'], cwd=work)
+        git(['push', '-q', layer, 'HEAD:master'], cwd=work)
+        for number in range(1, self.__args.pulls + 1):
+            git(['checkout', '-q', '-b', 'pull-%d' % number, 'master'], cwd=work)
+            with open(os.path.join(work, 'pull-%d' % number), 'w') as f:
+                f.write('%d\n' % number)
+            git(['add', '.'], cwd=work)
+            git(['commit', '-q', '-m', 'Pull request %d' % number], cwd=work)
+            git(['push', '-q', layer, 'HEAD:refs/pull/%d/head' % number], cwd=work)
+        shutil.rmtree(work)
+
+    def __setup_tools(self):
+        bin_dir = os.path.join(self.__root, 'bin')
+        os.makedirs(bin_dir)
+        for name, script in [('repo', FAKE_REPO), ('bitbake', FAKE_BITBAKE),
+                             ('bitbake-layers', FAKE_BITBAKE_LAYERS)]:
+            path = os.path.join(bin_dir, name)
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, 0o755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['BENCH_REMOTES'] = self.get_dir_remotes()
+        os.environ['BENCH_LAYERS'] = ' '.join(LAYERS)
+        os.environ['BENCH_DOMAINS'] = ' '.join(DOMAINS)
+        os.environ['BENCH_IMAGE_FILES'] = str(self.__args.image_files)
+        os.environ['BENCH_IMAGE_SIZE'] = str(self.__args.image_size)
+        os.environ['BENCH_LOG_FILES'] = str(self.__args.log_files)
+        os.environ['BENCH_LOG_SIZE'] = str(self.__args.log_size)
+
+    def __setup_config(self, api_url):
+        config = configparser.ConfigParser(interpolation=None)
+        config.read_dict({
+            build_conf.CFG_SECTION_GIT: {
+                build_conf.CFG_OPTION_XT_HISTORY: os.path.join(self.get_dir_remotes(),
+                                                               'build-history.git'),
+                build_conf.CFG_OPTION_XT_MANIFEST: os.path.join(self.get_dir_remotes(),
+                                                                'manifest.git'),
+            },
+            build_conf.CFG_SECTION_PATH: {
+                build_conf.CFG_OPTION_WORKSPACE_DIR: os.path.join(self.__root, 'workspace'),
+                build_conf.CFG_OPTION_STORAGE_DIR: os.path.join(self.__root, 'storage'),
+                build_conf.CFG_OPTION_CACHE_DIR: os.path.join(self.__root, 'cache'),
+            },
+            build_conf.CFG_SECTION_GITHUB: {
+                build_conf.CFG_OPTION_GITHUB_API_URL: api_url,
+                build_conf.CFG_OPTION_GITHUB_GIT_URL: self.get_dir_remotes(),
+            },
+        })
+        # options being compared, e.g. artifacts.dedup=yes
+        for item in self.__args.options:
+            key, value = item.split('=', 1)
+            section, option = key.split('.', 1)
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, option, value)
+        config_file = os.path.join(self.__root, 'bench.cfg')
+        with open(config_file, 'w') as f:
+            config.write(f)
+        return config_file
+
+    def __add(self, name, seconds):
+        self.__results.setdefault(name, []).append(round(seconds, 3))
+
+    def __run_once(self, config_file, build_args):
+        import build_prod
+        # artifacts and history of every run need their own directory
+        time.sleep(1.0 - datetime.datetime.now().microsecond / 1e6)
+        workspace = build_conf.WorkspaceConf(config_file)
+        start = time.monotonic()
+        workspace.setup_workspace_dir(workspace.get_dir_build(), remove=True)
+        workspace.setup_workspace_dir(workspace.get_dir_yocto_sstate(), remove=True)
+        self.__add('workspace_teardown', time.monotonic() - start)
+        argv = sys.argv
+        sys.argv = ['build_prod.py', '--product', PRODUCT, '--machine', MACHINE,
+                    '--config', config_file, '--with-local-conf', '--with-do-build',
+                    '--with-build-history'] + build_args
+        if self.__args.pulls:
+            sys.argv += ['--prod_pulls', ','.join([str(number) for number in
+                                                   range(1, self.__args.pulls + 1)])]
+        try:
+            start = time.monotonic()
+            cfg = build_conf.BuildConf()
+            self.__add('workspace_setup', time.monotonic() - start)
+        finally:
+            sys.argv = argv
+        cwd = os.getcwd()
+        start = time.monotonic()
+        try:
+            build_prod.build_run(cfg)
+        finally:
+            os.chdir(cwd)
+        self.__add('total', time.monotonic() - start)
+        with open(os.path.join(cfg.get_dir_build_artifacts_dest(),
+                               build_conf.REPORT_FNAME)) as f:
+            report = json.load(f)
+        for phase in report['phases']:
+            self.__add(phase['name'], phase['wall_time'])
+
+    def run(self, build_args):
+        self.__setup_remotes()
+        self.__setup_tools()
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGithubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            config_file = self.__setup_config('http://127.0.0.1:%d' % server.server_port)
+            for run in range(self.__args.runs):
+                print('Run %d of %d' % (run + 1, self.__args.runs))
+                with redirect_output(self.get_file_log()):
+                    self.__run_once(config_file, build_args)
+        finally:
+            server.shutdown()
+        return self.__results
+
+
+def bench_summary(results):
+    summary = {}
+    for name, runs in results.items():
+        summary[name] = {
+            'runs': runs,
+            'min': min(runs),
+            'median': round(statistics.median(runs), 3),
+            'mean': round(statistics.mean(runs), 3),
+        }
+    return summary
+
+
+def bench_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def bench_print(results, baseline=None):
+    print('%-28s %10s %10s %10s' % ('phase', 'min, s', 'median, s', 'baseline'))
+    for name, values in sorted(results['phases'].items()):
+        line = '%-28s %10.3f %10.3f' % (name, values['min'], values['median'])
+        if baseline and name in baseline['phases']:
+            old = baseline['phases'][name]['median']
+            change = (values['median'] - old) / old * 100 if old else 0
+            line += ' %10.3f %+.1f%%' % (old, change)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the build orchestration against '
+                                                 'local stand-ins of repo, bitbake and GitHub',
+                                     epilog='Arguments after "--" are passed to build_prod.py')
+    parser.add_argument('--runs', type=int, default=3,
+                        dest='runs', required=False, help='Number of runs, default is 3')
+    parser.add_argument('--image-files', type=int, default=20,
+                        dest='image_files', required=False,
+                        help='Image files per domain, default is 20')
+    parser.add_argument('--image-size', type=build_transfer.parse_size, default='16M',
+                        dest='image_size', required=False,
+                        help='Size of an image file, default is 16M')
+    parser.add_argument('--log-files', type=int, default=2000,
+                        dest='log_files', required=False,
+                        help='Task logs per domain, default is 2000')
+    parser.add_argument('--log-size', type=build_transfer.parse_size, default='8K',
+                        dest='log_size', required=False,
+                        help='Size of a task log, default is 8K')
+    parser.add_argument('--pulls', type=int, default=0,
+                        dest='pulls', required=False,
+                        help='Number of pull requests applied, default is 0')
+    parser.add_argument('--set', action='append', default=[],
+                        dest='options', required=False, metavar='SECTION.OPTION=VALUE',
+                        help='Set an option of the configuration file, e.g. artifacts.dedup=yes')
+    parser.add_argument('--dir',
+                        dest='dir', required=False,
+                        help='Directory to run in, temporary directory if not set. '
+                             'It should be on the drive being measured')
+    parser.add_argument('--keep', action='store_true',
+                        dest='keep', required=False, default=False,
+                        help='Do not remove the directory the benchmark was run in')
+    parser.add_argument('--output',
+                        dest='output', required=False, help='Save the results to the file')
+    parser.add_argument('--compare',
+                        dest='compare', required=False,
+                        help='Compare with the results saved before')
+    argv = sys.argv[1:]
+    build_args = []
+    if '--' in argv:
+        build_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    root = tempfile.mkdtemp(prefix='build-bench-', dir=args.dir)
+    try:
+        started = datetime.datetime.now()
+        results = Bench(root, args).run(build_args)
+        results = {
+            'version': RESULTS_VERSION,
+            'started': started.isoformat(),
+            'revision': bench_revision(),
+            'host': {
+                'cpus': build_host.get_cpu_count(),
+                'mem_total': build_host.get_mem_total(),
+            },
+            'params': {
+                'runs': args.runs,
+                'image_files': args.image_files,
+                'image_size': args.image_size,
+                'log_files': args.log_files,
+                'log_size': args.log_size,
+                'domains': len(DOMAINS),
+                'pulls': args.pulls,
+                'options': args.options,
+                'build_args': build_args,
+            },
+            'phases': bench_summary(results),
+        }
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+        bench_print(results, baseline)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+            print('Saved results to ' + args.output)
+    except Exception as e:
+        print(e)
+        print('See the log ' + os.path.join(root, 'bench.log'))
+        print("FAILED")
+        args.keep = True
+        sys.exit(1)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import build_conf
+import build_lock
+import build_store
+import build_transfer
+
+'''
+Management of the caches shared by the builds:
+1. sstate mirror (XT_SSTATE_CACHE_MIRROR_DIR): new sstate objects are
+synchronized from the SSTATE_DIR of the build (current-build-cache)
+into the mirror and the objects used by the build are marked as accessed.
+When the mirror grows beyond its quota, the least recently used objects
+are evicted.
+2. downloads (DL_DIR): every source, e.g. a tarball or a bare git clone
+with its .done stamp, is tracked as a whole by the time of its last use:
+the bitbake fetcher touches the .done stamp of a source every time a build
+uses it, which, unlike the access time with relatime, is exact. The least
+recently used sources are evicted down to the quota. Tarballs made
+by BB_GENERATE_MIRROR_TARBALLS and the downloaded files are synchronized
+into the downloads mirror, which is used as PREMIRRORS (own-mirrors), so
+a new builder or workspace gets sources without cloning them upstream.
+Mirror files used by the builds are symlinked into DL_DIR by bitbake.
+
+Every cache keeps an index (sqlite) with size, mtime, hash and the time
+of the last access of its objects. Caches are locked while being updated,
+so builders of the same host can share them.
+'''
+
+INDEX_FNAME = '.index.sqlite'
+LOCK_FNAME = '.lock'
+
+ACTION_SSTATE_SYNC = 'sstate-sync'
+ACTION_SSTATE_EVICT = 'sstate-evict'
+ACTION_SSTATE_REPORT = 'sstate-report'
+
+ACTION_DOWNLOADS_SYNC = 'downloads-sync'
+ACTION_DOWNLOADS_EVICT = 'downloads-evict'
+ACTION_DOWNLOADS_REPORT = 'downloads-report'
+
+ACTIONS = [
+    ACTION_SSTATE_SYNC,
+    ACTION_SSTATE_EVICT,
+    ACTION_SSTATE_REPORT,
+    ACTION_DOWNLOADS_SYNC,
+    ACTION_DOWNLOADS_EVICT,
+    ACTION_DOWNLOADS_REPORT
+]
+
+# stamps and locks of a source made by the bitbake fetcher
+DOWNLOADS_DONE_SUFFIX = '.done'
+DOWNLOADS_STAMP_SUFFIXES = [DOWNLOADS_DONE_SUFFIX, '.lock']
+# sources used recently may be in use by the builds running,
+# so they are never evicted
+DOWNLOADS_MIN_AGE = 24 * 3600
+# same for the sstate objects
+SSTATE_MIN_AGE = 24 * 3600
+# objects are added to the index by the sync of the build, the whole
+# mirror is only scanned for the objects populated by somebody else
+# or removed that often
+INDEX_SCAN_INTERVAL = 24 * 3600
+
+
+class CacheIndex(object):
+    def __init__(self, path):
+        self.__path = path
+        build_conf.WorkspaceConf.setup_dir(path)
+        self.__db = sqlite3.connect(os.path.join(path, INDEX_FNAME))
+        self.__db.execute('CREATE TABLE IF NOT EXISTS objects ('
+                          'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                          'sha256 TEXT, last_access REAL)')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)')
+
+    def get_path(self):
+        return self.__path
+
+    def lookup(self, rel):
+        return self.__db.execute('SELECT size, mtime, sha256, last_access FROM objects '
+                                 'WHERE path = ?', (rel,)).fetchone()
+
+    def add(self, rel, size, mtime, sha256, last_access):
+        self.__db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                          (rel, size, mtime, sha256, last_access))
+
+    def touch(self, rel, when):
+        self.__db.execute('UPDATE objects SET last_access = MAX(last_access, ?) '
+                          'WHERE path = ?', (when, rel))
+
+    def remove(self, rel):
+        self.__db.execute('DELETE FROM objects WHERE path = ?', (rel,))
+
+    def get_objects(self):
+        return [row[0] for row in self.__db.execute('SELECT path FROM objects')]
+
+    def get_total(self):
+        row = self.__db.execute('SELECT COUNT(*), TOTAL(size) FROM objects').fetchone()
+        return row[0], int(row[1])
+
+    def get_lru(self):
+        # least recently used objects first
+        return self.__db.execute('SELECT path, size, last_access FROM objects '
+                                 'ORDER BY last_access').fetchall()
+
+    def get_scanned(self):
+        # time the whole cache was scanned last, 0 if never
+        row = self.__db.execute("SELECT value FROM meta WHERE key = 'scanned'").fetchone()
+        return row[0] if row else 0
+
+    def set_scanned(self, when):
+        self.__db.execute("INSERT OR REPLACE INTO meta VALUES ('scanned', ?)", (when,))
+
+    def commit(self):
+        self.__db.commit()
+
+    def close(self):
+        self.__db.commit()
+        self.__db.close()
+
+
+def cache_index_scan(index):
+    '''
+    Add the objects found in the cache, but not in the index yet, e.g.
+    those populated by somebody else, and forget the ones which are gone
+    '''
+    path = index.get_path()
+    found = set()
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, path)
+            if rel in [INDEX_FNAME, LOCK_FNAME] or build_store.TMP_SUFFIX in name or \
+                    os.path.islink(full):
+                continue
+            found.add(rel)
+            row = index.lookup(rel)
+            st = os.stat(full)
+            if row and row[0] == st.st_size and row[1] == st.st_mtime:
+                continue
+            # hash is only computed when the object is transferred
+            index.add(rel, st.st_size, st.st_mtime, None,
+                      max(st.st_atime, row[3] if row else 0))
+    for rel in index.get_objects():
+        if rel not in found:
+            index.remove(rel)
+    index.set_scanned(time.time())
+    index.commit()
+
+
+def cache_index_use(index, rel, when):
+    # objects populated by somebody else since the last scan are added
+    if index.lookup(rel):
+        index.touch(rel, when)
+        return
+    try:
+        st = os.stat(os.path.join(index.get_path(), rel))
+    except FileNotFoundError:
+        return
+    index.add(rel, st.st_size, st.st_mtime, None, when)
+
+
+def cache_index_refresh(index):
+    '''
+    Scan the cache if it wasn't scanned for INDEX_SCAN_INTERVAL,
+    otherwise the index is kept up to date by the syncs
+    '''
+    if time.time() - index.get_scanned() < INDEX_SCAN_INTERVAL:
+        return
+    print('Scanning cache ' + index.get_path())
+    cache_index_scan(index)
+
+
+def cache_evict(index, quota, dry_run=False, remove=None, keep_after=None):
+    '''
+    Remove least recently used objects until the cache fits into quota,
+    but not those used after keep_after.
+    Returns the number of objects and bytes evicted
+    '''
+    count, total = index.get_total()
+    print('Cache %s: %d objects, %s, quota %s' % (index.get_path(), count,
+                                                build_transfer.format_size(total),
+                                                build_transfer.format_size(quota)))
+    evicted = 0
+    evicted_size = 0
+    for rel, size, last_access in index.get_lru():
+        if total <= quota:
+            break
+        if keep_after and last_access > keep_after:
+            print('\tObjects used after %s are kept' % time.ctime(keep_after))
+            break
+        if dry_run:
+            print('\tWould evict %s, %s, last used %s' %
+                  (rel, build_transfer.format_size(size), time.ctime(last_access)))
+        else:
+            if remove:
+                remove(rel)
+            else:
+                try:
+                    os.remove(os.path.join(index.get_path(), rel))
+                except FileNotFoundError:
+                    pass
+            index.remove(rel)
+        total -= size
+        evicted += 1
+        evicted_size += size
+    index.commit()
+    print('%s %d objects, %s' % ('Would evict' if dry_run else 'Evicted',
+                                 evicted, build_transfer.format_size(evicted_size)))
+    return evicted, evicted_size
+
+
+def cache_transfer_object(transfer, src, dst):
+    # objects appear in the mirror atomically, see build_store
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '%s%s%d' % (dst, build_store.TMP_SUFFIX, os.getpid())
+    transfer.copy_file(src, tmp)
+    os.rename(tmp, dst)
+    return build_store.hash_file(dst)
+
+
+def sstate_mirror_sync(cfg, index, transfer, dry_run=False):
+    src = cfg.get_dir_yocto_sstate()
+    mirror = index.get_path()
+    mirror_real = os.path.realpath(mirror)
+    print('Synchronizing sstate objects from %s to %s' % (src, mirror))
+    now = time.time()
+    hits = 0
+    new = []
+    for root, dirs, files in os.walk(src):
+        for name in files:
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, src)
+            if os.path.islink(full):
+                # objects fetched from the mirror are symlinked into SSTATE_DIR
+                target = os.path.realpath(full)
+                if target.startswith(mirror_real + os.sep):
+                    cache_index_use(index, os.path.relpath(target, mirror_real), now)
+                    hits += 1
+                continue
+            if index.lookup(rel) or os.path.exists(os.path.join(mirror, rel)):
+                cache_index_use(index, rel, now)
+                hits += 1
+                continue
+            new.append(rel)
+    size = sum([os.path.getsize(os.path.join(src, rel)) for rel in new])
+    print('\t%d objects used from the mirror, %d new objects, %s' %
+          (hits, len(new), build_transfer.format_size(size)))
+    if dry_run:
+        index.commit()
+        return
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=transfer.get_jobs()) as pool:
+        futures = [(rel, pool.submit(cache_transfer_object, transfer,
+                                     os.path.join(src, rel), os.path.join(mirror, rel)))
+                   for rel in new]
+        for rel, future in futures:
+            sha256 = future.result()
+            st = os.stat(os.path.join(mirror, rel))
+            index.add(rel, st.st_size, st.st_mtime, sha256, now)
+    index.commit()
+    print('\tSynchronized in %.1fs' % (time.monotonic() - start))
+
+
+def sstate_mirror_maintain(cfg, actions, quota=None, dry_run=False):
+    mirror = cfg.get_dir_yocto_sstate_mirror()
+    if quota is None:
+        quota = cfg.get_opt_sstate_mirror_quota()
+    with build_lock.file_lock(os.path.join(mirror, LOCK_FNAME)):
+        index = CacheIndex(mirror)
+        try:
+            cache_index_refresh(index)
+            if ACTION_SSTATE_SYNC in actions:
+                transfer = build_transfer.Transfer(cfg.get_opt_transfer_jobs(),
+                                                   cfg.get_opt_transfer_mode())
+                sstate_mirror_sync(cfg, index, transfer, dry_run)
+            # objects used recently may be fetched by the builds running
+            keep_after = time.time() - SSTATE_MIN_AGE
+            if ACTION_SSTATE_EVICT in actions and quota:
+                cache_evict(index, quota, dry_run, keep_after=keep_after)
+            if ACTION_SSTATE_REPORT in actions:
+                cache_evict(index, quota or 0, dry_run=True, keep_after=keep_after)
+        finally:
+            index.close()
+
+
+def sstate_mirror_shrink(cfg, size, dry_run=False):
+    '''
+    Evict least recently used objects of the sstate mirror
+    to free size bytes. Returns the bytes evicted
+    '''
+    mirror = cfg.get_dir_yocto_sstate_mirror()
+    if not os.path.isdir(mirror):
+        return 0
+    with build_lock.file_lock(os.path.join(mirror, LOCK_FNAME)):
+        index = CacheIndex(mirror)
+        try:
+            cache_index_refresh(index)
+            count, total = index.get_total()
+            return cache_evict(index, max(total - size, 0), dry_run,
+                               keep_after=time.time() - SSTATE_MIN_AGE)[1]
+        finally:
+            index.close()
+
+
+def downloads_source(rel):
+    '''
+    Source the file of DL_DIR belongs to: the file itself or,
+    for the fetchers keeping sources in directories, e.g. git2/<repo>,
+    the directory. Stamps and locks belong to their source
+    '''
+    parts = rel.split(os.sep)
+    source = os.path.join(*parts[:2])
+    for suffix in DOWNLOADS_STAMP_SUFFIXES:
+        if source.endswith(suffix):
+            return source[:-len(suffix)]
+    return source
+
+
+def downloads_last_use(full):
+    '''
+    Time the source of DL_DIR was used by a build last: bitbake touches
+    the .done stamp of the source when it uses it. None without the stamp
+    '''
+    try:
+        return os.stat(full + DOWNLOADS_DONE_SUFFIX).st_mtime
+    except OSError:
+        return None
+
+
+def downloads_index_scan(index):
+    path = index.get_path()
+    sources = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, path)
+            if rel in [INDEX_FNAME, LOCK_FNAME]:
+                continue
+            st = os.lstat(full)
+            source = sources.setdefault(downloads_source(rel), [0, 0])
+            source[0] += st.st_size
+            source[1] = max(source[1], st.st_mtime)
+    for rel, (size, mtime) in sources.items():
+        row = index.lookup(rel)
+        # files without the stamp, e.g. the mirror tarballs, are
+        # written when the build uses their source
+        last_use = downloads_last_use(os.path.join(path, rel)) or mtime
+        index.add(rel, size, mtime, None, max(last_use, row[3] if row else 0))
+    for rel in index.get_objects():
+        if rel not in sources:
+            index.remove(rel)
+    index.commit()
+
+
+def downloads_remove(path, source):
+    full = os.path.join(path, source)
+    if os.path.isdir(full) and not os.path.islink(full):
+        shutil.rmtree(full)
+    for name in [full] + [full + suffix for suffix in DOWNLOADS_STAMP_SUFFIXES]:
+        if os.path.lexists(name) and not os.path.isdir(name):
+            os.remove(name)
+
+
+def downloads_mirror_sync(cfg, index, transfer, dry_run=False):
+    src = cfg.get_dir_yocto_downloads()
+    mirror = index.get_path()
+    mirror_real = os.path.realpath(mirror)
+    print('Synchronizing downloads from %s to %s' % (src, mirror))
+    hits = 0
+    new = []
+    # only the files at the top of DL_DIR are mirrored, e.g. tarballs
+    # of the downloads and of the git clones, see BB_GENERATE_MIRROR_TARBALLS
+    for name in os.listdir(src):
+        full = os.path.join(src, name)
+        if name in [INDEX_FNAME, LOCK_FNAME] or build_store.TMP_SUFFIX in name or \
+                any([name.endswith(suffix) for suffix in DOWNLOADS_STAMP_SUFFIXES]):
+            continue
+        if os.path.islink(full):
+            target = os.path.realpath(full)
+            if target.startswith(mirror_real + os.sep):
+                index.touch(os.path.relpath(target, mirror_real),
+                            downloads_last_use(full) or os.lstat(full).st_mtime)
+                hits += 1
+            continue
+        if not os.path.isfile(full):
+            continue
+        st = os.stat(full)
+        dst = os.path.join(mirror, name)
+        # tarballs of the git clones are regenerated when the clone is updated
+        if os.path.exists(dst) and os.stat(dst).st_mtime >= st.st_mtime:
+            index.touch(name, downloads_last_use(full) or st.st_mtime)
+            continue
+        new.append((name, st))
+    size = sum([st.st_size for name, st in new])
+    print('\t%d files used from the mirror, %d new files, %s' %
+          (hits, len(new), build_transfer.format_size(size)))
+    if dry_run:
+        index.commit()
+        return
+    now = time.time()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=transfer.get_jobs()) as pool:
+        futures = [(name, st, pool.submit(cache_transfer_object, transfer,
+                                          os.path.join(src, name), os.path.join(mirror, name)))
+                   for name, st in new]
+        for name, src_st, future in futures:
+            sha256 = future.result()
+            st = os.stat(os.path.join(mirror, name))
+            index.add(name, st.st_size, st.st_mtime, sha256, now)
+    index.commit()
+    print('\tSynchronized in %.1fs' % (time.monotonic() - start))
+
+
+def downloads_maintain(cfg, actions, quota=None, dry_run=False):
+    downloads = cfg.get_dir_yocto_downloads()
+    mirror = cfg.get_dir_yocto_downloads_mirror()
+    if quota is None:
+        quota = cfg.get_opt_downloads_quota()
+    mirror_quota = cfg.get_opt_downloads_mirror_quota()
+    keep_after = time.time() - DOWNLOADS_MIN_AGE
+    with build_lock.file_lock(os.path.join(downloads, LOCK_FNAME)):
+        index = CacheIndex(downloads)
+        try:
+            downloads_index_scan(index)
+            # the mirror is updated first, so the sources evicted
+            # from DL_DIR are still available from it
+            with build_lock.file_lock(os.path.join(mirror, LOCK_FNAME)):
+                mirror_index = CacheIndex(mirror)
+                try:
+                    cache_index_refresh(mirror_index)
+                    if ACTION_DOWNLOADS_SYNC in actions:
+                        transfer = build_transfer.Transfer(cfg.get_opt_transfer_jobs(),
+                                                           cfg.get_opt_transfer_mode())
+                        downloads_mirror_sync(cfg, mirror_index, transfer, dry_run)
+                    if ACTION_DOWNLOADS_EVICT in actions and mirror_quota:
+                        cache_evict(mirror_index, mirror_quota, dry_run, keep_after=keep_after)
+                    if ACTION_DOWNLOADS_REPORT in actions:
+                        cache_evict(mirror_index, mirror_quota, dry_run=True,
+                                    keep_after=keep_after)
+                finally:
+                    mirror_index.close()
+            remove = lambda source: downloads_remove(downloads, source)
+            if ACTION_DOWNLOADS_EVICT in actions and quota:
+                cache_evict(index, quota, dry_run, remove, keep_after)
+            if ACTION_DOWNLOADS_REPORT in actions:
+                cache_evict(index, quota, dry_run=True, keep_after=keep_after)
+        finally:
+            index.close()
+
+
+def downloads_shrink(cfg, size, dry_run=False):
+    '''
+    Evict least recently used sources of DL_DIR to free size bytes,
+    the sources used recently are kept. Returns the bytes evicted
+    '''
+    downloads = cfg.get_dir_yocto_downloads()
+    if not os.path.isdir(downloads):
+        return 0
+    with build_lock.file_lock(os.path.join(downloads, LOCK_FNAME)):
+        index = CacheIndex(downloads)
+        try:
+            downloads_index_scan(index)
+            count, total = index.get_total()
+            return cache_evict(index, max(total - size, 0), dry_run,
+                               lambda source: downloads_remove(downloads, source),
+                               time.time() - DOWNLOADS_MIN_AGE)[1]
+        finally:
+            index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the caches shared by the builds')
+    parser.add_argument('--config',
+                        dest='config_file', required=False,
+                        help="Use configuration file for tuning")
+    parser.add_argument('--dry-run', action='store_true',
+                        dest='dry_run', required=False, default=False,
+                        help='Only report what would be done')
+    parser.add_argument('--quota',
+                        dest='quota', required=False, type=build_transfer.parse_size,
+                        help='Size the cache is evicted down to, e.g. 200G')
+    parser.add_argument('action', choices=ACTIONS,
+                        help='sstate-sync - copy new objects of the build into the sstate mirror, '
+                             'sstate-evict - evict least recently used objects down to the quota, '
+                             'sstate-report - report what eviction would do, '
+                             'downloads-sync - copy new tarballs of DL_DIR into the downloads mirror, '
+                             'downloads-evict - evict least recently used sources of DL_DIR and '
+                             'the downloads mirror down to their quotas, '
+                             'downloads-report - report what eviction would do')
+    args = parser.parse_args()
+    try:
+        cfg = build_conf.WorkspaceConf(args.config_file)
+        if args.action in [ACTION_DOWNLOADS_SYNC, ACTION_DOWNLOADS_EVICT,
+                           ACTION_DOWNLOADS_REPORT]:
+            downloads_maintain(cfg, [args.action], args.quota, args.dry_run)
+        else:
+            sstate_mirror_maintain(cfg, [args.action], args.quota, args.dry_run)
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
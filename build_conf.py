@@ -3,12 +3,20 @@ import datetime
 import os
 import shutil
 import errno
+import json
+import time
 
 import configparser
 
+import build_reaper
+import build_transfer
+
 # define build script version file name: this is created
 # in the deploy dir after successfull build
 VERSION_FNAME = 'build-system-version_1.0'
+# timings and resource usage of the build phases, saved
+# next to the version file
+REPORT_FNAME = 'build-report.json'
 
 '''
 The directories used during the build:
@@ -20,6 +28,7 @@ and remains alive through the builds, usually HDD. Used for:
 2.2. Build artifacts
 2.3. Xen-troops repositories used for builds
 2.4. Holds sstate-cache
+2.5. Databases of the hash equivalence and PR servers
 '''
 
 TYPE_DAILY = "dailybuild"
@@ -36,23 +45,99 @@ TYPE = [
 
 BUILD_VERSIONS_FNAME = "build-versions.inc"
 BUILD_METADATA_REFS_FNAME = "metadata-revs"
+# product and branch the warm workspace is prepared for
+WORKSPACE_STAMP_FNAME = ".xt-workspace"
+# console output of the commands run in the build environment
+CONSOLE_LOG_FNAME = "console.log"
+# progress events of bitbake as JSON lines
+PROGRESS_EVENTS_FNAME = "bitbake-progress.jsonl"
 
 YOCTO_DEFAULT_TARGET = "xt-image"
 YOCTO_UPDATE_TARGET = "xt-update"
 
+# subtrees of the Yocto build dir which can be staged on tmpfs
+STAGING_SUBTREES = ["tmp", "shared_rootfs", "deploy"]
+
+PARALLEL_YES = "yes"
+PARALLEL_AUTO = "auto"
+
 CFG_SECTION_GIT = "git"
 CFG_OPTION_XT_HISTORY = "xt_history_uri"
 CFG_OPTION_XT_MANIFEST = "xt_manifest_uri"
+CFG_OPTION_XT_HISTORY_PERSISTENT = "xt_history_persistent"
+CFG_OPTION_XT_HISTORY_DIR = "xt_history_dir"
 
 CFG_SECTION_PATH = "path"
 CFG_OPTION_WORKSPACE_DIR = "workspace_base_dir"
 CFG_OPTION_STORAGE_DIR = "workspace_storage_base_dir"
 CFG_OPTION_CACHE_DIR = "workspace_cache_base_dir"
+CFG_OPTION_FAST_TEARDOWN = "fast_teardown"
+CFG_OPTION_TEARDOWN_RATE = "teardown_rate"
 
-CFG_SECTION_CONF = "local_conf"
+# directories of the previous builds are moved here to be removed
+# in background, see build_reaper
+TRASH_DIR = '.build-trash'
 
+CFG_SECTION_CONF = "local_conf"
 
-class BuildConf(object):
+CFG_SECTION_ARTIFACTS = "artifacts"
+CFG_OPTION_TRANSFER_JOBS = "transfer_jobs"
+CFG_OPTION_TRANSFER_MODE = "transfer_mode"
+CFG_OPTION_DEDUP = "dedup"
+CFG_OPTION_LOGS = "logs"
+
+LOGS_ARCHIVE = "archive"
+LOGS_COPY = "copy"
+
+CFG_SECTION_REPO = "repo"
+CFG_OPTION_REPO_MIRROR = "mirror"
+CFG_OPTION_REPO_MIRROR_MAX_AGE = "mirror_max_age"
+CFG_OPTION_REPO_SYNC_JOBS = "sync_jobs"
+
+CFG_SECTION_SSTATE = "sstate"
+CFG_OPTION_SSTATE_MANAGE_MIRROR = "manage_mirror"
+CFG_OPTION_SSTATE_MIRROR_QUOTA = "mirror_quota"
+
+CFG_SECTION_DOWNLOADS = "downloads"
+CFG_OPTION_DOWNLOADS_MANAGE = "manage"
+CFG_OPTION_DOWNLOADS_QUOTA = "quota"
+CFG_OPTION_DOWNLOADS_MIRROR_DIR = "mirror_dir"
+CFG_OPTION_DOWNLOADS_MIRROR_QUOTA = "mirror_quota"
+
+CFG_SECTION_HASHSERV = "hashserv"
+CFG_OPTION_HASHSERV_MANAGE = "manage"
+CFG_OPTION_HASHSERV_PORT = "hashserv_port"
+CFG_OPTION_PRSERV_PORT = "prserv_port"
+
+CFG_SECTION_STAGING = "staging"
+CFG_OPTION_STAGING_DIR = "dir"
+CFG_OPTION_STAGING_SUBTREES = "subtrees"
+CFG_OPTION_STAGING_SIZE = "size"
+CFG_OPTION_STAGING_MEM_RESERVE = "mem_reserve"
+
+CFG_SECTION_PREFLIGHT = "preflight"
+CFG_OPTION_PREFLIGHT_CHECK = "check"
+CFG_OPTION_PREFLIGHT_EVICT = "evict"
+CFG_OPTION_PREFLIGHT_WAIT = "wait"
+
+CFG_SECTION_PROGRESS = "progress"
+CFG_OPTION_PROGRESS_EVENTS = "events_file"
+
+CFG_SECTION_GITHUB = "github"
+CFG_OPTION_GITHUB_API_URL = "api_url"
+CFG_OPTION_GITHUB_GIT_URL = "git_url"
+CFG_OPTION_GITHUB_TOKEN = "token"
+
+# upper limit of the automatically selected number of repo sync jobs
+REPO_SYNC_JOBS_MAX = 16
+
+
+class WorkspaceConf(object):
+    '''
+    Workspace configuration: directories and URIs used by the builds.
+    This doesn't depend on the build requested, so can be used by the
+    tools which maintain the storage and caches
+    '''
     def get_dir_build(self):
         return self.__workspace_base_dir
 
@@ -67,8 +152,17 @@ class BuildConf(object):
         return self.__xt_history_uri
 
     def get_dir_xt_history(self):
+        path = self.__config.get(CFG_SECTION_GIT, CFG_OPTION_XT_HISTORY_DIR,
+                                 raw=True, fallback=None)
+        if path:
+            return WorkspaceConf.expand_path(path)
         return os.path.join(self.get_dir_storage(), 'build-history')
 
+    # keep build history checkout between the builds
+    def get_opt_xt_history_persistent(self):
+        return self.__config.getboolean(CFG_SECTION_GIT, CFG_OPTION_XT_HISTORY_PERSISTENT,
+                                        fallback=False)
+
     # URI of the git repo with build manifests
     def get_uri_xt_manifest(self):
         return self.__xt_manifest_uri
@@ -76,12 +170,13 @@ class BuildConf(object):
     def get_dir_xt_manifest(self):
         return os.path.join(self.get_dir_storage(), 'build-manifest')
 
-    def get_dir_buildhistory_rel(self):
-        return self.__buildhistory_rel_dir
+    # index of the builds in the build history, see build_index
+    def get_file_history_index(self):
+        return os.path.join(self.get_dir_storage(), 'build-history-index.sqlite')
 
-    def get_dir_history_artifacts(self):
-        return os.path.join(self.get_dir_xt_history(),
-                            self.get_dir_buildhistory_rel())
+    # local mirror of all the repositories used by the builds
+    def get_dir_repo_mirror(self):
+        return os.path.join(self.get_dir_storage(), 'repo-mirror')
 
     # this is the directory we deliver artifacts to
     def get_dir_build_artifacts(self):
@@ -98,6 +193,74 @@ class BuildConf(object):
     def get_dir_yocto_sstate(self):
         return os.path.join(self.get_dir_cache(), 'current-build-cache')
 
+    # sstate mirror is populated by the build script instead of the build
+    def get_opt_sstate_manage_mirror(self):
+        return self.__config.getboolean(CFG_SECTION_SSTATE, CFG_OPTION_SSTATE_MANAGE_MIRROR,
+                                        fallback=False)
+
+    # size the sstate mirror is evicted down to, 0 for unlimited
+    def get_opt_sstate_mirror_quota(self):
+        return build_transfer.parse_size(self.__config.get(CFG_SECTION_SSTATE,
+                                                           CFG_OPTION_SSTATE_MIRROR_QUOTA,
+                                                           fallback='0'))
+
+    # downloads are tracked, mirrored as tarballs and evicted
+    def get_opt_downloads_manage(self):
+        return self.__config.getboolean(CFG_SECTION_DOWNLOADS, CFG_OPTION_DOWNLOADS_MANAGE,
+                                        fallback=False)
+
+    # size DL_DIR is evicted down to, 0 for unlimited
+    def get_opt_downloads_quota(self):
+        return build_transfer.parse_size(self.__config.get(CFG_SECTION_DOWNLOADS,
+                                                           CFG_OPTION_DOWNLOADS_QUOTA,
+                                                           fallback='0'))
+
+    # premirror of the downloads (tarballs only), can be shared with other builders
+    def get_dir_yocto_downloads_mirror(self):
+        path = self.__config.get(CFG_SECTION_DOWNLOADS, CFG_OPTION_DOWNLOADS_MIRROR_DIR,
+                                 fallback=None)
+        if path:
+            return self.expand_path(path)
+        return os.path.join(self.get_dir_storage(), 'downloads-mirror')
+
+    def get_opt_downloads_mirror_quota(self):
+        return build_transfer.parse_size(self.__config.get(CFG_SECTION_DOWNLOADS,
+                                                           CFG_OPTION_DOWNLOADS_MIRROR_QUOTA,
+                                                           fallback='0'))
+
+    # hash equivalence and PR servers are shared by the builds of the host
+    def get_opt_hashserv_manage(self):
+        return self.__config.getboolean(CFG_SECTION_HASHSERV, CFG_OPTION_HASHSERV_MANAGE,
+                                        fallback=False)
+
+    def get_opt_hashserv_port(self):
+        return self.__config.getint(CFG_SECTION_HASHSERV, CFG_OPTION_HASHSERV_PORT,
+                                    fallback=8686)
+
+    def get_opt_prserv_port(self):
+        return self.__config.getint(CFG_SECTION_HASHSERV, CFG_OPTION_PRSERV_PORT,
+                                    fallback=8585)
+
+    def get_dir_hashserv(self):
+        return os.path.join(self.get_dir_storage(), 'hashserv')
+
+    def get_opt_github_api_url(self):
+        return self.__config.get(CFG_SECTION_GITHUB, CFG_OPTION_GITHUB_API_URL,
+                                 fallback='https://api.github.com').rstrip('/')
+
+    def get_opt_github_git_url(self):
+        return self.__config.get(CFG_SECTION_GITHUB, CFG_OPTION_GITHUB_GIT_URL,
+                                 fallback='https://github.com').rstrip('/')
+
+    # token is optional: without it API requests are rate-limited by IP
+    def get_opt_github_token(self):
+        return self.__config.get(CFG_SECTION_GITHUB, CFG_OPTION_GITHUB_TOKEN,
+                                 fallback=os.environ.get('GITHUB_TOKEN'))
+
+    # metadata of the pull requests and their ETags
+    def get_file_github_cache(self):
+        return os.path.join(self.get_dir_storage(), 'github-cache.json')
+
     def get_dir_yocto_build(self):
         return os.path.join(self.get_dir_build(), 'build')
 
@@ -107,12 +270,250 @@ class BuildConf(object):
     def get_dir_yocto_log(self):
         return os.path.join(self.get_dir_yocto_build(), 'log')
 
+    # tmpfs the I/O heavy subtrees of the build are staged on, None if not used
+    def get_dir_staging(self):
+        path = self.__config.get(CFG_SECTION_STAGING, CFG_OPTION_STAGING_DIR,
+                                 fallback=None)
+        if path:
+            return self.expand_path(path)
+        return None
+
+    def get_opt_staging_subtrees(self):
+        subtrees = self.__config.get(CFG_SECTION_STAGING, CFG_OPTION_STAGING_SUBTREES,
+                                     fallback='tmp shared_rootfs').split()
+        for subtree in subtrees:
+            if subtree not in STAGING_SUBTREES:
+                raise Exception('Wrong [staging] subtree "' + subtree + '", use ' +
+                                ', '.join(STAGING_SUBTREES))
+        return subtrees
+
+    # space the staged subtrees need, the peak of the previous builds is used
+    # if bigger
+    def get_opt_staging_size(self):
+        return build_transfer.parse_size(self.__config.get(CFG_SECTION_STAGING,
+                                                           CFG_OPTION_STAGING_SIZE,
+                                                           fallback='0'))
+
+    # memory which must stay available besides the staged subtrees
+    def get_opt_staging_mem_reserve(self):
+        return build_transfer.parse_size(self.__config.get(CFG_SECTION_STAGING,
+                                                           CFG_OPTION_STAGING_MEM_RESERVE,
+                                                           fallback='16G'))
+
+    def get_dir_staging_stats(self):
+        return os.path.join(self.get_dir_storage(), 'staging-stats')
+
+    def get_opt_preflight_check(self):
+        return self.__config.getboolean(CFG_SECTION_PREFLIGHT, CFG_OPTION_PREFLIGHT_CHECK,
+                                        fallback=True)
+
+    # caches may be evicted to make space for the build
+    def get_opt_preflight_evict(self):
+        return self.__config.getboolean(CFG_SECTION_PREFLIGHT, CFG_OPTION_PREFLIGHT_EVICT,
+                                        fallback=True)
+
+    # seconds the build waits for space before it is refused
+    def get_opt_preflight_wait(self):
+        return self.__config.getint(CFG_SECTION_PREFLIGHT, CFG_OPTION_PREFLIGHT_WAIT,
+                                    fallback=0)
+
+    def get_dir_footprints(self):
+        return os.path.join(self.get_dir_storage(), 'footprints')
+
+    # file the progress events of bitbake are appended to
+    def get_file_progress_events(self):
+        path = self.__config.get(CFG_SECTION_PROGRESS, CFG_OPTION_PROGRESS_EVENTS,
+                                 fallback=None)
+        if path:
+            return self.expand_path(path)
+        return os.path.join(self.get_dir_yocto_log(), PROGRESS_EVENTS_FNAME)
+
+    # task timings of the previous builds, used to estimate the time left
+    def get_dir_progress_timings(self):
+        return os.path.join(self.get_dir_storage(), 'bitbake-timings')
+
     def get_dir_yocto_buildhistory(self):
         return os.path.join(self.get_dir_yocto_build(), 'buildhistory')
 
     def get_dir_yocto_shared_rootfs(self):
         return os.path.join(self.get_dir_yocto_build(), 'shared_rootfs')
 
+    def get_opt_local_conf(self):
+        return self.__xt_local_conf_options
+
+    # number of workers used to populate artifacts, 0 for auto
+    def get_opt_transfer_jobs(self):
+        return self.__config.getint(CFG_SECTION_ARTIFACTS, CFG_OPTION_TRANSFER_JOBS,
+                                    fallback=0)
+
+    def get_opt_transfer_mode(self):
+        return self.__config.get(CFG_SECTION_ARTIFACTS, CFG_OPTION_TRANSFER_MODE,
+                                 fallback='auto')
+
+    def get_opt_artifacts_dedup(self):
+        return self.__config.getboolean(CFG_SECTION_ARTIFACTS, CFG_OPTION_DEDUP,
+                                        fallback=False)
+
+    def get_opt_artifacts_logs(self):
+        logs = self.__config.get(CFG_SECTION_ARTIFACTS, CFG_OPTION_LOGS,
+                                 fallback=LOGS_ARCHIVE)
+        if logs not in [LOGS_ARCHIVE, LOGS_COPY]:
+            raise Exception('Wrong [artifacts] logs "' + logs + '", use ' +
+                            LOGS_ARCHIVE + ' or ' + LOGS_COPY)
+        return logs
+
+    def get_opt_repo_mirror(self):
+        return self.__config.getboolean(CFG_SECTION_REPO, CFG_OPTION_REPO_MIRROR,
+                                        fallback=False)
+
+    # seconds the mirror is considered up to date after its update
+    def get_opt_repo_mirror_max_age(self):
+        return self.__config.getint(CFG_SECTION_REPO, CFG_OPTION_REPO_MIRROR_MAX_AGE,
+                                    fallback=600)
+
+    def get_opt_repo_sync_jobs(self):
+        jobs = self.__config.get(CFG_SECTION_REPO, CFG_OPTION_REPO_SYNC_JOBS,
+                                 fallback='auto')
+        if jobs == 'auto':
+            return min(REPO_SYNC_JOBS_MAX, os.cpu_count() or 1)
+        return int(jobs)
+
+    @staticmethod
+    def setup_dir(path, remove=False, silent=False):
+        # remove the existing one if any
+        if remove:
+            if not silent:
+                print('Removing ' + path)
+            try:
+                shutil.rmtree(path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def get_opt_fast_teardown(self):
+        return self.__config.getboolean(CFG_SECTION_PATH, CFG_OPTION_FAST_TEARDOWN,
+                                        fallback=False)
+
+    # files removed per second by the reaper, 0 for unlimited
+    def get_opt_teardown_rate(self):
+        return self.__config.getint(CFG_SECTION_PATH, CFG_OPTION_TEARDOWN_RATE,
+                                    fallback=0)
+
+    @staticmethod
+    def get_dir_trash(path):
+        # trash must be on the same filesystem as path
+        return os.path.join(os.path.dirname(path), TRASH_DIR)
+
+    def setup_workspace_dir(self, path, remove=False):
+        '''
+        Same as setup_dir, but with fast teardown enabled the existing
+        directory is moved into the trash and removed in background
+        '''
+        if remove and self.get_opt_fast_teardown():
+            trash = WorkspaceConf.get_dir_trash(path)
+            dest = os.path.join(trash, '%s.%d.%d' % (os.path.basename(path),
+                                                     time.time(), os.getpid()))
+            print('Moving %s to %s' % (path, trash))
+            try:
+                WorkspaceConf.setup_dir(trash)
+                os.rename(path, dest)
+                remove = False
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    remove = False
+                else:
+                    # e.g. path is a mount point: remove it the usual way
+                    print('Failed to move %s to trash: %s' % (path, err))
+            if os.path.isdir(trash):
+                build_reaper.reaper_start(trash, self.get_opt_teardown_rate())
+        WorkspaceConf.setup_dir(path, remove)
+
+    @staticmethod
+    def expand_path(path):
+        return os.path.normpath(os.path.expandvars(os.path.expanduser(path)))
+
+    def set_work_config(self, config_file):
+        # place where build happens, SSD
+        self.__workspace_base_dir = os.path.join(os.sep, 'tmp', 'build-ssd')
+        # place where we store files which can be re-used
+        self.__workspace_storage_base_dir = os.path.join(os.sep, 'tmp', 'build-hdd')
+        # place where we store Yocto's sstate and ccache
+        self.__workspace_cache_base_dir = os.path.join(os.sep, 'tmp', 'build-ssd')
+
+        # URI of the git repo with build history
+        self.__xt_history_uri = 'ssh://git@git.epam.com/epmd-aepr/build-history.git'
+        # URI of the git repo with build manifests
+        self.__xt_manifest_uri = 'https://github.com/xen-troops/meta-xt-products.git'
+
+        self.__xt_local_conf_options = []
+        self.__config = configparser.ConfigParser()
+        if config_file:
+            config = self.__config
+            config.read(config_file)
+            uri = config.get(CFG_SECTION_PATH, CFG_OPTION_WORKSPACE_DIR, raw = True)
+            if uri:
+                self.__workspace_base_dir = WorkspaceConf.expand_path(uri)
+            uri = config.get(CFG_SECTION_PATH, CFG_OPTION_STORAGE_DIR, raw = True)
+            if uri:
+                self.__workspace_storage_base_dir = WorkspaceConf.expand_path(uri)
+            uri = config.get(CFG_SECTION_PATH, CFG_OPTION_CACHE_DIR, raw = True)
+            if uri:
+                self.__workspace_cache_base_dir = WorkspaceConf.expand_path(uri)
+            uri = config.get(CFG_SECTION_GIT, CFG_OPTION_XT_HISTORY, raw = True)
+            if uri:
+                self.__xt_history_uri = uri
+            uri = config.get(CFG_SECTION_GIT, CFG_OPTION_XT_MANIFEST, raw = True)
+            if uri:
+                self.__xt_manifest_uri = uri
+            try:
+                config_items = config.items(CFG_SECTION_CONF)
+                if config_items:
+                    self.__xt_local_conf_options = config_items
+            except configparser.NoSectionError:
+                pass
+
+    def __init__(self, config_file=None):
+        self.set_work_config(config_file)
+
+
+class BuildConf(WorkspaceConf):
+    def get_dir_buildhistory_rel(self):
+        return self.__buildhistory_rel_dir
+
+    def get_file_footprints(self):
+        return os.path.join(self.get_dir_footprints(),
+                            '%s_%s.json' % (self.get_opt_product_type(),
+                                            self.get_opt_machine_type()))
+
+    def get_file_staging_stats(self):
+        return os.path.join(self.get_dir_staging_stats(),
+                            '%s_%s.json' % (self.get_opt_product_type(),
+                                            self.get_opt_machine_type()))
+
+    def get_file_progress_timings(self):
+        return os.path.join(self.get_dir_progress_timings(),
+                            '%s_%s.json' % (self.get_opt_product_type(),
+                                            self.get_opt_machine_type()))
+
+    def get_dir_history_artifacts(self):
+        return os.path.join(self.get_dir_xt_history(),
+                            self.get_dir_buildhistory_rel())
+
+    # this is the directory we deliver artifacts of this build to
+    def get_dir_build_artifacts_dest(self):
+        return os.path.join(self.get_dir_build_artifacts(),
+                            self.get_dir_buildhistory_rel())
+
+    # part of the build history this build belongs to, e.g.
+    # all the builds of this product and machine made today
+    def get_dir_buildhistory_subtree_rel(self):
+        return os.path.dirname(self.get_dir_buildhistory_rel())
+
     # build options
     def get_opt_generate_local_conf(self):
         return self.__args.local_conf
@@ -132,6 +533,10 @@ class BuildConf(object):
     def get_opt_continue_build(self):
         return self.__args.continue_build
 
+    # workspace of the previous build is reused
+    def get_opt_warm_workspace(self):
+        return self.__warm_workspace
+
     def get_opt_build_type(self):
         return self.__args.build_type
 
@@ -144,41 +549,48 @@ class BuildConf(object):
     def get_opt_parallel_build(self):
         return self.__args.parallel_build
 
-    def get_opt_local_conf(self):
-        return self.__xt_local_conf_options
+    def get_opt_parallel_build_auto(self):
+        return self.__args.parallel_build == PARALLEL_AUTO
 
     def get_opt_repo_branch(self):
         return self.__args.repo_branch
 
+    def get_opt_reconstr_type(self):
+        return self.__reconstr_type
+
     def get_opt_reconstr_date(self):
+        if self.__reconstr_date:
+            return self.__reconstr_date
         return self.__args.reconstr_date.strftime('%Y-%m-%d')
 
     def get_opt_reconstr_time(self):
+        if self.__reconstr_time:
+            return self.__reconstr_time
         return self.__args.reconstr_time.strftime('%H-%M-%S')
 
+    # build to reconstruct is to be found in the build history index
+    def get_opt_reconstr_lookup(self):
+        return not (self.__args.reconstr_date and self.__args.reconstr_time)
+
+    def get_opt_reconstr_before(self):
+        if not self.__args.reconstr_before:
+            return None
+        return self.__args.reconstr_before.strftime('%Y-%m-%d')
+
+    def get_opt_reconstr_revision(self):
+        return self.__args.reconstr_revision
+
+    def set_reconstr_build(self, build_type, date, time):
+        self.__reconstr_type = build_type
+        self.__reconstr_date = date
+        self.__reconstr_time = time
+
     def get_prod_pulls(self):
         return self.__args.prod_pulls
     
     def get_opt_generate_update(self):
         return self.__args.generate_update
 
-    @staticmethod
-    def setup_dir(path, remove=False, silent=False):
-        # remove the existing one if any
-        if remove:
-            if not silent:
-                print('Removing ' + path)
-            try:
-                shutil.rmtree(path)
-            except OSError as err:
-                if err.errno != errno.ENOENT:
-                    raise
-        try:
-            os.makedirs(path)
-        except OSError as err:
-            if err.errno != errno.EEXIST:
-                raise
-
     def __parse_args(self):
         parser = argparse.ArgumentParser()
         required = parser.add_argument_group('required arguments')
@@ -207,12 +619,18 @@ class BuildConf(object):
         parser.add_argument('--continue-build', action='store_true',
                             dest='continue_build', required=False, default=False,
                             help='Continue existing build if any, do not clean up')
+        parser.add_argument('--warm-workspace', action='store_true',
+                            dest='warm_workspace', required=False, default=False,
+                            help='Reuse the workspace of the previous build of the same '
+                                 'product and branch, only synchronizing it incrementally')
         parser.add_argument('--retain-sstate', action='store_true',
                             dest='retain_sstate', required=False, default=False,
                             help='Do not remove SSTATE_DIR at any circumstances')
-        parser.add_argument('--parallel-build', action='store_true',
+        parser.add_argument('--parallel-build', nargs='?', choices=[PARALLEL_YES, PARALLEL_AUTO],
+                            const=PARALLEL_YES,
                             dest='parallel_build', required=False, default=False,
-                            help='Allow parallel building of domains')
+                            help='Allow parallel building of domains, "auto" to also '
+                                 'tune bitbake parallelism for this host')
         parser.add_argument('--config',
                             dest='config_file', required=False,
                             help="Use configuration file for tuning")
@@ -231,67 +649,73 @@ class BuildConf(object):
         known_args, other_args = parser.parse_known_args()
         # now that we know which build it is we can add appropriate options
         if known_args.build_type == TYPE_RECONSTR:
+            parser.add_argument('--latest', action='store_true',
+                                dest='reconstr_latest', required=False, default=False,
+                                help='Reconstruct the latest build of the product and machine')
+            parser.add_argument('--before',
+                                dest='reconstr_before', required=False,
+                                help='Reconstruct the latest build made on or before the date',
+                                type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d'))
+            parser.add_argument('--revision',
+                                dest='reconstr_revision', required=False,
+                                help='Reconstruct the latest build containing the revision')
+            known_args, other_args = parser.parse_known_args()
+            # date and time are not needed if the build is looked up
+            lookup = known_args.reconstr_latest or known_args.reconstr_before or \
+                known_args.reconstr_revision
             parser.add_argument('--date',
-                                dest='reconstr_date', required=True,
+                                dest='reconstr_date', required=not lookup,
                                 help='Date of the build to reconstruct',
                                 type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d'))
             parser.add_argument('--time',
-                                dest='reconstr_time', required=True,
+                                dest='reconstr_time', required=not lookup,
                                 help='Time of the build to reconstruct',
                                 type=lambda d: datetime.datetime.strptime(d, '%H-%M-%S'))
         self.__args = parser.parse_args()
 
-    @staticmethod
-    def expand_path(path):
-        return os.path.normpath(os.path.expandvars(os.path.expanduser(path)))
-
-    def set_work_config(self):
-        # place where build happens, SSD
-        self.__workspace_base_dir = os.path.join(os.sep, 'tmp', 'build-ssd')
-        # place where we store files which can be re-used
-        self.__workspace_storage_base_dir = os.path.join(os.sep, 'tmp', 'build-hdd')
-        # place where we store Yocto's sstate and ccache
-        self.__workspace_cache_base_dir = os.path.join(os.sep, 'tmp', 'build-ssd')
-
-        # URI of the git repo with build history
-        self.__xt_history_uri = 'ssh://git@git.epam.com/epmd-aepr/build-history.git'
-        # URI of the git repo with build manifests
-        self.__xt_manifest_uri = 'https://github.com/xen-troops/meta-xt-products.git'
-
-        if self.__args.config_file:
-            config = configparser.ConfigParser()
-            config.read(self.__args.config_file)
-            uri = config.get(CFG_SECTION_PATH, CFG_OPTION_WORKSPACE_DIR, raw = True)
-            if uri:
-                self.__workspace_base_dir = BuildConf.expand_path(uri)
-            uri = config.get(CFG_SECTION_PATH, CFG_OPTION_STORAGE_DIR, raw = True)
-            if uri:
-                self.__workspace_storage_base_dir = BuildConf.expand_path(uri)
-            uri = config.get(CFG_SECTION_PATH, CFG_OPTION_CACHE_DIR, raw = True)
-            if uri:
-                self.__workspace_cache_base_dir = BuildConf.expand_path(uri)
-            uri = config.get(CFG_SECTION_GIT, CFG_OPTION_XT_HISTORY, raw = True)
-            if uri:
-                self.__xt_history_uri = uri
-            uri = config.get(CFG_SECTION_GIT, CFG_OPTION_XT_MANIFEST, raw = True)
-            if uri:
-                self.__xt_manifest_uri = uri
-            self.__xt_local_conf_options = []
-            try:
-                config_items = config.items(CFG_SECTION_CONF)
-                if config_items:
-                    self.__xt_local_conf_options = config_items
-            except configparser.NoSectionError:
-                pass
+    def __get_file_workspace_stamp(self):
+        return os.path.join(self.get_dir_build(), WORKSPACE_STAMP_FNAME)
+
+    def __get_workspace_stamp(self):
+        # everything local.conf is made of besides the paths, so TMPDIR and
+        # deploy of another machine or configuration are never reused
+        return {
+            'product': self.get_opt_product_type(),
+            'branch': self.get_opt_repo_branch(),
+            'machine': self.get_opt_machine_type(),
+            'populate_sdk': bool(self.get_opt_populate_sdk()),
+            'local_conf': [list(item) for item in self.get_opt_local_conf()],
+        }
+
+    def __check_workspace_stamp(self):
+        try:
+            with open(self.__get_file_workspace_stamp()) as f:
+                stamp = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if stamp != self.__get_workspace_stamp():
+            print('Workspace %s was prepared for %s, starting from scratch' %
+                  (self.get_dir_build(), stamp))
+            return False
+        return True
 
     def __init__(self):
         # get build arguments
         self.__parse_args()
-        self.set_work_config()
+        WorkspaceConf.__init__(self, self.__args.config_file)
+        self.__reconstr_type = TYPE_DAILY
+        self.__reconstr_date = None
+        self.__reconstr_time = None
         self.__buildhistory_rel_dir = os.path.join(self.get_opt_build_type(),
                                                    datetime.date.today().strftime('%Y-%m-%d'),
                                                    self.get_opt_product_type(), self.get_opt_machine_type(),
                                                    datetime.datetime.now().strftime('%H-%M-%S'))
-        BuildConf.setup_dir(self.get_dir_build(), not (self.__args.continue_build or self.__args.generate_update))
+        # the workspace is only reused if it was prepared for the same product, branch,
+        # machine and local.conf options
+        self.__warm_workspace = self.__args.warm_workspace and self.__check_workspace_stamp()
+        self.setup_workspace_dir(self.get_dir_build(), not (self.__args.continue_build or self.__args.generate_update or self.__warm_workspace))
         BuildConf.setup_dir(self.get_dir_storage())
-        BuildConf.setup_dir(self.get_dir_yocto_sstate(), not (self.__args.continue_build or self.__args.retain_sstate or self.__args.generate_update))
+        self.setup_workspace_dir(self.get_dir_yocto_sstate(), not (self.__args.continue_build or self.__args.retain_sstate or self.__args.generate_update or self.__warm_workspace))
+        if self.__args.warm_workspace:
+            with open(self.__get_file_workspace_stamp(), 'w') as f:
+                json.dump(self.__get_workspace_stamp(), f)
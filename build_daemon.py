@@ -0,0 +1,365 @@
+import argparse
+import configparser
+import datetime
+import itertools
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import build_conf
+import build_matrix
+
+'''
+Build service: a long-running daemon which accepts build jobs through
+a local HTTP API, queues them and runs them as build_prod.py processes.
+- jobs identical to the one already queued are deduplicated
+- bursts of pushes to the same product/machine/branch are coalesced:
+an on_push job waits for coalesce_delay seconds after the last push
+before it starts, and the pushes made meanwhile are merged into it
+- every product/machine/branch has its own workspace and jobs of the
+same workspace never run at the same time. on_push builds reuse the
+workspace of the previous build, see --warm-workspace of build_prod.py
+
+API (JSON):
+POST   /jobs            - queue a job: {"type": "on_push", "product": "devel",
+                          "machine": "salvator-x", "branch": "master", "args": []}
+GET    /jobs            - list the jobs
+GET    /jobs/<id>       - state of the job
+GET    /jobs/<id>/log   - log of the job
+DELETE /jobs/<id>       - cancel the job
+'''
+
+CFG_SECTION_DAEMON = "daemon"
+CFG_OPTION_LISTEN = "listen"
+CFG_OPTION_MAX_JOBS = "max_jobs"
+CFG_OPTION_COALESCE_DELAY = "coalesce_delay"
+CFG_OPTION_BUILD_ARGS = "build_args"
+CFG_OPTION_HISTORY = "history"
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+JOB_TYPES = [
+    build_conf.TYPE_DAILY,
+    build_conf.TYPE_PUSH,
+    build_conf.TYPE_REQ
+]
+
+# queue is checked for finished and runnable jobs, seconds
+POLL_INTERVAL = 1
+
+
+class DaemonJob(object):
+    def __init__(self, job_id, build_type, product, machine, branch, args):
+        self.id = job_id
+        self.type = build_type
+        self.product = product
+        self.machine = machine
+        self.branch = branch
+        self.args = args
+        self.status = STATUS_PENDING
+        self.submitted = time.time()
+        # coalesced jobs do not start before this
+        self.not_before = 0
+        self.requests = 1
+        self.proc = None
+        self.log_file = None
+        self.report_file = None
+        self.returncode = None
+        self.start = None
+        self.end = None
+
+    def get_workspace(self):
+        return 'prod-%s-%s-%s' % (self.product, self.machine, self.branch.replace('/', '_'))
+
+    def get_key(self):
+        return (self.type, self.product, self.machine, self.branch, tuple(self.args))
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'product': self.product,
+            'machine': self.machine,
+            'branch': self.branch,
+            'args': self.args,
+            'status': self.status,
+            'requests': self.requests,
+            'submitted': datetime.datetime.fromtimestamp(self.submitted).isoformat(),
+            'returncode': self.returncode,
+            'wall_time': round(self.end - self.start, 3) if self.end else None,
+            'log': self.log_file,
+            'build_report': self.report_file,
+        }
+
+
+class BuildDaemon(object):
+    def __init__(self, cfg, config_file):
+        self.__cfg = cfg
+        # values are passed to the builds as they are
+        self.__config = configparser.ConfigParser(interpolation=None)
+        self.__config.read(config_file)
+        self.__max_jobs = self.__config.getint(CFG_SECTION_DAEMON, CFG_OPTION_MAX_JOBS,
+                                               fallback=1)
+        self.__coalesce_delay = self.__config.getint(CFG_SECTION_DAEMON,
+                                                     CFG_OPTION_COALESCE_DELAY, fallback=60)
+        self.__build_args = shlex.split(self.__config.get(CFG_SECTION_DAEMON,
+                                                          CFG_OPTION_BUILD_ARGS, fallback=''))
+        # number of finished jobs remembered
+        self.__history = self.__config.getint(CFG_SECTION_DAEMON, CFG_OPTION_HISTORY,
+                                              fallback=100)
+        self.__jobs = []
+        self.__ids = itertools.count(1)
+        self.__cond = threading.Condition()
+        self.__stopped = False
+
+    def get_dir_daemon(self):
+        return os.path.join(self.__cfg.get_dir_build(), 'daemon')
+
+    def submit(self, build_type, product, machine, branch='master', args=None):
+        '''
+        Queue the job, returns the job and whether it was merged
+        into the one already queued
+        '''
+        if build_type not in JOB_TYPES:
+            raise ValueError('Wrong build type "%s", use one of %s' %
+                             (build_type, ', '.join(JOB_TYPES)))
+        if not product or not machine:
+            raise ValueError('Both product and machine are required')
+        job = DaemonJob(None, build_type, product, machine,
+                        branch or 'master', list(args or []))
+        with self.__cond:
+            for queued in self.__jobs:
+                if queued.status != STATUS_PENDING or queued.get_key() != job.get_key():
+                    continue
+                queued.requests += 1
+                if queued.type == build_conf.TYPE_PUSH:
+                    # wait for the burst of pushes to end
+                    queued.not_before = time.time() + self.__coalesce_delay
+                return queued, True
+            if job.type == build_conf.TYPE_PUSH:
+                job.not_before = job.submitted + self.__coalesce_delay
+            job.id = next(self.__ids)
+            self.__jobs.append(job)
+            self.__cond.notify()
+        return job, False
+
+    def get_jobs(self):
+        with self.__cond:
+            return list(self.__jobs)
+
+    def get_job(self, job_id):
+        with self.__cond:
+            for job in self.__jobs:
+                if job.id == job_id:
+                    return job
+        return None
+
+    def cancel(self, job_id):
+        with self.__cond:
+            job = self.get_job(job_id)
+            if not job:
+                return None
+            if job.status == STATUS_PENDING:
+                job.status = STATUS_CANCELLED
+            elif job.status == STATUS_RUNNING:
+                job.proc.terminate()
+                job.status = STATUS_CANCELLED
+            self.__cond.notify()
+            return job
+
+    def __start(self, job):
+        job_dir = os.path.join(self.get_dir_daemon(), job.get_workspace())
+        config_file = build_matrix.job_config_write(
+            self.__cfg, self.__config, CFG_SECTION_DAEMON, job_dir,
+            os.path.join(self.__cfg.get_dir_cache(), 'daemon', job.get_workspace()))
+        job.log_file = os.path.join(job_dir, 'job-%d.log' % job.id)
+        argv = [sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build_prod.py'),
+                '--build-type', job.type, '--product', job.product, '--machine', job.machine,
+                '--branch', job.branch, '--config', config_file] + \
+            self.__build_args + job.args
+        if job.type == build_conf.TYPE_PUSH:
+            argv.append('--warm-workspace')
+        print('Starting job %d: %s' % (job.id, ' '.join(argv)))
+        job.start = time.monotonic()
+        job.status = STATUS_RUNNING
+        with open(job.log_file, 'w') as log:
+            job.proc = subprocess.Popen(argv, stdout=log, stderr=subprocess.STDOUT,
+                                        stdin=subprocess.DEVNULL)
+
+    def __finish(self, job):
+        job.end = time.monotonic()
+        job.returncode = job.proc.returncode
+        if job.status != STATUS_CANCELLED:
+            job.status = STATUS_OK if job.returncode == 0 else STATUS_FAILED
+        job.report_file = build_matrix.job_report_file(job.log_file)
+        job.proc = None
+        print('Finished job %d: %s in %.1fs' % (job.id, job.status, job.end - job.start))
+
+    def __schedule(self):
+        # cancelled jobs are also waited for
+        for job in self.__jobs:
+            if job.proc and job.proc.poll() is not None:
+                self.__finish(job)
+        busy = set([job.get_workspace() for job in self.__jobs if job.proc])
+        now = time.time()
+        # jobs are started in the order they were submitted
+        for job in self.__jobs:
+            if len(busy) >= self.__max_jobs:
+                break
+            if job.status != STATUS_PENDING or job.not_before > now or \
+                    job.get_workspace() in busy:
+                continue
+            try:
+                self.__start(job)
+            except Exception as e:
+                print('Failed to start job %d: %s' % (job.id, e))
+                job.status = STATUS_FAILED
+                continue
+            busy.add(job.get_workspace())
+        # forget the oldest finished jobs
+        finished = [job for job in self.__jobs
+                    if job.status not in [STATUS_PENDING, STATUS_RUNNING] and not job.proc]
+        for job in finished[:max(0, len(finished) - self.__history)]:
+            self.__jobs.remove(job)
+
+    def run(self):
+        os.makedirs(self.get_dir_daemon(), exist_ok=True)
+        with self.__cond:
+            while not self.__stopped:
+                self.__schedule()
+                self.__cond.wait(POLL_INTERVAL)
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            for job in self.__jobs:
+                if job.proc:
+                    job.proc.terminate()
+                    job.proc.wait()
+                    self.__finish(job)
+            self.__cond.notify()
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    daemon = None
+
+    def __reply(self, code, data):
+        body = json.dumps(data, indent=1, sort_keys=True).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __get_job(self):
+        # /jobs/<id>[/log]
+        parts = self.path.strip('/').split('/')
+        try:
+            job = self.daemon.get_job(int(parts[1]))
+        except (IndexError, ValueError):
+            job = None
+        if not job:
+            self.__reply(404, {'error': 'No such job'})
+        return job, parts[2:]
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/jobs':
+            self.__reply(200, [job.as_dict() for job in self.daemon.get_jobs()])
+            return
+        job, rest = self.__get_job()
+        if not job:
+            return
+        if rest == ['log']:
+            if not job.log_file or not os.path.exists(job.log_file):
+                self.__reply(404, {'error': 'Job has no log yet'})
+                return
+            with open(job.log_file, 'rb') as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.__reply(200, job.as_dict())
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.__reply(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            job, merged = self.daemon.submit(request.get('type', build_conf.TYPE_REQ),
+                                             request.get('product'), request.get('machine'),
+                                             request.get('branch'), request.get('args'))
+        except ValueError as e:
+            self.__reply(400, {'error': str(e)})
+            return
+        reply = job.as_dict()
+        reply['merged'] = merged
+        self.__reply(200 if merged else 201, reply)
+
+    def do_DELETE(self):
+        job, rest = self.__get_job()
+        if not job:
+            return
+        self.__reply(200, self.daemon.cancel(job.id).as_dict())
+
+    def log_message(self, format, *args):
+        print('%s %s' % (self.address_string(), format % args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the build service')
+    parser.add_argument('--config',
+                        dest='config_file', required=True,
+                        help="Configuration file with the [daemon] section")
+    parser.add_argument('--listen',
+                        dest='listen', required=False,
+                        help='Address to listen on, host:port. Default is [daemon] listen '
+                             'or 127.0.0.1:8090')
+    args = parser.parse_args()
+    try:
+        cfg = build_conf.WorkspaceConf(args.config_file)
+        daemon = BuildDaemon(cfg, args.config_file)
+        listen = args.listen
+        if not listen:
+            config = configparser.ConfigParser(interpolation=None)
+            config.read(args.config_file)
+            listen = config.get(CFG_SECTION_DAEMON, CFG_OPTION_LISTEN, fallback='127.0.0.1:8090')
+        host, port = listen.rsplit(':', 1)
+        DaemonRequestHandler.daemon = daemon
+        server = ThreadingHTTPServer((host, int(port)), DaemonRequestHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        print('Listening on %s:%s' % (host, port))
+        # running builds are stopped with the daemon
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            print('Stopping')
+        finally:
+            server.shutdown()
+            daemon.stop()
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
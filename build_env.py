@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+
+'''
+Yocto build environment session.
+The environment script (oe-init-build-env) is sourced only once: the
+resulting environment variables and working directory are captured and
+then used to run bitbake and friends directly, without a shell.
+'''
+
+YOCTO_INIT_SCRIPT = os.path.join('xt-distro', 'oe-init-build-env')
+
+
+class BuildEnv(object):
+    def __init__(self, workspace_dir, log_file=None):
+        self.__workspace_dir = workspace_dir
+        self.__log_file = log_file
+        self.__env = None
+        self.__cwd = None
+
+    def get_env(self):
+        return self.__env
+
+    def get_cwd(self):
+        return self.__cwd
+
+    def setup(self):
+        print('Setting up build environment with ' + YOCTO_INIT_SCRIPT)
+        # output of the script goes to stderr, so stdout only has
+        # the resulting working directory and environment
+        proc = subprocess.run(['bash', '-c',
+                               'source "$0" 1>&2 && printf "%s\\0" "$PWD" && env -0',
+                               YOCTO_INIT_SCRIPT],
+                              cwd=self.__workspace_dir, stdout=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise Exception('Failed to source "' + YOCTO_INIT_SCRIPT +
+                            '", error code: ' + str(proc.returncode))
+        values = proc.stdout.decode('utf-8', 'replace').split('\0')
+        self.__cwd = values[0]
+        self.__env = {}
+        for value in values[1:]:
+            if '=' in value:
+                key, val = value.split('=', 1)
+                self.__env[key] = val
+
+    def run(self, argv, on_line=None):
+        '''
+        Run command in the build environment, output is streamed
+        to the console and the build log line by line as it comes.
+        on_line, if set, is called for every line of the output
+        '''
+        if self.__env is None:
+            self.setup()
+        print('Running ' + ' '.join(argv))
+        log = None
+        if self.__log_file:
+            os.makedirs(os.path.dirname(self.__log_file), exist_ok=True)
+            log = open(self.__log_file, 'at')
+        try:
+            proc = subprocess.Popen(argv, cwd=self.__cwd, env=self.__env,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True, errors='replace')
+            for line in proc.stdout:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+                if log:
+                    log.write(line)
+                    log.flush()
+                if on_line:
+                    on_line(line)
+            ret = proc.wait()
+        finally:
+            if log:
+                log.close()
+        if ret != 0:
+            raise Exception('Failed to run "' + ' '.join(argv) + '", error code: ' + str(ret))
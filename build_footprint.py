@@ -0,0 +1,202 @@
+import json
+import os
+import threading
+import time
+
+import build_cache
+import build_conf
+import build_host
+import build_lock
+import build_reaper
+import build_transfer
+
+'''
+Admission of the builds by the space they need: the footprint of the
+build in the build, cache and storage directories is predicted from the
+footprints of the previous builds of the same product and machine and
+compared with the free space of their filesystems before the build starts.
+If the space is short, the trashed workspaces are reaped, then the caches
+([sstate] mirror and DL_DIR) are evicted, and if it is still short, the build
+waits for the space ([preflight] wait) and is refused, instead of failing
+with ENOSPC hours later.
+The footprint of a build is measured as the largest drop of the free space
+of each filesystem while the build runs, so it includes the temporary files
+removed by the end of the build. Other builds using the same filesystem at
+the same time make it bigger, so the prediction errs on the safe side.
+'''
+
+FOOTPRINTS_VERSION = 1
+# footprints of the builds kept, the biggest one is predicted
+FOOTPRINTS_HISTORY = 5
+# margin over the biggest footprint of the previous builds
+FOOTPRINT_MARGIN = 1.2
+MONITOR_INTERVAL = 30
+WAIT_INTERVAL = 60
+
+
+class Footprint(object):
+    def __init__(self, cfg):
+        self.__cfg = cfg
+        self.__path = cfg.get_file_footprints()
+        self.__lock = threading.Lock()
+        self.__monitor = None
+        self.__stop = threading.Event()
+        # device -> largest free space seen, largest drop of it
+        self.__top = {}
+        self.__drop = {}
+        self.__filesystems = self.__get_filesystems()
+
+    def __get_roles(self):
+        return [
+            ('build', self.__cfg.get_dir_build()),
+            ('cache', self.__cfg.get_dir_cache()),
+            ('storage', self.__cfg.get_dir_storage()),
+        ]
+
+    def __get_filesystems(self):
+        # device -> (path, roles), the directories may share a filesystem
+        filesystems = {}
+        for role, path in self.__get_roles():
+            os.makedirs(path, exist_ok=True)
+            dev = os.stat(path).st_dev
+            filesystems.setdefault(dev, (path, []))[1].append(role)
+        return filesystems
+
+    def __load(self):
+        try:
+            with open(self.__path) as f:
+                footprints = json.load(f)
+        except (IOError, OSError, ValueError):
+            return []
+        if footprints.get('version') != FOOTPRINTS_VERSION:
+            return []
+        return footprints.get('builds', [])
+
+    def predict(self):
+        '''
+        Bytes needed by the build per role: build, cache and storage
+        '''
+        builds = self.__load()
+        return dict([(role, int(max([build.get(role, 0) for build in builds] + [0]) *
+                                FOOTPRINT_MARGIN))
+                     for role, path in self.__get_roles()])
+
+    def __get_shortfalls(self, predicted):
+        shortfalls = {}
+        for dev, (path, roles) in self.__filesystems.items():
+            needed = sum([predicted[role] for role in roles])
+            free = build_host.get_disk_free(path)
+            if free < needed:
+                shortfalls[dev] = needed - free
+        return shortfalls
+
+    def __reap(self, dev):
+        # trashed workspaces on the filesystem are removed right away,
+        # along with the reaper running in background if any
+        for path in [self.__cfg.get_dir_build(), self.__cfg.get_dir_yocto_sstate()]:
+            trash = build_conf.WorkspaceConf.get_dir_trash(path)
+            if not os.path.isdir(trash) or os.stat(trash).st_dev != dev:
+                continue
+            for entry in os.listdir(trash):
+                if entry == build_reaper.LOCK_FNAME:
+                    continue
+                print('Reaping ' + os.path.join(trash, entry))
+                build_reaper.Reaper().remove_tree(os.path.join(trash, entry))
+
+    def __evict(self, dev, size):
+        caches = [
+            (self.__cfg.get_dir_yocto_sstate_mirror(), build_cache.sstate_mirror_shrink),
+            (self.__cfg.get_dir_yocto_downloads(), build_cache.downloads_shrink),
+        ]
+        for path, shrink in caches:
+            if size <= 0:
+                return
+            if not os.path.isdir(path) or os.stat(path).st_dev != dev:
+                continue
+            size -= shrink(self.__cfg, size)
+
+    def admit(self, report):
+        '''
+        Make sure the filesystems have the space the build is predicted
+        to need, raise if they don't get it in time
+        '''
+        predicted = self.predict()
+        report.set('footprint_predicted', predicted)
+        if not self.__cfg.get_opt_preflight_check():
+            return
+        print('Predicted footprint: ' +
+              ', '.join(['%s %s' % (role, build_transfer.format_size(size))
+                         for role, size in sorted(predicted.items())]))
+        deadline = time.monotonic() + self.__cfg.get_opt_preflight_wait()
+        shortfalls = self.__get_shortfalls(predicted)
+        if shortfalls:
+            for dev in shortfalls:
+                self.__reap(dev)
+            shortfalls = self.__get_shortfalls(predicted)
+        if shortfalls and self.__cfg.get_opt_preflight_evict():
+            for dev, size in shortfalls.items():
+                self.__evict(dev, size)
+            shortfalls = self.__get_shortfalls(predicted)
+        while shortfalls:
+            short = ', '.join(['%s short on %s' % (build_transfer.format_size(size),
+                                                   self.__filesystems[dev][0])
+                               for dev, size in shortfalls.items()])
+            if time.monotonic() >= deadline:
+                raise Exception('Not enough space for the build: ' + short)
+            print('Waiting for space: ' + short)
+            time.sleep(WAIT_INTERVAL)
+            for dev in shortfalls:
+                self.__reap(dev)
+            shortfalls = self.__get_shortfalls(predicted)
+
+    def __sample(self):
+        with self.__lock:
+            for dev, (path, roles) in self.__filesystems.items():
+                free = build_host.get_disk_free(path)
+                self.__top[dev] = max(self.__top.get(dev, 0), free)
+                self.__drop[dev] = max(self.__drop.get(dev, 0), self.__top[dev] - free)
+
+    def __watch(self):
+        while not self.__stop.wait(MONITOR_INTERVAL):
+            self.__sample()
+
+    def monitor_start(self):
+        self.__sample()
+        self.__stop.clear()
+        self.__monitor = threading.Thread(target=self.__watch, daemon=True)
+        self.__monitor.start()
+
+    def monitor_stop(self):
+        if not self.__monitor:
+            return
+        self.__stop.set()
+        self.__monitor.join()
+        self.__monitor = None
+        self.__sample()
+
+    def record(self, report):
+        '''
+        Save the footprint of the build for the builds to come
+        '''
+        footprint = {}
+        with self.__lock:
+            for dev, (path, roles) in self.__filesystems.items():
+                # the drop of a shared filesystem is counted once
+                for role in roles:
+                    footprint[role] = self.__drop.get(dev, 0) if role == roles[0] else 0
+        report.set('footprint', footprint)
+        print('Footprint: ' + ', '.join(['%s %s' % (role, build_transfer.format_size(size))
+                                         for role, size in sorted(footprint.items())]))
+        os.makedirs(os.path.dirname(self.__path), exist_ok=True)
+        # the builds of the same product and machine may finish at the same time
+        with build_lock.file_lock(self.__path + '.lock'):
+            builds = self.__load() + [footprint]
+            tmp = '%s.tmp-%d' % (self.__path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'version': FOOTPRINTS_VERSION,
+                           'builds': builds[-FOOTPRINTS_HISTORY:]}, f)
+            os.rename(tmp, self.__path)
+
+
+def footprint_open(cfg):
+    return Footprint(cfg)
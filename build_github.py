@@ -0,0 +1,91 @@
+import base64
+import json
+import os
+import urllib.error
+import urllib.request
+
+import build_lock
+
+'''
+Minimal client of the GitHub REST API used to check the pull requests
+applied to the build. Responses are cached on disk with their ETags, so
+the repeated requests are conditional: GitHub answers them with
+"304 Not Modified", which doesn't count against the rate limit.
+The token is optional, but unauthenticated requests are rate-limited
+per IP, which is shared by all the builders behind it.
+'''
+
+TIMEOUT = 30
+USER_AGENT = 'xt-build-scripts'
+
+
+class GithubClient(object):
+    def __init__(self, api_url, git_url, token=None, cache_file=None):
+        self.__api_url = api_url
+        self.__git_url = git_url
+        self.__token = token
+        self.__cache_file = cache_file
+
+    def get_git_url(self, repo):
+        return '%s/%s' % (self.__git_url, repo)
+
+    def get_git_options(self):
+        # credentials are only passed to the command, never saved in .git/config
+        if not self.__token:
+            return []
+        auth = base64.b64encode(('x-access-token:' + self.__token).encode()).decode()
+        return ['-c', 'http.extraHeader=Authorization: Basic ' + auth]
+
+    def __cache_load(self):
+        if not self.__cache_file:
+            return {}
+        try:
+            with open(self.__cache_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def __cache_store(self, url, etag, data):
+        if not self.__cache_file:
+            return
+        # the cache is shared by the builders of the host
+        with build_lock.file_lock(self.__cache_file + '.lock'):
+            cache = self.__cache_load()
+            cache[url] = {'etag': etag, 'data': data}
+            tmp = '%s.tmp-%d' % (self.__cache_file, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, self.__cache_file)
+
+    def get(self, path):
+        '''
+        GET the API path, returns the decoded JSON or None if not found
+        '''
+        url = self.__api_url + path
+        cached = self.__cache_load().get(url)
+        request = urllib.request.Request(url)
+        request.add_header('Accept', 'application/vnd.github+json')
+        request.add_header('User-Agent', USER_AGENT)
+        if self.__token:
+            request.add_header('Authorization', 'token ' + self.__token)
+        if cached and cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                data = json.loads(response.read().decode('utf-8'))
+                self.__cache_store(url, response.headers.get('ETag'), data)
+                return data
+        except urllib.error.HTTPError as err:
+            if err.code == 304 and cached:
+                return cached['data']
+            if err.code == 404:
+                return None
+            raise Exception('GitHub API request %s failed: %d %s' % (url, err.code, err.reason))
+
+    def get_pull(self, repo, number):
+        return self.get('/repos/%s/pulls/%d' % (repo, number))
+
+
+def github_open(cfg):
+    return GithubClient(cfg.get_opt_github_api_url(), cfg.get_opt_github_git_url(),
+                        cfg.get_opt_github_token(), cfg.get_file_github_cache())
@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import build_conf
+import build_lock
+
+'''
+Hash equivalence and PR servers shared by the builds of the host.
+With the hash equivalence server (bitbake-hashserv) the tasks whose outputs
+are identical to those already built are reused from sstate even if their
+input hashes differ, e.g. across workspaces and products. The PR server
+(bitbake-prserv) keeps the package revisions consistent for all of them.
+The servers are started by the first build which needs them, from its
+build environment, and keep running for the next builds; their databases
+are in the storage folder. The state file (pids and addresses) is only
+changed under the lock, so the builds running at the same time start the
+servers once.
+'''
+
+HOST = '127.0.0.1'
+STATE_FNAME = 'servers.json'
+LOCK_FNAME = '.lock'
+# seconds to wait for a server to accept connections
+START_TIMEOUT = 30
+STOP_TIMEOUT = 10
+
+SERVER_HASHSERV = 'hashserv'
+SERVER_PRSERV = 'prserv'
+SERVERS = [SERVER_HASHSERV, SERVER_PRSERV]
+# programs of the servers, to tell them from the processes
+# which got their pids since
+PROGRAMS = {
+    SERVER_HASHSERV: 'bitbake-hashserv',
+    SERVER_PRSERV: 'bitbake-prserv',
+}
+
+# bitbake-prserv --start daemonizes itself and saves its pid here
+PRSERV_PIDFILE = '/tmp/PRServer_%s_%d.pid'
+
+
+def port_is_open(port):
+    try:
+        with socket.create_connection((HOST, port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def pid_is_server(pid, name):
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            argv = f.read().decode(errors='replace').split('\0')
+    except (IOError, OSError):
+        return False
+    # the server is run by the interpreter, e.g. python3 .../bitbake-hashserv
+    return PROGRAMS[name] in [os.path.basename(arg) for arg in argv[:2]]
+
+
+class ServerManager(object):
+    def __init__(self, path, hashserv_port, prserv_port):
+        self.__dir = path
+        self.__ports = {
+            SERVER_HASHSERV: hashserv_port,
+            SERVER_PRSERV: prserv_port,
+        }
+
+    def get_address(self, name):
+        return '%s:%d' % (HOST, self.__ports[name])
+
+    def __get_file(self, fname):
+        return os.path.join(self.__dir, fname)
+
+    def __state_load(self):
+        try:
+            with open(self.__get_file(STATE_FNAME)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def __state_store(self, state):
+        tmp = self.__get_file(STATE_FNAME) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.__get_file(STATE_FNAME))
+
+    def __start_hashserv(self, env):
+        with open(self.__get_file('hashserv.log'), 'a') as log:
+            # own session, so the server outlives the build
+            proc = subprocess.Popen(['bitbake-hashserv',
+                                     '--bind', self.get_address(SERVER_HASHSERV),
+                                     '--database', self.__get_file('hashserv.db'),
+                                     '--log', 'WARNING'],
+                                    cwd=self.__dir, env=env, stdin=subprocess.DEVNULL,
+                                    stdout=log, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        return proc
+
+    def __start_prserv(self, env):
+        port = self.__ports[SERVER_PRSERV]
+        ret = subprocess.call(['bitbake-prserv', '--start',
+                               '--host', HOST, '--port', str(port),
+                               '--file', self.__get_file('prserv.sqlite3'),
+                               '--log', self.__get_file('prserv.log'),
+                               '--loglevel', 'WARNING'],
+                              cwd=self.__dir, env=env, stdin=subprocess.DEVNULL,
+                              start_new_session=True)
+        if ret != 0:
+            raise Exception('Failed to start bitbake-prserv, error code: ' + str(ret))
+
+    def __wait_started(self, name, proc=None):
+        deadline = time.monotonic() + START_TIMEOUT
+        while not port_is_open(self.__ports[name]):
+            if proc and proc.poll() is not None:
+                raise Exception('%s exited on start, see logs in %s' % (name, self.__dir))
+            if time.monotonic() > deadline:
+                raise Exception('%s did not start in %ds, see logs in %s' %
+                                (name, START_TIMEOUT, self.__dir))
+            time.sleep(0.2)
+        if proc:
+            return proc.pid
+        pidfile = PRSERV_PIDFILE % (HOST, self.__ports[name])
+        if not os.path.exists(pidfile):
+            return None
+        try:
+            with open(pidfile) as f:
+                pid = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+        # the file may be left by a server which is gone
+        return pid if pid_is_server(pid, name) else None
+
+    def ensure(self, env):
+        '''
+        Start the servers which are not running yet,
+        returns their addresses
+        '''
+        os.makedirs(self.__dir, exist_ok=True)
+        with build_lock.file_lock(self.__get_file(LOCK_FNAME)):
+            state = self.__state_load()
+            for name in SERVERS:
+                if port_is_open(self.__ports[name]):
+                    print('Using %s at %s' % (name, self.get_address(name)))
+                    continue
+                print('Starting %s at %s' % (name, self.get_address(name)))
+                proc = None
+                if name == SERVER_HASHSERV:
+                    proc = self.__start_hashserv(env)
+                else:
+                    self.__start_prserv(env)
+                state[name] = {
+                    'pid': self.__wait_started(name, proc),
+                    'address': self.get_address(name),
+                    'started': time.time(),
+                }
+                self.__state_store(state)
+        return dict([(name, self.get_address(name)) for name in SERVERS])
+
+    def status(self):
+        state = self.__state_load()
+        res = {}
+        for name in SERVERS:
+            pid = state.get(name, {}).get('pid')
+            res[name] = {
+                'address': self.get_address(name),
+                'pid': pid,
+                'running': port_is_open(self.__ports[name]),
+            }
+        return res
+
+    def stop(self):
+        with build_lock.file_lock(self.__get_file(LOCK_FNAME)):
+            state = self.__state_load()
+            for name in SERVERS:
+                pid = state.get(name, {}).get('pid')
+                if not pid or not pid_is_alive(pid):
+                    continue
+                # the server may be gone and its pid reused since
+                if not pid_is_server(pid, name):
+                    print('Not stopping %s: pid %d is not %s' % (name, pid, PROGRAMS[name]))
+                    continue
+                print('Stopping %s, pid %d' % (name, pid))
+                os.kill(pid, signal.SIGTERM)
+                deadline = time.monotonic() + STOP_TIMEOUT
+                while pid_is_alive(pid) and time.monotonic() < deadline:
+                    time.sleep(0.2)
+                if pid_is_alive(pid) and pid_is_server(pid, name):
+                    os.kill(pid, signal.SIGKILL)
+            self.__state_store({})
+
+
+def hashserv_open(cfg):
+    return ServerManager(cfg.get_dir_hashserv(), cfg.get_opt_hashserv_port(),
+                         cfg.get_opt_prserv_port())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the hash equivalence and PR servers '
+                                                 'shared by the builds')
+    parser.add_argument('--config',
+                        dest='config_file', required=False,
+                        help="Use configuration file for tuning")
+    parser.add_argument('action', choices=['status', 'stop'], help='Action')
+    args = parser.parse_args()
+    try:
+        manager = hashserv_open(build_conf.WorkspaceConf(args.config_file))
+        if args.action == 'status':
+            for name, values in manager.status().items():
+                print('%-10s %-20s pid %-8s %s' % (name, values['address'], values['pid'],
+                                                   'running' if values['running']
+                                                   else 'not running'))
+        else:
+            manager.stop()
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import os
+
+'''
+Host resources: CPUs, memory and disk space available for the builds
+and the build parallelism derived from them
+'''
+
+GiB = 1024 * 1024 * 1024
+
+# memory needed by a single bitbake task or make job, on average
+MEM_PER_THREAD = 2 * GiB
+# disk space needed to build a single domain
+DISK_PER_DOMAIN = 50 * GiB
+
+# bitbake stops starting new tasks if the pressure (PSI, µs of stall
+# per second) exceeds these, see BB_PRESSURE_MAX_*
+PRESSURE_MAX_CPU = 15000
+PRESSURE_MAX_IO = 15000
+PRESSURE_MAX_MEMORY = 1000
+
+
+def get_cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def read_meminfo(key):
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def get_mem_available():
+    return read_meminfo('MemAvailable')
+
+
+def get_mem_total():
+    return read_meminfo('MemTotal')
+
+
+def get_disk_free(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def tune_parallel(cpus, mem, disk_free, domains):
+    '''
+    Compute bitbake parallelism for the build of the given number of domains
+    which are built at the same time: CPUs and memory are split between
+    the domains, so they do not run out of memory together. Most of the
+    bitbake tasks are single threaded, so the number of tasks is the number
+    of slots of a domain and BB_PRESSURE_MAX_* stop bitbake from starting
+    new tasks when the host is busy. Make may use all the slots when a task
+    compiles alone, but it doesn't start new jobs while the load exceeds
+    the slots, so the compile jobs of the tasks running at the same time
+    share the slots instead of multiplying them
+    '''
+    slots = max(1, min(cpus, mem // MEM_PER_THREAD))
+    per_domain = max(1, slots // domains)
+    return {
+        'cpus': cpus,
+        'mem_available': mem,
+        'disk_free': disk_free,
+        'domains': domains,
+        'low_disk': disk_free < domains * DISK_PER_DOMAIN,
+        'BB_NUMBER_THREADS': per_domain,
+        'PARALLEL_MAKE': '-j %d -l %d' % (per_domain, per_domain),
+        'BB_PRESSURE_MAX_CPU': PRESSURE_MAX_CPU,
+        'BB_PRESSURE_MAX_IO': PRESSURE_MAX_IO,
+        'BB_PRESSURE_MAX_MEMORY': PRESSURE_MAX_MEMORY,
+    }
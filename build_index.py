@@ -0,0 +1,309 @@
+import argparse
+import datetime
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+
+import build_conf
+
+'''
+Index of the builds saved in the build history repository:
+type/date/product/machine/time -> manifest, metadata-revs and
+build-versions.inc of the build, with all the revisions found in them.
+It allows finding the build to reconstruct, e.g. the latest build of
+a product/machine made on or before a date or the build which contains
+a revision, without cloning the whole build history repository.
+The index is updated incrementally: by the builds when they commit their
+history and from the build history repository for the commits not indexed
+yet.
+'''
+
+INDEX_VERSION = 1
+HISTORY_REF = 'origin/master'
+
+# type/date/product/machine/time
+BUILD_PATH_DEPTH = 5
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+TIME_RE = re.compile(r'^\d{2}-\d{2}-\d{2}$')
+# git revisions in metadata-revs and build-versions.inc
+REVISION_RE = re.compile(r'\b[0-9a-f]{40}\b')
+
+INDEXED_FILES = [
+    build_conf.BUILD_METADATA_REFS_FNAME,
+    build_conf.BUILD_VERSIONS_FNAME
+]
+
+
+def split_build_path(path):
+    '''
+    Split path of a file in the build history into the build it belongs to
+    and the file path relative to that build, (None, None) if not a build file
+    '''
+    parts = path.split('/')
+    if len(parts) <= BUILD_PATH_DEPTH:
+        return None, None
+    if not DATE_RE.match(parts[1]) or not TIME_RE.match(parts[4]):
+        return None, None
+    return '/'.join(parts[:BUILD_PATH_DEPTH]), '/'.join(parts[BUILD_PATH_DEPTH:])
+
+
+def git_run(repo_dir, args, input=None):
+    proc = subprocess.run(['git', '-C', repo_dir] + args, input=input,
+                          stdout=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise Exception('Failed to run git ' + ' '.join(args) + ', error code: ' +
+                        str(proc.returncode))
+    return proc.stdout
+
+
+def git_read_blobs(repo_dir, objects):
+    '''
+    Read the content of the blobs, e.g. rev:path, with a single git process
+    '''
+    if not objects:
+        return {}
+    out = git_run(repo_dir, ['cat-file', '--batch'],
+                  input=''.join([obj + '\n' for obj in objects]).encode())
+    blobs = {}
+    pos = 0
+    for obj in objects:
+        eol = out.index(b'\n', pos)
+        header = out[pos:eol].split()
+        pos = eol + 1
+        if header[-1] == b'missing':
+            continue
+        size = int(header[2])
+        blobs[obj] = out[pos:pos + size].decode('utf-8', 'replace')
+        pos += size + 1
+    return blobs
+
+
+class HistoryIndex(object):
+    def __init__(self, path):
+        self.__db = sqlite3.connect(path)
+        self.__db.execute('CREATE TABLE IF NOT EXISTS builds ('
+                          'path TEXT PRIMARY KEY, type TEXT, date TEXT, product TEXT, '
+                          'machine TEXT, time TEXT, manifest TEXT)')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS revisions ('
+                          'path TEXT, file TEXT, revision TEXT)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS revisions_revision '
+                          'ON revisions (revision)')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def get_meta(self, key):
+        row = self.__db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.__db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def add_build(self, path, files):
+        '''
+        Index the build at path of the build history, files maps
+        paths relative to the build to their content (None if not read)
+        '''
+        build_type, date, product, machine, time = path.split('/')
+        manifest = None
+        if product + '.xml' in files:
+            manifest = path + '/' + product + '.xml'
+        self.__db.execute('INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (path, build_type, date, product, machine, time, manifest))
+        self.__db.execute('DELETE FROM revisions WHERE path = ?', (path,))
+        for name, content in files.items():
+            if not content:
+                continue
+            for revision in set(REVISION_RE.findall(content)):
+                self.__db.execute('INSERT INTO revisions VALUES (?, ?, ?)',
+                                  (path, name, revision))
+
+    def commit(self):
+        self.__db.commit()
+
+    def close(self):
+        self.__db.commit()
+        self.__db.close()
+
+    def latest(self, product, machine, before=None, build_type=build_conf.TYPE_DAILY):
+        # latest build made on or before the date given
+        query = 'SELECT * FROM builds WHERE product = ? AND machine = ? AND type = ?'
+        params = [product, machine, build_type]
+        if before:
+            query += ' AND date <= ?'
+            params.append(before)
+        query += ' AND manifest IS NOT NULL ORDER BY date DESC, time DESC LIMIT 1'
+        return self.__db.execute(query, params).fetchone()
+
+    def recent(self, product, machine, count, build_type=None):
+        # last builds, of any type if not given
+        query = 'SELECT * FROM builds WHERE product = ? AND machine = ?'
+        params = [product, machine]
+        if build_type:
+            query += ' AND type = ?'
+            params.append(build_type)
+        query += ' ORDER BY date DESC, time DESC LIMIT ?'
+        params.append(count)
+        return self.__db.execute(query, params).fetchall()
+
+    def find_revision(self, revision, product=None, machine=None):
+        # builds containing the revision, revision can be abbreviated
+        query = ('SELECT DISTINCT builds.* FROM builds JOIN revisions '
+                 'ON builds.path = revisions.path WHERE revisions.revision LIKE ?')
+        params = [revision.lower() + '%']
+        if product:
+            query += ' AND builds.product = ?'
+            params.append(product)
+        if machine:
+            query += ' AND builds.machine = ?'
+            params.append(machine)
+        # only the builds which can be reconstructed, like latest()
+        query += ' AND builds.manifest IS NOT NULL ORDER BY builds.date DESC, builds.time DESC'
+        return self.__db.execute(query, params).fetchall()
+
+
+def history_index_open(cfg):
+    return HistoryIndex(cfg.get_file_history_index())
+
+
+def history_index_add(cfg, path, build_dir):
+    '''
+    Index the build just committed from its build history directory
+    '''
+    files = {}
+    for root, dirs, names in os.walk(build_dir):
+        for name in names:
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, build_dir)
+            content = None
+            if name in INDEXED_FILES:
+                with open(full, errors='replace') as f:
+                    content = f.read()
+            files[rel] = content
+    index = history_index_open(cfg)
+    try:
+        index.add_build(path, files)
+    finally:
+        index.close()
+
+
+def history_index_update(cfg, fetch=True):
+    '''
+    Index builds of the build history repository committed after
+    the last update
+    '''
+    repo_dir = cfg.get_dir_xt_history()
+    if not os.path.isdir(os.path.join(repo_dir, '.git')):
+        raise Exception('No build history checkout at ' + repo_dir +
+                        ', set [git] xt_history_persistent to keep it')
+    if fetch:
+        git_run(repo_dir, ['fetch', 'origin'])
+    head = git_run(repo_dir, ['rev-parse', HISTORY_REF]).decode().strip()
+    index = history_index_open(cfg)
+    try:
+        last = index.get_meta('commit')
+        if last == head:
+            print('Build history index is up to date')
+            return
+        if last:
+            paths = git_run(repo_dir, ['diff', '--name-only', '--no-renames',
+                                       '--diff-filter=AM', last, head])
+        else:
+            paths = git_run(repo_dir, ['ls-tree', '-r', '--name-only', head])
+        builds = {}
+        for path in paths.decode('utf-8', 'replace').splitlines():
+            build, rel = split_build_path(path)
+            if build:
+                builds.setdefault(build, {})[rel] = None
+        # only the small files we index are read, so only those
+        # blobs are fetched in the case of partial clone
+        objects = []
+        for build, files in builds.items():
+            for rel in files:
+                if os.path.basename(rel) in INDEXED_FILES:
+                    objects.append('%s:%s/%s' % (head, build, rel))
+        blobs = git_read_blobs(repo_dir, objects)
+        for build, files in builds.items():
+            for rel in files:
+                files[rel] = blobs.get('%s:%s/%s' % (head, build, rel))
+            index.add_build(build, files)
+        index.set_meta('commit', head)
+        print('Indexed %d builds up to %s' % (len(builds), head))
+    finally:
+        index.close()
+
+
+def history_extract_build(cfg, path, dest):
+    '''
+    Make a git repository at dest with only the build at path of the
+    build history, so it can be used as the manifest repository
+    to reconstruct the build without cloning the whole history
+    '''
+    repo_dir = cfg.get_dir_xt_history()
+    build_conf.WorkspaceConf.setup_dir(dest, remove=True, silent=True)
+    print('Extracting %s from build history to %s' % (path, dest))
+    archive = git_run(repo_dir, ['archive', '--format=tar', HISTORY_REF, path])
+    subprocess.run(['tar', '-x', '-C', dest], input=archive, check=True)
+    git_run(dest, ['init', '-q'])
+    git_run(dest, ['add', '.'])
+    git_run(dest, ['-c', 'user.name=build', '-c', 'user.email=build@localhost',
+                   'commit', '-q', '-m', path])
+    git_run(dest, ['branch', '-M', 'master'])
+
+
+def print_builds(rows):
+    for row in rows:
+        print('%s %s %s %s %s %s' % row[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the index of the build history')
+    parser.add_argument('--config',
+                        dest='config_file', required=False,
+                        help="Use configuration file for tuning")
+    parser.add_argument('--product',
+                        dest='product_type', required=False, help='Product type')
+    parser.add_argument('--machine',
+                        dest='machine_type', required=False, help='Machine type')
+    parser.add_argument('--before',
+                        dest='before', required=False,
+                        type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d'),
+                        help='Latest build made on or before the date, YYYY-MM-DD')
+    parser.add_argument('--no-fetch', action='store_false',
+                        dest='fetch', required=False, default=True,
+                        help='Do not fetch build history before update')
+    parser.add_argument('action', choices=['update', 'latest', 'revision'],
+                        help='update - index new builds of the build history, '
+                             'latest - find the latest build of --product and --machine, '
+                             'revision - find the builds containing the revision')
+    parser.add_argument('revision', nargs='?',
+                        help='Revision to find')
+    args = parser.parse_args()
+    try:
+        cfg = build_conf.WorkspaceConf(args.config_file)
+        product = 'prod-' + args.product_type if args.product_type else None
+        if args.action == 'update':
+            history_index_update(cfg, args.fetch)
+            return
+        index = history_index_open(cfg)
+        try:
+            if args.action == 'latest':
+                if not product or not args.machine_type:
+                    raise Exception('Both --product and --machine are required')
+                before = args.before.strftime('%Y-%m-%d') if args.before else None
+                row = index.latest(product, args.machine_type, before)
+                print_builds([row] if row else [])
+            else:
+                if not args.revision:
+                    raise Exception('Revision is required')
+                print_builds(index.find_revision(args.revision, product, args.machine_type))
+        finally:
+            index.close()
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
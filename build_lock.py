@@ -0,0 +1,36 @@
+import contextlib
+import errno
+import fcntl
+import os
+
+'''
+Advisory locks shared by the builders running on the same host
+'''
+
+
+@contextlib.contextmanager
+def file_lock(path, blocking=True):
+    '''
+    Hold an exclusive lock on path while in the context.
+    If not blocking and the lock is held by someone else,
+    the context gets False
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except (IOError, OSError) as err:
+            if err.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
@@ -0,0 +1,231 @@
+import argparse
+import json
+import lzma
+import os
+import stat
+import sys
+import tarfile
+import time
+
+import build_transfer
+
+'''
+Archive of the build logs: instead of copying thousands of small task logs
+one by one, the log directory is streamed into a single tar archive
+compressed with xz. The archive is made of frames: every frame is
+a separate xz stream holding whole tar members, up to FRAME_SIZE of them
+uncompressed. The concatenation of the frames is a valid .tar.xz, so it can
+be unpacked with "tar -xJf" as usual, and the index of the members
+(frame and offset within it) allows extracting a single log by decompressing
+only the frame it is in.
+'''
+
+ARCHIVE_FNAME = 'logs.tar.xz'
+INDEX_FNAME = 'logs.index.json'
+INDEX_VERSION = 1
+
+# uncompressed size of the tar members in a frame, a frame is closed
+# at the first member boundary after this
+FRAME_SIZE = 4 * 1024 * 1024
+# logs compress very well even with the fast presets
+XZ_PRESET = 3
+CHUNK_SIZE = 1024 * 1024
+
+
+class LogArchiveWriter(object):
+    def __init__(self, path):
+        self.__file = open(path, 'wb')
+        self.__frames = []
+        self.__members = []
+        self.__compressor = None
+        # uncompressed bytes in the current frame
+        self.__frame_pos = 0
+        self.__frame_start = 0
+        self.__size = 0
+
+    def __write(self, data):
+        if not self.__compressor:
+            self.__compressor = lzma.LZMACompressor(preset=XZ_PRESET)
+            self.__frame_start = self.__file.tell()
+            self.__frame_pos = 0
+        self.__file.write(self.__compressor.compress(data))
+        self.__frame_pos += len(data)
+        self.__size += len(data)
+
+    def __close_frame(self):
+        if not self.__compressor:
+            return
+        self.__file.write(self.__compressor.flush())
+        self.__frames.append({
+            'offset': self.__frame_start,
+            'length': self.__file.tell() - self.__frame_start,
+            'size': self.__frame_pos,
+        })
+        self.__compressor = None
+
+    def add(self, path, name):
+        st = os.lstat(path)
+        info = tarfile.TarInfo(name)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = int(st.st_mtime)
+        if stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISREG(st.st_mode):
+            info.size = st.st_size
+        else:
+            return
+        self.__write(info.tobuf(format=tarfile.PAX_FORMAT))
+        member = {
+            'name': name,
+            'frame': len(self.__frames),
+            # data of the member follows its header
+            'offset': self.__frame_pos,
+            'size': info.size,
+            'type': info.type.decode(),
+        }
+        if info.isreg():
+            written = 0
+            with open(path, 'rb') as f:
+                # the file may still grow, e.g. the console log
+                while written < info.size:
+                    data = f.read(min(CHUNK_SIZE, info.size - written))
+                    if not data:
+                        break
+                    self.__write(data)
+                    written += len(data)
+            if written < info.size:
+                self.__write(tarfile.NUL * (info.size - written))
+            if info.size % tarfile.BLOCKSIZE:
+                self.__write(tarfile.NUL * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE))
+        self.__members.append(member)
+        if self.__frame_pos >= FRAME_SIZE:
+            self.__close_frame()
+
+    def close(self):
+        # end of archive marker
+        self.__write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        self.__close_frame()
+        compressed = self.__file.tell()
+        self.__file.close()
+        return {
+            'version': INDEX_VERSION,
+            'archive': ARCHIVE_FNAME,
+            'size': self.__size,
+            'compressed': compressed,
+            'frames': self.__frames,
+            'members': self.__members,
+        }
+
+
+def archive_logs(src, dest):
+    '''
+    Archive the log directory src into dest/logs.tar.xz with its
+    index dest/logs.index.json, returns the index
+    '''
+    start = time.monotonic()
+    os.makedirs(dest, exist_ok=True)
+    writer = LogArchiveWriter(os.path.join(dest, ARCHIVE_FNAME))
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        rel = os.path.relpath(root, src)
+        for name in dirs:
+            full = os.path.join(root, name)
+            writer.add(full, os.path.normpath(os.path.join('logs', rel, name)))
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            writer.add(full, os.path.normpath(os.path.join('logs', rel, name)))
+    index = writer.close()
+    index['seconds'] = round(time.monotonic() - start, 3)
+    with open(os.path.join(dest, INDEX_FNAME), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def load_index(path):
+    with open(os.path.join(path, INDEX_FNAME)) as f:
+        return json.load(f)
+
+
+def find_member(index, name):
+    name = os.path.normpath(name)
+    for member in index['members']:
+        if member['name'] == name or member['name'] == os.path.join('logs', name):
+            return member
+    raise Exception('No ' + name + ' in the log archive')
+
+
+def read_member(path, index, member, out):
+    '''
+    Write the content of the member to out, decompressing
+    only the frame it is in
+    '''
+    frame = index['frames'][member['frame']]
+    decompressor = lzma.LZMADecompressor()
+    # offset of the member's data in the uncompressed frame
+    skip = member['offset']
+    left = member['size']
+    with open(os.path.join(path, index['archive']), 'rb') as f:
+        f.seek(frame['offset'])
+        remaining = frame['length']
+        while remaining and left:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            remaining -= len(data)
+            data = decompressor.decompress(data)
+            if skip:
+                drop = min(skip, len(data))
+                data = data[drop:]
+                skip -= drop
+            data = data[:left]
+            out.write(data)
+            left -= len(data)
+    if left:
+        raise Exception('Log archive is truncated')
+
+
+def extract_member(path, name, dest):
+    index = load_index(path)
+    member = find_member(index, name)
+    if member['type'] != tarfile.REGTYPE.decode():
+        raise Exception(name + ' is not a file')
+    with open(dest, 'wb') as out:
+        read_member(path, index, member, out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Access the archive of the build logs')
+    parser.add_argument('path',
+                        help='Directory with ' + ARCHIVE_FNAME + ' and ' + INDEX_FNAME)
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+    subparsers.add_parser('list', help='List the archived logs')
+    extract = subparsers.add_parser('extract', help='Extract a single log')
+    extract.add_argument('name', help='Log to extract, e.g. cooker/salvator-x/console-latest.log')
+    extract.add_argument('-o', '--output',
+                         dest='output', required=False,
+                         help='File to write the log to, standard output if not given')
+    args = parser.parse_args()
+    try:
+        index = load_index(args.path)
+        if args.action == 'list':
+            for member in index['members']:
+                if member['type'] == tarfile.REGTYPE.decode():
+                    print('%10s %s' % (build_transfer.format_size(member['size']),
+                                       member['name']))
+            return
+        if args.output:
+            extract_member(args.path, args.name, args.output)
+        else:
+            read_member(args.path, index, find_member(index, args.name),
+                        sys.stdout.buffer)
+            sys.stdout.flush()
+    except Exception as e:
+        print(e, file=sys.stderr)
+        print("FAILED", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import shutil
+import stat
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import build_store
+import build_transfer
+
+'''
+Manifest of the build artifacts: path, size, mode and SHA-256 of every
+file (and target of every symlink) of a build directory. It is made while
+the artifacts are populated, the files being hashed by the transfer
+workers, and saved as artifacts-manifest.json in the build directory.
+Comparing manifests tells what changed between two builds without reading
+their files, so only the changed files need to be transferred or verified.
+'''
+
+MANIFEST_FNAME = 'artifacts-manifest.json'
+MANIFEST_VERSION = 1
+
+TYPE_FILE = 'file'
+TYPE_LINK = 'link'
+
+
+class Manifest(object):
+    def __init__(self, root, entries=None):
+        self.__root = root
+        # path relative to root -> entry
+        self.__entries = entries or {}
+        self.__lock = threading.Lock()
+
+    def get_entries(self):
+        return self.__entries
+
+    def __rel(self, path):
+        return os.path.relpath(path, self.__root)
+
+    def add(self, path, size, mode, digest=None):
+        if not digest:
+            digest = build_store.hash_file(path)
+        with self.__lock:
+            self.__entries[self.__rel(path)] = {
+                'type': TYPE_FILE,
+                'size': size,
+                'mode': '%o' % stat.S_IMODE(mode),
+                'sha256': digest,
+            }
+
+    def add_link(self, path, target):
+        with self.__lock:
+            self.__entries[self.__rel(path)] = {
+                'type': TYPE_LINK,
+                'target': target,
+            }
+
+    def add_file(self, path):
+        # for the files written other than by the transfer
+        if os.path.islink(path):
+            self.add_link(path, os.readlink(path))
+            return
+        st = os.stat(path)
+        self.add(path, st.st_size, st.st_mode)
+
+    def write(self, path=None):
+        if not path:
+            path = os.path.join(self.__root, MANIFEST_FNAME)
+        tmp = path + build_store.TMP_SUFFIX + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.__entries},
+                      f, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+
+
+def manifest_load(root):
+    with open(os.path.join(root, MANIFEST_FNAME)) as f:
+        data = json.load(f)
+    if data.get('version') != MANIFEST_VERSION:
+        raise Exception('Unsupported manifest version in ' + root)
+    return Manifest(root, data['files'])
+
+
+def manifest_scan(root, jobs=None):
+    '''
+    Make the manifest of an existing directory, hashing files in parallel
+    '''
+    manifest = Manifest(root)
+    if not jobs:
+        jobs = min(build_transfer.DEFAULT_JOBS, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for dirpath, dirs, files in os.walk(root):
+            for name in dirs:
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    manifest.add_link(path, os.readlink(path))
+            for name in files:
+                path = os.path.join(dirpath, name)
+                if os.path.relpath(path, root) == MANIFEST_FNAME:
+                    continue
+                futures.append(pool.submit(manifest.add_file, path))
+        for future in futures:
+            future.result()
+    return manifest
+
+
+def manifest_get(root, jobs=None):
+    # use the saved manifest if any
+    if os.path.exists(os.path.join(root, MANIFEST_FNAME)):
+        return manifest_load(root)
+    return manifest_scan(root, jobs)
+
+
+def manifest_diff(old, new):
+    '''
+    Returns paths added, removed and changed between the manifests
+    '''
+    old_entries = old.get_entries()
+    new_entries = new.get_entries()
+    added = sorted(set(new_entries) - set(old_entries))
+    removed = sorted(set(old_entries) - set(new_entries))
+    changed = sorted([path for path in set(old_entries) & set(new_entries)
+                      if old_entries[path] != new_entries[path]])
+    return added, removed, changed
+
+
+def manifest_verify(root, jobs=None):
+    '''
+    Compare the files of root with its saved manifest, returns
+    the paths missing, unexpected and corrupted
+    '''
+    added, removed, changed = manifest_diff(manifest_load(root), manifest_scan(root, jobs))
+    return removed, added, changed
+
+
+def manifest_sync(src, dst, jobs=None, mode=build_transfer.MODE_AUTO):
+    '''
+    Make dst, e.g. a copy of a previous build, the same as src by
+    transferring only the files which differ
+    '''
+    src_manifest = manifest_get(src, jobs)
+    dst_manifest = manifest_scan(dst, jobs) if os.path.isdir(dst) else Manifest(dst)
+    added, removed, changed = manifest_diff(dst_manifest, src_manifest)
+    for path in removed + changed:
+        full = os.path.join(dst, path)
+        if os.path.isdir(full) and not os.path.islink(full):
+            shutil.rmtree(full)
+        elif os.path.lexists(full):
+            os.remove(full)
+    transfer = build_transfer.Transfer(jobs, mode)
+    entries = src_manifest.get_entries()
+    with ThreadPoolExecutor(max_workers=transfer.get_jobs()) as pool:
+        futures = []
+        for path in added + changed:
+            entry = entries[path]
+            full = os.path.join(dst, path)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            if os.path.isdir(full) and not os.path.islink(full):
+                # a file replaces a directory of the old build
+                shutil.rmtree(full)
+            if entry['type'] == TYPE_LINK:
+                os.symlink(entry['target'], full)
+            else:
+                futures.append(pool.submit(transfer.copy_file, os.path.join(src, path), full))
+        for future in futures:
+            future.result()
+    # files transferred must match the manifest of the source
+    check = manifest_scan_paths(dst, added + changed, jobs).get_entries()
+    corrupted = [path for path in added + changed if check.get(path) != entries[path]]
+    if corrupted:
+        raise Exception('Files differ from the manifest after transfer: ' +
+                        ', '.join(corrupted))
+    Manifest(dst, entries).write()
+    return added, removed, changed
+
+
+def manifest_scan_paths(root, paths, jobs=None):
+    manifest = Manifest(root)
+    if not jobs:
+        jobs = min(build_transfer.DEFAULT_JOBS, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(manifest.add_file, os.path.join(root, path))
+                       for path in paths]:
+            future.result()
+    return manifest
+
+
+def print_diff(added, removed, changed, labels=('Added', 'Removed', 'Changed')):
+    for label, paths in zip(labels, [added, removed, changed]):
+        for path in paths:
+            print('%s\t%s' % (label, path))
+    print('%d %s, %d %s, %d %s' % (len(added), labels[0].lower(),
+                                   len(removed), labels[1].lower(),
+                                   len(changed), labels[2].lower()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare, verify and synchronize build artifacts '
+                                                 'using their manifests')
+    parser.add_argument('--jobs', type=int,
+                        dest='jobs', required=False,
+                        help='Number of files hashed or transferred at a time')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+    generate = subparsers.add_parser('generate', help='Make the manifest of a build directory')
+    generate.add_argument('path', help='Build directory')
+    verify = subparsers.add_parser('verify', help='Verify a build directory against its manifest')
+    verify.add_argument('path', help='Build directory')
+    diff = subparsers.add_parser('diff', help='List the files changed between two builds')
+    diff.add_argument('old', help='Build directory of the old build')
+    diff.add_argument('new', help='Build directory of the new build')
+    sync = subparsers.add_parser('sync', help='Transfer only the files which differ')
+    sync.add_argument('--mode', choices=build_transfer.MODES,
+                      dest='mode', required=False, default=build_transfer.MODE_AUTO,
+                      help='Transfer mode, see [artifacts] transfer_mode')
+    sync.add_argument('src', help='Build directory to copy')
+    sync.add_argument('dst', help='Directory to update, e.g. a copy of a previous build')
+    args = parser.parse_args()
+    try:
+        if args.action == 'generate':
+            manifest = manifest_scan(args.path, args.jobs)
+            manifest.write()
+            print('Saved manifest of %d files to %s' %
+                  (len(manifest.get_entries()), os.path.join(args.path, MANIFEST_FNAME)))
+        elif args.action == 'verify':
+            missing, unexpected, corrupted = manifest_verify(args.path, args.jobs)
+            print_diff(missing, unexpected, corrupted, ('Missing', 'Unexpected', 'Corrupted'))
+            if missing or unexpected or corrupted:
+                print("FAILED")
+                sys.exit(1)
+        elif args.action == 'diff':
+            print_diff(*manifest_diff(manifest_get(args.old, args.jobs),
+                                      manifest_get(args.new, args.jobs)))
+        else:
+            print_diff(*manifest_sync(args.src, args.dst, args.jobs, args.mode))
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
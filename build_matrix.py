@@ -0,0 +1,250 @@
+import argparse
+import configparser
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+import build_conf
+import build_host
+
+'''
+Matrix build: run builds of multiple product/machine pairs on one host.
+The pairs are taken from the [matrix] section of the configuration file.
+Each build runs as a separate build_prod.py process with its own
+workspace and cache directories, while the storage (downloads, sstate
+mirror, artifacts, repo mirror) is shared by all of them.
+Builds are started as long as the host has enough CPUs, memory and disk
+space for one more build besides those reserved for the builds running,
+up to the configured maximum.
+'''
+
+CFG_SECTION_MATRIX = "matrix"
+CFG_OPTION_BUILDS = "builds"
+CFG_OPTION_MAX_JOBS = "max_jobs"
+CFG_OPTION_CPUS_PER_JOB = "cpus_per_job"
+CFG_OPTION_RAM_PER_JOB = "ram_per_job"
+CFG_OPTION_DISK_PER_JOB = "disk_per_job"
+CFG_OPTION_MATRIX_DIR = "dir"
+
+# resources checked between the job starts, seconds
+POLL_INTERVAL = 10
+
+
+def job_config_write(cfg, config, section, job_dir, cache_dir):
+    '''
+    Write the configuration of a build run by the script: every build gets
+    its own workspace, cache and build history checkout, but shares the storage.
+    section is the section of the script which is not passed to the build
+    '''
+    config_job = configparser.ConfigParser(interpolation=None)
+    config_job.read_dict(config)
+    config_job.remove_section(section)
+    if not config_job.has_section(build_conf.CFG_SECTION_PATH):
+        config_job.add_section(build_conf.CFG_SECTION_PATH)
+    config_job.set(build_conf.CFG_SECTION_PATH, build_conf.CFG_OPTION_WORKSPACE_DIR,
+                   os.path.join(job_dir, 'build'))
+    config_job.set(build_conf.CFG_SECTION_PATH, build_conf.CFG_OPTION_CACHE_DIR, cache_dir)
+    config_job.set(build_conf.CFG_SECTION_PATH, build_conf.CFG_OPTION_STORAGE_DIR,
+                   cfg.get_dir_storage())
+    # build history checkouts can't be shared by the builds running together
+    if not config_job.has_section(build_conf.CFG_SECTION_GIT):
+        config_job.add_section(build_conf.CFG_SECTION_GIT)
+    config_job.set(build_conf.CFG_SECTION_GIT, build_conf.CFG_OPTION_XT_HISTORY_DIR,
+                   os.path.join(job_dir, 'build-history'))
+    os.makedirs(job_dir, exist_ok=True)
+    config_file = os.path.join(job_dir, 'build.cfg')
+    with open(config_file, 'w') as f:
+        config_job.write(f)
+    return config_file
+
+
+def job_report_file(log_file):
+    # find the report of the build in its log, see build_report
+    report_file = None
+    with open(log_file, errors='replace') as f:
+        for line in f:
+            if line.startswith('Saving build report to '):
+                report_file = line[len('Saving build report to '):].strip()
+    return report_file
+
+
+class MatrixJob(object):
+    def __init__(self, product, machine):
+        self.product = product
+        self.machine = machine
+        self.name = 'prod-%s-%s' % (product, machine)
+        self.proc = None
+        self.log = None
+        self.log_file = None
+        self.status = 'pending'
+        self.returncode = None
+        self.start = None
+        self.end = None
+        self.report_file = None
+
+    def as_dict(self):
+        report = None
+        if self.report_file and os.path.exists(self.report_file):
+            with open(self.report_file) as f:
+                report = json.load(f)
+        return {
+            'product': self.product,
+            'machine': self.machine,
+            'status': self.status,
+            'returncode': self.returncode,
+            'log': self.log_file,
+            'wall_time': round(self.end - self.start, 3) if self.end else None,
+            'build_report': report,
+        }
+
+
+class Matrix(object):
+    def __init__(self, cfg, config_file, build_args):
+        self.__cfg = cfg
+        # values are passed to the builds as they are
+        self.__config = configparser.ConfigParser(interpolation=None)
+        self.__config.read(config_file)
+        self.__build_args = build_args
+        self.__jobs = []
+        for item in self.__config.get(CFG_SECTION_MATRIX, CFG_OPTION_BUILDS).split(','):
+            item = item.strip()
+            if not item:
+                continue
+            if ':' not in item:
+                raise Exception('Wrong matrix build "' + item + '", use product:machine')
+            product, machine = item.split(':', 1)
+            self.__jobs.append(MatrixJob(product.strip(), machine.strip()))
+        self.__cpus_per_job = self.__config.getint(CFG_SECTION_MATRIX, CFG_OPTION_CPUS_PER_JOB,
+                                                   fallback=8)
+        self.__ram_per_job = self.__config.getint(CFG_SECTION_MATRIX, CFG_OPTION_RAM_PER_JOB,
+                                                  fallback=16) * build_host.GiB
+        self.__disk_per_job = self.__config.getint(CFG_SECTION_MATRIX, CFG_OPTION_DISK_PER_JOB,
+                                                   fallback=100) * build_host.GiB
+        max_jobs = self.__config.get(CFG_SECTION_MATRIX, CFG_OPTION_MAX_JOBS, fallback='auto')
+        if max_jobs == 'auto':
+            self.__max_jobs = max(1, build_host.get_cpu_count() // self.__cpus_per_job)
+        else:
+            self.__max_jobs = int(max_jobs)
+
+    def get_dir_matrix(self):
+        # not in the workspace, which a build run with the same
+        # configuration removes
+        path = self.__config.get(CFG_SECTION_MATRIX, CFG_OPTION_MATRIX_DIR, fallback=None)
+        if path:
+            return build_conf.WorkspaceConf.expand_path(path)
+        return self.__cfg.get_dir_build() + '-matrix'
+
+    def __setup_job(self, job):
+        return job_config_write(self.__cfg, self.__config, CFG_SECTION_MATRIX,
+                                os.path.join(self.get_dir_matrix(), job.name),
+                                os.path.join(self.__cfg.get_dir_cache(), 'matrix', job.name))
+
+    def __can_start(self, running):
+        if running == 0:
+            # always make progress, even if the host is short of resources
+            return True
+        if running >= self.__max_jobs:
+            return False
+        if (running + 1) * self.__cpus_per_job > build_host.get_cpu_count():
+            return False
+        # the builds just started haven't used their memory and disk space
+        # yet, so they are reserved for every build running
+        if (running + 1) * self.__ram_per_job > build_host.get_mem_total():
+            return False
+        if build_host.get_disk_free(self.get_dir_matrix()) < (running + 1) * self.__disk_per_job:
+            return False
+        return True
+
+    def __start(self, job):
+        config_file = self.__setup_job(job)
+        job.log_file = os.path.join(self.get_dir_matrix(), job.name, 'build.log')
+        job.log = open(job.log_file, 'w')
+        argv = [sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build_prod.py'),
+                '--product', job.product, '--machine', job.machine,
+                '--config', config_file] + self.__build_args
+        print('Starting %s: %s' % (job.name, ' '.join(argv)))
+        job.start = time.monotonic()
+        job.status = 'running'
+        job.proc = subprocess.Popen(argv, stdout=job.log, stderr=subprocess.STDOUT)
+
+    def __finish(self, job):
+        job.end = time.monotonic()
+        job.returncode = job.proc.returncode
+        job.status = 'ok' if job.returncode == 0 else 'failed'
+        job.log.close()
+        job.report_file = job_report_file(job.log_file)
+        print('Finished %s: %s in %.1fs' % (job.name, job.status, job.end - job.start))
+
+    def run(self):
+        print('Matrix of %d builds, at most %d at a time' % (len(self.__jobs), self.__max_jobs))
+        started = datetime.datetime.now()
+        start = time.monotonic()
+        os.makedirs(self.get_dir_matrix(), exist_ok=True)
+        pending = list(self.__jobs)
+        running = []
+        while pending or running:
+            for job in list(running):
+                if job.proc.poll() is not None:
+                    running.remove(job)
+                    self.__finish(job)
+            while pending and self.__can_start(len(running)):
+                job = pending.pop(0)
+                self.__start(job)
+                running.append(job)
+            if running:
+                time.sleep(POLL_INTERVAL)
+        return {
+            'started': started.isoformat(),
+            'wall_time': round(time.monotonic() - start, 3),
+            'max_jobs': self.__max_jobs,
+            'status': 'ok' if all(job.status == 'ok' for job in self.__jobs) else 'failed',
+            'builds': [job.as_dict() for job in self.__jobs],
+        }
+
+
+def matrix_report_save(cfg, report):
+    print('Matrix builds:')
+    for build in report['builds']:
+        print('\t%-20s %-20s %-6s %8.1fs %s' % (build['product'], build['machine'],
+                                                build['status'], build['wall_time'] or 0,
+                                                build['log']))
+    dest = os.path.join(cfg.get_dir_storage(), 'matrix-reports')
+    os.makedirs(dest, exist_ok=True)
+    path = os.path.join(dest, datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.json')
+    print('Saving matrix report to ' + path)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run builds of multiple products and machines',
+                                     epilog='Arguments after "--" are passed to every build_prod.py run')
+    parser.add_argument('--config',
+                        dest='config_file', required=True,
+                        help="Configuration file with the [matrix] section")
+    argv = sys.argv[1:]
+    build_args = []
+    if '--' in argv:
+        build_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    try:
+        cfg = build_conf.WorkspaceConf(args.config_file)
+        report = Matrix(cfg, args.config_file, build_args).run()
+        matrix_report_save(cfg, report)
+        if report['status'] != 'ok':
+            print("FAILED")
+            sys.exit(1)
+        print("Done")
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+'''
+Pipeline of the build stages: every stage runs as soon as the stages it
+depends on are done, so the independent ones, e.g. the build history clone
+and repo sync, run at the same time. If a stage fails, the stages not yet
+started are cancelled, the running ones are waited for and the error of
+the failed stage is raised. Every stage is recorded as a phase of the build
+report, and the critical path (the chain of stages which defined the total
+time) is reported with the time each of its stages added to it.
+Stages share the current directory of the process, so they must not
+change it.
+'''
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+
+class Stage(object):
+    def __init__(self, name, func, deps):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.status = STATUS_PENDING
+        self.result = None
+        self.error = None
+        # relative to the start of the pipeline
+        self.start = None
+        self.end = None
+
+
+class Pipeline(object):
+    def __init__(self, report):
+        self.__report = report
+        self.__stages = {}
+        self.__order = []
+        self.__start = None
+        self.__lock = threading.Lock()
+
+    def add(self, name, func, deps=None):
+        '''
+        Add the stage: func is called without arguments once all the deps
+        are done. Dependencies on the stages not added, e.g. optional ones,
+        are satisfied
+        '''
+        if name in self.__stages:
+            raise Exception('Pipeline stage %s is already added' % name)
+        self.__stages[name] = Stage(name, func, deps or [])
+        self.__order.append(name)
+
+    def has_stage(self, name):
+        return name in self.__stages
+
+    def get_result(self, name):
+        # value returned by the stage function, None if it is not added
+        stage = self.__stages.get(name)
+        return stage.result if stage else None
+
+    def __deps(self, stage):
+        return [self.__stages[dep] for dep in stage.deps if dep in self.__stages]
+
+    def __now(self):
+        return time.monotonic() - self.__start
+
+    def __run_stage(self, stage):
+        with self.__lock:
+            stage.start = self.__now()
+        try:
+            with self.__report.phase(stage.name):
+                stage.result = stage.func()
+        finally:
+            with self.__lock:
+                stage.end = self.__now()
+
+    def run(self):
+        for name in self.__order:
+            for dep in self.__stages[name].deps:
+                if dep in self.__stages and self.__order.index(dep) > self.__order.index(name):
+                    raise Exception('Pipeline stage %s depends on %s added after it' % (name, dep))
+        self.__start = time.monotonic()
+        failed = []
+        running = {}
+        with ThreadPoolExecutor(max_workers=len(self.__order) or 1) as pool:
+            while True:
+                if not failed:
+                    for name in self.__order:
+                        stage = self.__stages[name]
+                        if stage.status != STATUS_PENDING:
+                            continue
+                        if all([dep.status == STATUS_OK for dep in self.__deps(stage)]):
+                            stage.status = STATUS_RUNNING
+                            running[pool.submit(self.__run_stage, stage)] = stage
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                        stage.status = STATUS_OK
+                    except BaseException as e:
+                        stage.status = STATUS_FAILED
+                        stage.error = e
+                        failed.append(stage)
+        for name in self.__order:
+            if self.__stages[name].status == STATUS_PENDING:
+                self.__stages[name].status = STATUS_CANCELLED
+        self.__report_stages()
+        if failed:
+            for stage in failed[1:]:
+                print('Stage %s also failed: %s' % (stage.name, stage.error))
+            cancelled = [name for name in self.__order
+                         if self.__stages[name].status == STATUS_CANCELLED]
+            if cancelled:
+                print('Cancelled stages: ' + ' '.join(cancelled))
+            raise failed[0].error
+
+    def critical_path(self):
+        '''
+        Stages which defined the total time, first to last: from the stage
+        finished last, the dependency finished last is followed back
+        '''
+        finished = [stage for stage in self.__stages.values() if stage.end is not None]
+        path = []
+        stage = max(finished, key=lambda s: s.end) if finished else None
+        while stage:
+            path.insert(0, stage)
+            deps = [dep for dep in self.__deps(stage) if dep.end is not None]
+            stage = max(deps, key=lambda s: s.end) if deps else None
+        return path
+
+    def __report_stages(self):
+        path = []
+        previous_end = 0
+        for stage in self.critical_path():
+            path.append({
+                'name': stage.name,
+                'status': stage.status,
+                'start': round(stage.start, 3),
+                'wall_time': round(stage.end - stage.start, 3),
+                # time the stage added to the path since
+                # the dependency before it was done
+                'contribution': round(stage.end - previous_end, 3),
+            })
+            previous_end = stage.end
+        self.__report.set('critical_path', path)
+        self.__report.set('stages', dict([(name, self.__stages[name].status)
+                                          for name in self.__order]))
+        if path:
+            print('Critical path:')
+            for item in path:
+                print('\t%-28s %-9s wall %8.1fs contribution %8.1fs' %
+                      (item['name'], item['status'], item['wall_time'],
+                       item['contribution']))
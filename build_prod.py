@@ -1,11 +1,40 @@
+import contextlib
 import git
+import io
 import os
 import shutil
 import subprocess
-from github import Github
+import sys
+import time
+import build_cache
 import build_conf
+import build_env
+import build_footprint
+import build_github
+import build_hashserv
+import build_host
+import build_index
+import build_logs
+import build_manifest
+import build_pipeline
+import build_lock
+import build_progress
+import build_report
+import build_staging
+import build_stats
+import build_store
+import build_transfer
 import re
 import errno
+import json
+
+# number of attempts to push build history if other builders push concurrently
+GIT_PUSH_RETRIES = 5
+
+# build history of the build being reconstructed is extracted here
+# to be used as the manifest repository
+RECONSTR_MANIFEST_DIR = 'build-history-manifest'
+
 
 def list_directories(path):
     dirnames = [files for files in os.listdir(path) if os.path.isdir(os.path.join(path, files))]
@@ -18,9 +47,11 @@ def list_xml_files(path):
     return [files for files in os.listdir(path) if files.endswith(".xml")]
 
 
-def copy_file(src, dst, fname):
+def copy_file(src, dst, fname, transfer=None):
     src = os.path.join(src, fname)
     dst = os.path.join(dst, fname)
+    if not transfer:
+        transfer = build_transfer.Transfer()
     try:
         os.remove(dst)
     except OSError as err:
@@ -28,32 +59,39 @@ def copy_file(src, dst, fname):
             raise
     try:
         # copy with file stats
-        shutil.copy2(src, dst)
+        return transfer.copy_file(src, dst)
     except IOError as err:
         if err.errno != errno.ENOENT:
             raise
 
 
-def copy_dir(src, dst):
+def copy_dir(src, dst, transfer=None):
+    if not transfer:
+        transfer = build_transfer.Transfer()
     try:
         shutil.rmtree(dst)
     except OSError as err:
         if err.errno != errno.ENOENT:
             raise
     try:
-        shutil.copytree(src, dst, True)
+        return transfer.copy_tree(src, dst)
     except OSError as err:
         if err.errno != errno.ENOENT:
             raise
 
 
-def bash_run_command(cmd):
-    ret = subprocess.call("bash -c '%s'" % cmd, shell=True)
+def bash_run_command(cmd, cwd=None):
+    ret = subprocess.call(['bash', '-c', cmd], cwd=cwd)
     if ret != 0:
         raise Exception('Failed to run "' + cmd + '", error code: ' + str(ret))
 
 # block to work with pull requests
 
+# local refs the pull requests are fetched to
+PULL_REF = 'refs/pull-req/%d'
+PULL_REMOTE = 'pull_req_source'
+
+
 def verify_pulls(existed, proposed, uri):
     print('Verifying of the proposed pulls: {}'.format(proposed))
     for pr in proposed:
@@ -64,32 +102,69 @@ def verify_pulls(existed, proposed, uri):
     return True
 
 
-def get_pulls_for(uri):
-    print('Getting the pulls for {}'.format(uri))
-    g = Github()
-    repo = g.get_repo(uri)
-    pulls = repo.get_pulls(state='open', sort='created', base='master')
+def get_pulls_for(repo, github, proposed):
+    # pull requests of those proposed which exist in the remote
+    refs = ['refs/pull/%d/head' % pr for pr in proposed]
+    out = repo.git.execute(['git'] + github.get_git_options() +
+                           ['ls-remote', PULL_REMOTE] + refs)
     res = []
-    for pr in pulls:
-        res.append(pr.number)
+    for line in out.splitlines():
+        res.append(int(line.split()[1].split('/')[2]))
     return res
 
+
+def fetch_pulls(repo, github, proposed, uri):
+    print('Fetching the pulls {} from {}'.format(proposed, uri))
+    # all the pull requests are fetched at once, the fetch fails
+    # if any of them does not exist
+    refspecs = ['+refs/pull/%d/head:%s' % (pr, PULL_REF % pr) for pr in proposed]
+    try:
+        repo.git.execute(['git'] + github.get_git_options() +
+                         ['fetch', '--no-tags', PULL_REMOTE] + refspecs)
+    except git.exc.GitCommandError:
+        # find out which of them does not exist
+        if verify_pulls(get_pulls_for(repo, github, proposed), proposed, uri):
+            raise
+        return False
+    return True
+
+
+def verify_pulls_state(github, proposed, uri):
+    try:
+        for pr in proposed:
+            pull = github.get_pull(uri, pr)
+            if not pull:
+                print('Pull request {} does not exist in {} repository.'.format(pr, uri))
+                return False
+            print('Pull request {}: {} [{}, base {}]'.format(pr, pull['title'], pull['state'],
+                                                            pull['base']['ref']))
+            if pull['state'] != 'open':
+                print('Pull request {} is not open.'.format(pr))
+                return False
+    except Exception as e:
+        # the pull requests are known to exist as they were fetched,
+        # so the build is not failed if GitHub API is not available
+        print('WARNING: failed to get the pull requests from GitHub: {}'.format(e))
+    return True
+
+
 def handle_pulls_input(inputstr):
     inputstr = ''.join(inputstr.split())
     return list(map(int, inputstr.split(",")))
 
 
-def apply_pulls(proposed):
+def apply_pulls(repo, proposed):
     for pull in proposed:
         print('Applying pull request {}'.format(pull))
-        bash_run_command('git pull pull_req_source pull/%s/head --rebase' % (pull))
+        # same as git pull --rebase, but the pull request is already fetched
+        repo.git.rebase(PULL_REF % pull)
 
 
-def process_pulls(uri, proposed):
+def process_pulls(repo, github, uri, proposed):
     proposed = handle_pulls_input(proposed)
-    existed = get_pulls_for(uri)
-    if verify_pulls(existed, proposed, uri):
-        apply_pulls(proposed)
+    if fetch_pulls(repo, github, proposed, uri) and \
+            verify_pulls_state(github, proposed, uri):
+        apply_pulls(repo, proposed)
         return True
 
     return False
@@ -102,36 +177,132 @@ def git_init(dir, uri):
     git.Repo.clone_from(uri, dir, branch='master')
 
 
+def git_open(dir, uri):
+    try:
+        repo = git.Repo(dir)
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+        return None
+    if repo.remotes.origin.url != uri:
+        return None
+    return repo
+
+
+def git_init_persistent(dir, uri, subtree):
+    repo = git_open(dir, uri)
+    if repo:
+        print('Fetching from ' + uri)
+        repo.remotes.origin.fetch()
+    else:
+        print('Cloning from ' + uri)
+        build_conf.BuildConf.setup_dir(dir, remove=True, silent=True)
+        # blobs are only fetched for the files checked out
+        repo = git.Repo.clone_from(uri, dir, branch='master',
+                                   multi_options=['--filter=blob:none',
+                                                  '--sparse'])
+    # only check out the part of the history we are going to update
+    repo.git.sparse_checkout('set', subtree)
+    repo.heads.master.checkout(force=True)
+    repo.git.reset('--hard', 'origin/master')
+    repo.git.clean('-fdx')
+
+
 def git_commit(cfg, dir):
     repo = git.Repo(dir)
     repo.heads.master.checkout()
     repo.git.add('.')
     repo.git.commit(m=cfg.get_dir_buildhistory_rel())
-    repo.remotes.origin.push()
+    for attempt in range(GIT_PUSH_RETRIES):
+        # other builders may have pushed since we fetched:
+        # there are no conflicts as every build has its own directory
+        repo.remotes.origin.fetch()
+        repo.git.rebase('origin/master')
+        try:
+            repo.git.push('origin', 'master')
+            return
+        except git.exc.GitCommandError as err:
+            print('Failed to push build history, retrying: ' + str(err))
+    raise Exception('Failed to push build history after %d attempts' % GIT_PUSH_RETRIES)
+
+
+def buildhistory_lock(cfg):
+    # the checkout is shared by the builds with the same configuration
+    return build_lock.file_lock(cfg.get_dir_xt_history() + '.lock')
 
 
-def buildhistory_init(cfg):
+def buildhistory_init(cfg, lock):
     if not cfg.get_opt_buildhistory():
         print('Not using build history')
         return
+    # held until the build history is committed, so other builds
+    # don't reset the checkout while it is populated
+    print('Locking build history checkout ' + cfg.get_dir_xt_history())
+    lock.enter_context(buildhistory_lock(cfg))
     print('Initializing build history git repository')
-    git_init(cfg.get_dir_xt_history(), cfg.get_uri_xt_history())
+    if cfg.get_opt_xt_history_persistent():
+        git_init_persistent(cfg.get_dir_xt_history(), cfg.get_uri_xt_history(),
+                            cfg.get_dir_buildhistory_subtree_rel())
+    else:
+        git_init(cfg.get_dir_xt_history(), cfg.get_uri_xt_history())
 
 
-def buildhistory_commit(cfg):
+def buildhistory_commit(cfg, lock):
     if not cfg.get_opt_buildhistory():
         return
     print('Commititng build history')
-    git_commit(cfg, cfg.get_dir_xt_history())
-
-
-def repo_init(uri, branch, xml_base_name):
-    bash_run_command('repo init -u %s -b %s -m %s.xml' %
-                     (uri, branch, xml_base_name))
-
-
-def repo_sync():
-    bash_run_command('repo sync -j8')
+    try:
+        git_commit(cfg, cfg.get_dir_xt_history())
+        build_index.history_index_add(cfg, cfg.get_dir_buildhistory_rel(),
+                                      cfg.get_dir_history_artifacts())
+    finally:
+        lock.close()
+
+
+def repo_init(uri, branch, xml_base_name, reference=None):
+    cmd = 'repo init -u %s -b %s -m %s.xml' % (uri, branch, xml_base_name)
+    if reference:
+        # objects found in the mirror are not fetched again
+        cmd += ' --reference ' + reference
+    bash_run_command(cmd)
+
+
+def repo_sync(jobs, force=False, cwd=None):
+    cmd = 'repo sync -j%d' % jobs
+    if force:
+        # projects of the warm workspace are reset to the manifest revisions,
+        # even if their remotes have changed
+        cmd += ' --force-sync -d'
+    bash_run_command(cmd, cwd)
+
+
+def repo_clean():
+    # drop whatever previous build has left in the projects,
+    # e.g. applied pull requests, so the checkout is clean
+    bash_run_command('repo forall -c "git rebase --abort >/dev/null 2>&1; '
+                     'git reset -q --hard && git clean -q -fdx"')
+
+
+def repo_mirror_update(cfg, uri, branch, xml_base_name):
+    mirror = cfg.get_dir_repo_mirror()
+    # builders of this host update the mirror one at a time
+    # and it is not updated again if it is fresh enough
+    with build_lock.file_lock(os.path.join(mirror, '.lock')):
+        stamp_file = os.path.join(mirror, '.stamps.json')
+        stamps = {}
+        if os.path.exists(stamp_file):
+            with open(stamp_file) as f:
+                stamps = json.load(f)
+        key = ' '.join([uri, branch, xml_base_name])
+        age = time.time() - stamps.get(key, 0)
+        if age < cfg.get_opt_repo_mirror_max_age():
+            print('Repo mirror %s is up to date, updated %ds ago' % (mirror, age))
+            return
+        print('Updating repo mirror ' + mirror)
+        bash_run_command('repo init --mirror -u %s -b %s -m %s.xml' %
+                         (uri, branch, xml_base_name), mirror)
+        repo_sync(cfg.get_opt_repo_sync_jobs(), cwd=mirror)
+        stamps[key] = time.time()
+        with open(stamp_file, 'w') as f:
+            json.dump(stamps, f)
 
 
 def repo_populate_manifest_get_fname(cfg):
@@ -144,33 +315,49 @@ def repo_populate_manifest(cfg):
     # setup build path variables
     history_artifacts_abs_dir = cfg.get_dir_history_artifacts()
     print('Saving current manifest to ' + history_artifacts_abs_dir)
-    if not os.path.exists(history_artifacts_abs_dir):
-        os.makedirs(history_artifacts_abs_dir)
+    # the build history of the images is populated at the same time
+    os.makedirs(history_artifacts_abs_dir, exist_ok=True)
     bash_run_command('repo manifest -r -o ' +
                      os.path.join(history_artifacts_abs_dir,
                                   repo_populate_manifest_get_fname(cfg)))
 
 
-def yocto_run_command(cmd):
-    src = os.path.join('xt-distro', 'oe-init-build-env')
-    if cmd == '':
-        bash_run_command('source ' + src)
-    else:
-        bash_run_command('source ' + src + ' && ' + cmd)
+def yocto_env_init(cfg):
+    # source the build environment once for all the commands to follow
+    env = build_env.BuildEnv(cfg.get_dir_build(),
+                             os.path.join(cfg.get_dir_yocto_log(), build_conf.CONSOLE_LOG_FNAME))
+    env.setup()
+    return env
 
 
-def yocto_add_bblayer(cfg, layer):
-    yocto_run_command('bitbake-layers add-layer ' + os.path.join('..', layer))
+def yocto_run_command(env, argv, on_line=None):
+    env.run(argv, on_line)
 
 
-def build_populate_artifacts(cfg):
-    dest = os.path.join(cfg.get_dir_build_artifacts(),
-                        cfg.get_dir_buildhistory_rel())
+def yocto_add_bblayers(env, layers):
+    # all the layers are added with a single bitbake-layers run,
+    # so layer configuration is only parsed once
+    yocto_run_command(env, ['bitbake-layers', 'add-layer'] +
+                      [os.path.join('..', layer) for layer in layers])
+
+
+def build_populate_artifacts(cfg, stats=None):
+    dest = cfg.get_dir_build_artifacts_dest()
     print('Populating build artifacts to ' + dest)
     cfg.setup_dir(dest, remove=True, silent=True)
+    store = None
+    if cfg.get_opt_artifacts_dedup():
+        store = build_store.ArtifactStore(cfg.get_dir_build_artifacts())
+        print('Using artifact store ' + store.get_dir_objects())
+    # everything populated is recorded in the manifest
+    manifest = build_manifest.Manifest(dest)
+    transfer = build_transfer.Transfer(cfg.get_opt_transfer_jobs(),
+                                       cfg.get_opt_transfer_mode(), store, manifest)
+    print('Using %d transfer jobs, mode: %s' % (transfer.get_jobs(), transfer.get_mode()))
     # touch version file
     os.close(os.open(os.path.join(dest, build_conf.VERSION_FNAME),
                      os.O_CREAT | os.O_TRUNC))
+    manifest.add_file(os.path.join(dest, build_conf.VERSION_FNAME))
     # images and sdk
     base_dir = cfg.get_dir_yocto_deploy()
     print("Populating images and SDK's")
@@ -185,7 +372,9 @@ def build_populate_artifacts(cfg):
                 src = os.path.join(base_dir, image, artifact)
                 dst = os.path.join(dest, image, artifact)
                 print('\t\tPopulating ' + artifact)
-                copy_dir(src, dst)
+                stats = copy_dir(src, dst, transfer)
+                if stats:
+                    print('\t\tPopulated ' + str(stats))
     # buildhistory
     base_dir = cfg.get_dir_yocto_buildhistory()
     print('Populating build history')
@@ -198,30 +387,83 @@ def build_populate_artifacts(cfg):
         # copy to build artifacts
         src = os.path.join(base_dir, image)
         dst = os.path.join(dest, image)
-        copy_file(src, dst, build_conf.BUILD_VERSIONS_FNAME)
-        copy_file(src, dst, build_conf.BUILD_METADATA_REFS_FNAME)
-        xml_list = list_xml_files(src)
-        for xml in xml_list:
-            copy_file(src, dst, xml)
-        # copy to buildhistory git repo
+        copy_file(src, dst, build_conf.BUILD_VERSIONS_FNAME, transfer)
+        copy_file(src, dst, build_conf.BUILD_METADATA_REFS_FNAME, transfer)
+        for xml in list_xml_files(src):
+            copy_file(src, dst, xml, transfer)
+    # logs
+    print('Populating logs')
+    if cfg.get_opt_artifacts_logs() == build_conf.LOGS_ARCHIVE:
+        index = build_logs.archive_logs(cfg.get_dir_yocto_log(), dest)
+        manifest.add_file(os.path.join(dest, build_logs.ARCHIVE_FNAME))
+        manifest.add_file(os.path.join(dest, build_logs.INDEX_FNAME))
+        print('\tArchived %d entries, %s compressed to %s in %.1fs' %
+              (len(index['members']), build_transfer.format_size(index['size']),
+               build_transfer.format_size(index['compressed']), index['seconds']))
+    else:
+        stats = copy_dir(cfg.get_dir_yocto_log(), os.path.join(dest, 'logs'), transfer)
+        if stats:
+            print('\tPopulated ' + str(stats))
+    # manifest of the repo and build stats
+    fname = repo_populate_manifest_get_fname(cfg)
+    print('Populating ' + fname)
+    copy_file(cfg.get_dir_history_artifacts(), dest, fname, transfer)
+    if stats:
+        print('Populating ' + build_stats.STATS_FNAME)
+        build_stats.stats_write(stats, dest)
+        manifest.add_file(os.path.join(dest, build_stats.STATS_FNAME))
+    manifest.write()
+    print('Saved manifest of %d files to %s' %
+          (len(manifest.get_entries()), os.path.join(dest, build_manifest.MANIFEST_FNAME)))
+
+
+def build_populate_history(cfg):
+    # copy the build history of the images to the build history git repo,
+    # this runs while the artifacts are populated
+    base_dir = cfg.get_dir_yocto_buildhistory()
+    print('Populating build history git repo')
+    for image in list_directories(base_dir):
+        src = os.path.join(base_dir, image)
         dst = os.path.join(cfg.get_dir_history_artifacts(), image)
         cfg.setup_dir(dst, remove=True, silent=True)
         copy_file(src, dst, build_conf.BUILD_VERSIONS_FNAME)
         copy_file(src, dst, build_conf.BUILD_METADATA_REFS_FNAME)
-        for xml in xml_list:
+        for xml in list_xml_files(src):
             copy_file(src, dst, xml)
-    # logs
-    print('Populating logs')
-    copy_dir(cfg.get_dir_yocto_log(), os.path.join(dest, 'logs'))
-    # manifest
-    print('Populating ' + repo_populate_manifest_get_fname(cfg))
-    copy_file(cfg.get_dir_history_artifacts(), dest,
-              repo_populate_manifest_get_fname(cfg))
 
 
-def generate_local_conf(cfg, reconstruct_dir):
+def get_guests_build(cfg):
+    for item in cfg.get_opt_local_conf():
+        if item[0].upper() == 'XT_GUESTS_BUILD' and item[1]:
+            return cfg.expand_path(item[1]).strip('"').split()
+    return []
+
+
+def generate_local_conf_parallel(cfg, f, report):
+    # all the domains are built at the same time
+    domains = 1 + len(get_guests_build(cfg))
+    values = build_host.tune_parallel(build_host.get_cpu_count(),
+                                      build_host.get_mem_available(),
+                                      build_host.get_disk_free(cfg.get_dir_build()),
+                                      domains)
+    print('Tuned for %d CPUs, %s of memory, %d domains: BB_NUMBER_THREADS %d, PARALLEL_MAKE %s' %
+          (values['cpus'], build_transfer.format_size(values['mem_available']),
+           domains, values['BB_NUMBER_THREADS'], values['PARALLEL_MAKE']))
+    if values['low_disk']:
+        print('WARNING: only %s of disk space is available for the build' %
+              build_transfer.format_size(values['disk_free']))
+    for var in ['BB_NUMBER_THREADS', 'PARALLEL_MAKE', 'BB_PRESSURE_MAX_CPU',
+                'BB_PRESSURE_MAX_IO', 'BB_PRESSURE_MAX_MEMORY']:
+        f.write('%s = "%s"\n' % (var, values[var]))
+    if report:
+        report.set('parallel_tuning', values)
+
+
+def generate_local_conf(cfg, reconstruct_dir, report=None, servers=None):
         print('Generating local.conf')
-        f = open(os.path.join('build', 'conf', 'local.conf'), "w+t")
+        # local.conf is only rewritten if changed, so bitbake
+        # of the warm workspace doesn't reparse everything
+        f = io.StringIO()
         # find the prod local conf
         local_conf = cfg.get_dir_build() + '//meta-xt-{}//doc//local.conf.{}'.format(cfg.get_opt_product_type(), cfg.get_opt_product_type())
 
@@ -233,18 +475,38 @@ def generate_local_conf(cfg, reconstruct_dir):
         f.write('MACHINE = "' + cfg.get_opt_machine_type() + '"\n')
         if not cfg.get_opt_parallel_build():
             f.write('BB_NUMBER_THREADS = "1"\n')
+        elif cfg.get_opt_parallel_build_auto():
+            generate_local_conf_parallel(cfg, f, report)
         f.write('DL_DIR = "' + cfg.get_dir_yocto_downloads() + '"\n')
+        if cfg.get_opt_downloads_manage():
+            # sources are fetched from the downloads mirror first and
+            # git clones are also saved as tarballs to populate it
+            f.write('BB_GENERATE_MIRROR_TARBALLS = "1"\n')
+            f.write('INHERIT += "own-mirrors"\n')
+            f.write('SOURCE_MIRROR_URL = "file://' + cfg.get_dir_yocto_downloads_mirror() + '/"\n')
         f.write('DEPLOY_DIR = "' + cfg.get_dir_yocto_deploy() + '"\n')
+        # the warm workspace keeps DEPLOY_DIR, the images of the previous
+        # builds must not be populated as the artifacts of this one; it is
+        # set for every build, so local.conf stays the same for the warm ones
+        f.write('RM_OLD_IMAGE = "1"\n')
         f.write('BUILDHISTORY_DIR = "' + cfg.get_dir_yocto_buildhistory() + '"\n')
         f.write('BUILDHISTORY_COMMIT = "1"\n')
         f.write('SSTATE_DIR = "' + cfg.get_dir_yocto_sstate() + '"\n')
         f.write('XT_SSTATE_CACHE_MIRROR_DIR = "' + cfg.get_dir_yocto_sstate_mirror() + '"\n')
-        if cfg.get_opt_populate_cache():
+        if servers:
+            # equivalent tasks of other workspaces and products are reused
+            f.write('BB_HASHSERVE = "' + servers[build_hashserv.SERVER_HASHSERV] + '"\n')
+            f.write('BB_SIGNATURE_HANDLER = "OEEquivHash"\n')
+            f.write('PRSERV_HOST = "' + servers[build_hashserv.SERVER_PRSERV] + '"\n')
+        if cfg.get_opt_populate_cache() and not cfg.get_opt_sstate_manage_mirror():
             f.write('XT_POPULATE_SSTATE_CACHE = "1"\n')
         f.write('XT_SHARED_ROOTFS_DIR = "' + cfg.get_dir_yocto_shared_rootfs() + '"\n')
         if cfg.get_opt_populate_sdk():
             f.write('XT_POPULATE_SDK = "1"\n')
         f.write('LOG_DIR = "' + cfg.get_dir_yocto_log() + '"\n')
+        # buildstats are analyzed after the build and archived with the logs
+        f.write('BUILDSTATS_BASE = "' + os.path.join(cfg.get_dir_yocto_log(),
+                                                     build_stats.BUILDSTATS_DIR) + '"\n')
         f.write('XT_PRODUCT_NAME = "' + cfg.get_opt_product_type() +'"\n')
         if reconstruct_dir:
             f.write('XT_RECONSTRUCT_DIR = "' + reconstruct_dir + '"\n')
@@ -258,74 +520,266 @@ def generate_local_conf(cfg, reconstruct_dir):
                             cfg.expand_path(item[1]) + '\n')
                 else:
                     f.write(item[0].upper() + ' = ""\n')
-        f.close()
+        conf_file = os.path.join('build', 'conf', 'local.conf')
+        if os.path.exists(conf_file):
+            with open(conf_file) as conf:
+                if conf.read() == f.getvalue():
+                    print('local.conf is up to date')
+                    return
+        with open(conf_file, 'w') as conf:
+            conf.write(f.getvalue())
+
+
+def yocto_has_bblayer(bblayers_conf, path):
+    for layer_dir in set([os.path.abspath(path), os.path.realpath(path)]):
+        if re.search(re.escape(layer_dir) + r'(?=[\s"\\]|$)', bblayers_conf):
+            return True
+    return False
 
 
-def add_meta_layers(cfg):
-    bblayers_list = list_directories(cfg.get_dir_build())
-    for bblayer in bblayers_list:
-        if bblayer.startswith('meta-'):
-            yocto_add_bblayer(cfg, bblayer)
+def add_meta_layers(cfg, env):
+    bblayers_list = sorted([bblayer for bblayer in list_directories(cfg.get_dir_build())
+                            if bblayer.startswith('meta-')])
+    # layers of the warm workspace are already there
+    bblayers_conf = ''
+    bblayers_file = os.path.join(cfg.get_dir_yocto_build(), 'conf', 'bblayers.conf')
+    if os.path.exists(bblayers_file):
+        with open(bblayers_file) as f:
+            bblayers_conf = f.read()
+    bblayers_list = [bblayer for bblayer in bblayers_list
+                     if not yocto_has_bblayer(bblayers_conf,
+                                              os.path.join(cfg.get_dir_build(), bblayer))]
+    if not bblayers_list:
+        print('All meta layers are already added')
+        return
+    print('Adding meta layers: ' + ' '.join(bblayers_list))
+    start = time.monotonic()
+    yocto_add_bblayers(env, bblayers_list)
+    print('Added %d meta layers in %.1fs' % (len(bblayers_list), time.monotonic() - start))
 
 
-def build_init(uri, branch, xml_base_name, proposed):
+def build_init(uri, branch, xml_base_name, proposed=None, jobs=8,
+               reference=None, github=None, warm=False):
     if not branch:
         branch = 'master'
 
-    repo_init(uri, branch, xml_base_name)
-    repo_sync()
+    repo_init(uri, branch, xml_base_name, reference)
+    if warm:
+        repo_clean()
+    repo_sync(jobs, force=warm)
     if proposed:
         print('Applying pull requests: %s ...' % proposed)
-        c_dir = os.getcwd()
-        # go into prod layer directory to get the repo instance
-        # and create the remote.
-        # (It is required to apply the pull request).
-        os.chdir('meta-xt-{}'.format(xml_base_name))
+        # the prod layer repo is opened by its path, the current directory
+        # is shared with the stages running at the same time
+        layer_dir = os.path.join(os.getcwd(), 'meta-xt-{}'.format(xml_base_name))
         # Get url of prod-layer to find the pull requests
         # The name of repository is known but organization - not
         # The organization can be extracted from the url of layer 'meta-xt-products'
         # Assumption:the layers  products and prod belong
         # to the same organization
         url = "xen-troops/meta-xt-" + xml_base_name
-        repo = git.Repo('./')
-        repo.create_remote('pull_req_source', url='git://github.com/{}'.format(url))
+        repo = git.Repo(layer_dir)
+        if PULL_REMOTE in [remote.name for remote in repo.remotes]:
+            repo.delete_remote(PULL_REMOTE)
+        repo.create_remote(PULL_REMOTE, url=github.get_git_url(url))
         # checkout the required branch
-        repo.git.checkout('HEAD', b='{}'.format(branch))
-        process_pulls(url, proposed)
-        # rollback the current directory
-        os.chdir(c_dir)
-    # create build dir and make initial setup
-    yocto_run_command('')
+        repo.git.checkout('HEAD', B='{}'.format(branch))
+        if not process_pulls(repo, github, url, proposed):
+            raise Exception('Failed to apply pull requests: %s' % proposed)
+
+
+def build_report_init(cfg):
+    report = build_report.BuildReport()
+    report.set('build_type', cfg.get_opt_build_type())
+    report.set('product', cfg.get_opt_product_type())
+    report.set('machine', cfg.get_opt_machine_type())
+    report.set('buildhistory_rel', cfg.get_dir_buildhistory_rel())
+    return report
+
+
+def build_report_save(cfg, report):
+    report.print_summary()
+    # the report goes next to the version file, so there is
+    # nothing to save if the artifacts were not populated
+    dest = cfg.get_dir_build_artifacts_dest()
+    if os.path.isdir(dest):
+        report.write(os.path.join(dest, build_conf.REPORT_FNAME))
+        # the report is saved after the manifest of the artifacts,
+        # which must still cover it
+        if os.path.exists(os.path.join(dest, build_manifest.MANIFEST_FNAME)):
+            manifest = build_manifest.manifest_load(dest)
+            manifest.add_file(os.path.join(dest, build_conf.REPORT_FNAME))
+            manifest.write()
 
 
 def build_run(cfg):
-    buildhistory_init(cfg)
+    report = build_report_init(cfg)
+    try:
+        build_run_phases(cfg, report)
+    finally:
+        build_report_save(cfg, report)
+
+
+def build_run_phases(cfg, report):
     bb_target = build_conf.YOCTO_DEFAULT_TARGET
     if cfg.get_opt_generate_update():
         bb_target = build_conf.YOCTO_UPDATE_TARGET
-    
-    # repo init + sync
+    # commands are run in the workspace, stages must not change it
     os.chdir(cfg.get_dir_build())
+    # the build is refused before anything expensive if it doesn't fit
+    footprint = build_footprint.footprint_open(cfg)
+    with report.phase('preflight'):
+        footprint.admit(report)
+    # independent stages run at the same time,
+    # e.g. the build history is cloned during repo sync
+    pipeline = build_pipeline.Pipeline(report)
+    # the build history checkout is locked from its init to its commit,
+    # which are different stages
+    history_lock = contextlib.ExitStack()
+    pipeline.add('buildhistory_init', lambda: buildhistory_init(cfg, history_lock))
+    staging = build_staging.staging_open(cfg)
+    pipeline.add('staging_setup', staging.setup)
+    # repo init + sync
+    if not (cfg.get_opt_continue_build() or cfg.get_opt_generate_update()):
+        reference = None
+        if cfg.get_opt_repo_mirror():
+            pipeline.add('repo_mirror_update',
+                         lambda: repo_mirror_update(cfg, cfg.get_uri_xt_manifest(),
+                                                    cfg.get_opt_repo_branch(),
+                                                    cfg.get_opt_product_type()))
+            reference = cfg.get_dir_repo_mirror()
+        pipeline.add('repo_sync',
+                     lambda: build_init(cfg.get_uri_xt_manifest(),
+                                        cfg.get_opt_repo_branch(),
+                                        cfg.get_opt_product_type(),
+                                        cfg.get_prod_pulls(),
+                                        cfg.get_opt_repo_sync_jobs(),
+                                        reference,
+                                        build_github.github_open(cfg),
+                                        cfg.get_opt_warm_workspace()),
+                     ['repo_mirror_update'])
+    # create build dir and make initial setup
+    pipeline.add('yocto_env_init', lambda: build_env_init(cfg), ['repo_sync', 'staging_setup'])
     if not (cfg.get_opt_continue_build() or cfg.get_opt_generate_update()):
-        build_init(cfg.get_uri_xt_manifest(),
-                cfg.get_opt_repo_branch(),
-                cfg.get_opt_product_type(),
-                cfg.get_prod_pulls())
         if cfg.get_opt_generate_local_conf():
-            generate_local_conf(cfg, "")
+            if cfg.get_opt_hashserv_manage():
+                pipeline.add('hashserv_start',
+                             lambda: hashserv_start(cfg, pipeline.get_result('yocto_env_init')),
+                             ['yocto_env_init'])
+            pipeline.add('generate_local_conf',
+                         lambda: generate_local_conf(cfg, "", report,
+                                                     pipeline.get_result('hashserv_start')),
+                         ['yocto_env_init', 'hashserv_start'])
         # add meta layers
-        add_meta_layers(cfg)
+        pipeline.add('add_meta_layers',
+                     lambda: add_meta_layers(cfg, pipeline.get_result('yocto_env_init')),
+                     ['yocto_env_init', 'generate_local_conf'])
+
+    if cfg.get_opt_do_build() or cfg.get_opt_continue_build() or cfg.get_opt_generate_update():
+        # ready for the build
+        pipeline.add('bitbake',
+                     lambda: build_bitbake(cfg, pipeline.get_result('yocto_env_init'),
+                                           bb_target, staging),
+                     ['yocto_env_init', 'add_meta_layers'])
+        # staged deploy is moved to the disk before the artifacts are populated
+        pipeline.add('staging_flush',
+                     lambda: staging_flush(staging, pipeline.get_result('bitbake'), report),
+                     ['bitbake'])
+        # caches are synchronized while the artifacts are populated
+        if cfg.get_opt_populate_cache() and cfg.get_opt_sstate_manage_mirror():
+            pipeline.add('sstate_mirror_sync',
+                         lambda: build_cache.sstate_mirror_maintain(
+                             cfg, [build_cache.ACTION_SSTATE_SYNC,
+                                   build_cache.ACTION_SSTATE_EVICT]),
+                         ['bitbake'])
+        if cfg.get_opt_downloads_manage():
+            pipeline.add('downloads_sync',
+                         lambda: build_cache.downloads_maintain(
+                             cfg, [build_cache.ACTION_DOWNLOADS_SYNC,
+                                   build_cache.ACTION_DOWNLOADS_EVICT]),
+                         ['bitbake'])
+        # the build history git repo is populated while the artifacts are
+        # populated, but only committed after them: the rebase of the commit
+        # takes away the files the artifacts copy from it
+        pipeline.add('repo_populate_manifest', lambda: repo_populate_manifest(cfg),
+                     ['bitbake', 'buildhistory_init'])
+        pipeline.add('buildhistory_populate', lambda: build_populate_history(cfg),
+                     ['bitbake', 'buildhistory_init'])
+        pipeline.add('build_stats', lambda: build_stats_save(cfg, report),
+                     ['bitbake', 'buildhistory_init'])
+        pipeline.add('build_populate_artifacts',
+                     lambda: build_populate_artifacts(cfg, pipeline.get_result('build_stats')),
+                     ['repo_populate_manifest', 'build_stats', 'staging_flush'])
+        # the tmpfs is freed for the other builds
+        pipeline.add('staging_cleanup', staging.cleanup,
+                     ['build_populate_artifacts', 'buildhistory_populate', 'build_stats'])
+        pipeline.add('buildhistory_commit', lambda: buildhistory_commit(cfg, history_lock),
+                     ['repo_populate_manifest', 'buildhistory_populate', 'build_stats',
+                      'build_populate_artifacts'])
+    footprint.monitor_start()
+    try:
+        pipeline.run()
+    finally:
+        footprint.monitor_stop()
+        # e.g. the build failed before the commit
+        history_lock.close()
+    footprint.record(report)
 
-    if not (cfg.get_opt_do_build() or cfg.get_opt_continue_build() or cfg.get_opt_generate_update()):
-        return
 
-    print('Building bitbake target: ' + bb_target)
+def build_env_init(cfg):
+    if cfg.get_opt_warm_workspace():
+        # TMPDIR is kept, but not the logs of the previous build
+        cfg.setup_dir(cfg.get_dir_yocto_log(), remove=True, silent=True)
+    return yocto_env_init(cfg)
 
-    # ready for the build
-    yocto_run_command('bitbake ' + bb_target)
-    repo_populate_manifest(cfg)
-    build_populate_artifacts(cfg)
-    buildhistory_commit(cfg)
+
+def hashserv_start(cfg, env):
+    # the build still works without the servers, only
+    # the equivalent tasks are not reused
+    try:
+        return build_hashserv.hashserv_open(cfg).ensure(env.get_env())
+    except Exception as e:
+        print('WARNING: failed to start hash equivalence and PR servers: {}'.format(e))
+        return None
+
+
+def build_stats_save(cfg, report):
+    # saved to the build history if it is kept,
+    # the artifacts are populated with the stats returned
+    print('Analyzing buildstats')
+    stats = build_stats.stats_collect(cfg.get_dir_yocto_log())
+    build_stats.print_stats(stats)
+    report.set('sstate', dict([(key, stats['sstate'][key])
+                               for key in ['hits', 'misses', 'hit_ratio']]))
+    if cfg.get_opt_buildhistory():
+        os.makedirs(cfg.get_dir_history_artifacts(), exist_ok=True)
+        build_stats.stats_write(stats, cfg.get_dir_history_artifacts())
+    return stats
+
+
+def staging_flush(staging, bitbake_time, report):
+    staging.flush()
+    staging.finish(bitbake_time, report)
+
+
+def build_bitbake(cfg, env, bb_target, staging=None):
+    print('Building bitbake target: ' + bb_target)
+    # task events are followed as they come
+    progress = build_progress.progress_open(cfg)
+    print('Saving progress events to ' + cfg.get_file_progress_events())
+    progress.start()
+    if staging:
+        staging.monitor_start()
+    start = time.monotonic()
+    ok = False
+    try:
+        yocto_run_command(env, ['bitbake', bb_target], progress.on_line)
+        ok = True
+    finally:
+        progress.finish(ok)
+        if staging:
+            staging.monitor_stop()
+    return time.monotonic() - start
 
 
 def build_print_target(build_type, cfg):
@@ -340,39 +794,113 @@ def build_daily(cfg):
 
 def build_push(cfg):
     build_print_target(build_conf.TYPE_PUSH, cfg)
+    build_run(cfg)
 
 
 def build_req(cfg):
     build_print_target(build_conf.TYPE_REQ, cfg)
+    build_run(cfg)
+
+
+def reconstr_lookup(cfg):
+    if not cfg.get_opt_xt_history_persistent():
+        raise Exception('Looking up the build to reconstruct needs [git] xt_history_persistent')
+    product = cfg.get_opt_product_type()
+    machine = cfg.get_opt_machine_type()
+    index = build_index.history_index_open(cfg)
+    try:
+        if cfg.get_opt_reconstr_revision():
+            print('Looking up the build of %s %s with revision %s' %
+                  (product, machine, cfg.get_opt_reconstr_revision()))
+            rows = index.find_revision(cfg.get_opt_reconstr_revision(), product, machine)
+            row = rows[0] if rows else None
+        else:
+            print('Looking up the latest build of %s %s made on or before %s' %
+                  (product, machine, cfg.get_opt_reconstr_before() or 'today'))
+            row = index.latest(product, machine, cfg.get_opt_reconstr_before())
+    finally:
+        index.close()
+    if not row:
+        raise Exception('No build found in the build history index, '
+                        'run "build_index.py update" to update it')
+    print('Found build ' + row[0])
+    cfg.set_reconstr_build(row[1], row[2], row[5])
 
 
 def build_reconstr(cfg):
     build_print_target(build_conf.TYPE_RECONSTR, cfg)
+    report = build_report_init(cfg)
+    try:
+        build_reconstr_phases(cfg, report)
+    finally:
+        build_report_save(cfg, report)
+
+
+def build_reconstr_phases(cfg, report):
     bb_target = build_conf.YOCTO_DEFAULT_TARGET
     os.chdir(cfg.get_dir_build())
+    # predicted from the footprints of the daily, push and request builds
+    with report.phase('preflight'):
+        build_footprint.footprint_open(cfg).admit(report)
 
+    if cfg.get_opt_reconstr_lookup():
+        with report.phase('history_lookup'):
+            reconstr_lookup(cfg)
     # construct path to the build history artifacts in the build history repo
-    db_path = os.path.join('dailybuild', cfg.get_opt_reconstr_date(),
+    db_path = os.path.join(cfg.get_opt_reconstr_type(), cfg.get_opt_reconstr_date(),
                                  cfg.get_opt_product_type(),
                                  cfg.get_opt_machine_type(),
                                  cfg.get_opt_reconstr_time())
     manifest_file = os.path.join(db_path, cfg.get_opt_product_type())
     if not cfg.get_opt_continue_build():
-        build_init(cfg.get_uri_xt_history(), cfg.get_opt_repo_branch(),
-                manifest_file)
+        manifest_uri = cfg.get_uri_xt_history()
+        manifest_branch = cfg.get_opt_repo_branch()
+        if cfg.get_opt_xt_history_persistent():
+            # only fetch the build we need instead of the whole history
+            with report.phase('history_extract'), buildhistory_lock(cfg):
+                git_init_persistent(cfg.get_dir_xt_history(), cfg.get_uri_xt_history(),
+                                    db_path)
+                manifest_uri = os.path.join(cfg.get_dir_build(), RECONSTR_MANIFEST_DIR)
+                manifest_branch = 'master'
+                build_index.history_extract_build(cfg, db_path, manifest_uri)
+        # the mirror is not updated with the manifest of the past build,
+        # but whatever it already has is still used
+        reference = None
+        if cfg.get_opt_repo_mirror() and os.path.isdir(cfg.get_dir_repo_mirror()):
+            reference = cfg.get_dir_repo_mirror()
+        with report.phase('repo_sync'):
+            build_init(manifest_uri, manifest_branch,
+                    manifest_file, jobs=cfg.get_opt_repo_sync_jobs(),
+                    reference=reference)
+    staging = build_staging.staging_open(cfg)
+    with report.phase('staging_setup'):
+        staging.setup()
+    # create build dir and make initial setup
+    with report.phase('yocto_env_init'):
+        env = yocto_env_init(cfg)
+    if not cfg.get_opt_continue_build():
         # point the upper Yocto to the folder which contains build history
         # artifacts
         history_path = os.path.join(cfg.get_dir_build(),'.repo', 'manifests',
                 db_path)
-        generate_local_conf(cfg, history_path)
+        with report.phase('generate_local_conf'):
+            generate_local_conf(cfg, history_path, report)
         # add meta layers
-        add_meta_layers(cfg)
+        with report.phase('add_meta_layers'):
+            add_meta_layers(cfg, env)
 
     if not (cfg.get_opt_do_build() or cfg.get_opt_continue_build()):
         return
     # ready for the build
-    yocto_run_command('bitbake ' + bb_target)
-    build_populate_artifacts(cfg)
+    with report.phase('bitbake'):
+        bitbake_time = build_bitbake(cfg, env, bb_target, staging)
+    with report.phase('staging_flush'):
+        staging_flush(staging, bitbake_time, report)
+    with report.phase('build_populate_artifacts'):
+        build_populate_history(cfg)
+        build_populate_artifacts(cfg)
+    with report.phase('staging_cleanup'):
+        staging.cleanup()
 
 
 def main():
@@ -389,6 +917,7 @@ def main():
     except Exception as e:
         print (e)
         print ("FAILED")
+        sys.exit(1)
 
 
 if __name__ == '__main__':
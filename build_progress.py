@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import build_lock
+
+'''
+Progress of bitbake: its output is parsed line by line as it comes and
+the task events are appended to a file as JSON lines, one event per line,
+so a dashboard can follow the build by reading what was appended since it
+last looked instead of the console log:
+- {"event": "started", ...}
+- {"event": "task_started", "recipe": ..., "task": ..., "num": N, "total": M,
+"setscene": false, "eta": seconds left or null, ...}
+- {"event": "task_succeeded" or "task_failed", ..., "duration": seconds}
+- {"event": "finished", "status": "ok" or "failed", ...}
+Every event has "time" (seconds since the epoch) and "elapsed" (seconds
+since bitbake started). The time left is estimated from the durations of
+the tasks in the previous builds of the same product and machine: the
+expected time of the tasks running and of the tasks not started yet,
+divided by the number of tasks run at a time.
+'''
+
+TIMINGS_VERSION = 1
+# weight of the last build in the task durations remembered
+TIMINGS_WEIGHT = 0.5
+# the number of tasks run at a time is only measured after this
+PARALLELISM_MIN_ELAPSED = 60
+
+RUNNING_TASK_RE = re.compile(r'Running (setscene )?task (\d+) of (\d+) \((.+):(do_\w+)\)')
+TASK_EVENT_RE = re.compile(r'recipe (\S+): task (do_\w+): (Started|Succeeded|Failed)')
+
+
+def recipe_name(recipe):
+    # PN of PN-PV-PR, so the timings survive version updates
+    parts = recipe.rsplit('-', 2)
+    return parts[0] if len(parts) == 3 else recipe
+
+
+class ProgressTracker(object):
+    def __init__(self, events_file, timings_file=None):
+        self.__events_file = events_file
+        self.__timings_file = timings_file
+        self.__lock = threading.Lock()
+        self.__start = time.time()
+        self.__events = None
+        # (recipe, task) -> start time
+        self.__running = {}
+        # task key -> durations measured in this build
+        self.__durations = {}
+        self.__busy = 0.0
+        self.__num = 0
+        self.__total = 0
+        self.__setscene = False
+        self.__history = self.__timings_load()
+
+    def __timings_load(self):
+        if not self.__timings_file:
+            return {}
+        try:
+            with open(self.__timings_file) as f:
+                timings = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if timings.get('version') != TIMINGS_VERSION:
+            return {}
+        return timings
+
+    def __timings_save(self):
+        if not self.__timings_file or not self.__durations:
+            return
+        os.makedirs(os.path.dirname(self.__timings_file), exist_ok=True)
+        # the builds of the same product and machine may finish at the same time
+        with build_lock.file_lock(self.__timings_file + '.lock'):
+            timings = self.__timings_load()
+            tasks = timings.get('tasks', {})
+            for key, duration in self.__durations.items():
+                if key in tasks:
+                    duration = TIMINGS_WEIGHT * duration + (1 - TIMINGS_WEIGHT) * tasks[key]
+                tasks[key] = round(duration, 2)
+            elapsed = time.time() - self.__start
+            timings = {
+                'version': TIMINGS_VERSION,
+                'tasks': tasks,
+                'parallelism': round(self.__busy / elapsed, 2) if elapsed else 1,
+            }
+            tmp = '%s.tmp-%d' % (self.__timings_file, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(timings, f, separators=(',', ':'), sort_keys=True)
+            os.rename(tmp, self.__timings_file)
+
+    def __emit(self, event, **values):
+        now = time.time()
+        values['event'] = event
+        values['time'] = round(now, 3)
+        values['elapsed'] = round(now - self.__start, 1)
+        if self.__events is None:
+            os.makedirs(os.path.dirname(self.__events_file), exist_ok=True)
+            self.__events = open(self.__events_file, 'a')
+        self.__events.write(json.dumps(values, sort_keys=True) + '\n')
+        # the reader may look at any moment
+        self.__events.flush()
+
+    def __expected(self, key):
+        return self.__history.get('tasks', {}).get(key)
+
+    def get_eta(self):
+        '''
+        Seconds left, None until it can be estimated
+        '''
+        tasks = self.__history.get('tasks')
+        if self.__setscene or not self.__total or not tasks:
+            return None
+        now = time.time()
+        elapsed = now - self.__start
+        average = sum(tasks.values()) / len(tasks)
+        left = (self.__total - self.__num) * average
+        for (recipe, task), start in self.__running.items():
+            expected = self.__expected(recipe_name(recipe) + ':' + task)
+            left += max((expected if expected is not None else average) - (now - start), 0)
+        parallelism = self.__history.get('parallelism') or 1
+        if elapsed >= PARALLELISM_MIN_ELAPSED:
+            busy = self.__busy + sum([now - start for start in self.__running.values()])
+            parallelism = busy / elapsed
+        return round(left / max(parallelism, 1))
+
+    def start(self):
+        with self.__lock:
+            self.__emit('started')
+
+    def on_line(self, line):
+        match = RUNNING_TASK_RE.search(line)
+        if match:
+            with self.__lock:
+                self.__setscene = bool(match.group(1))
+                self.__num = int(match.group(2))
+                self.__total = int(match.group(3))
+            return
+        match = TASK_EVENT_RE.search(line)
+        if not match:
+            return
+        recipe, task, state = match.groups()
+        with self.__lock:
+            now = time.time()
+            if state == 'Started':
+                self.__running[(recipe, task)] = now
+                self.__emit('task_started', recipe=recipe, task=task, num=self.__num,
+                            total=self.__total, setscene=self.__setscene,
+                            running=len(self.__running), eta=self.get_eta())
+                return
+            start = self.__running.pop((recipe, task), None)
+            duration = now - start if start is not None else None
+            if duration is not None:
+                self.__busy += duration
+                if state == 'Succeeded':
+                    self.__durations[recipe_name(recipe) + ':' + task] = duration
+            self.__emit('task_succeeded' if state == 'Succeeded' else 'task_failed',
+                        recipe=recipe, task=task,
+                        duration=round(duration, 1) if duration is not None else None,
+                        num=self.__num, total=self.__total, eta=self.get_eta())
+
+    def finish(self, ok):
+        with self.__lock:
+            self.__emit('finished', status='ok' if ok else 'failed',
+                        tasks=len(self.__durations))
+            self.__events.close()
+            self.__events = None
+            if ok:
+                self.__timings_save()
+
+
+def progress_open(cfg):
+    return ProgressTracker(cfg.get_file_progress_events(), cfg.get_file_progress_timings())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Follow the progress events of a build')
+    parser.add_argument('path', help='File of the progress events')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        dest='follow', required=False, default=False,
+                        help='Wait for the new events, like tail -f')
+    args = parser.parse_args()
+    try:
+        with open(args.path) as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    if not args.follow:
+                        break
+                    time.sleep(1)
+                    continue
+                event = json.loads(line)
+                if event['event'] in ['task_started', 'task_succeeded', 'task_failed']:
+                    eta = event.get('eta')
+                    print('%8.0fs %5d of %-5d %-15s %s:%s%s' %
+                          (event['elapsed'], event['num'], event['total'],
+                           event['event'][len('task_'):], event['recipe'], event['task'],
+                           ', %dm left' % (eta // 60) if eta is not None else ''))
+                else:
+                    print('%8.0fs %s %s' % (event['elapsed'], event['event'],
+                                            event.get('status', '')))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import errno
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+
+import build_lock
+
+'''
+Background removal of the workspace directories.
+Instead of removing the directory of the previous build before the new
+build can start, the directory is renamed into the trash directory on the
+same filesystem, which is instant, and removed by the reaper afterwards.
+The reaper runs with the lowest CPU and I/O priority, limits the rate of
+removal and pauses while the storage is under I/O pressure, so it doesn't
+compete with the build for the disk bandwidth.
+Only one reaper works on a trash directory at a time: it keeps going
+until the trash is empty, so directories trashed meanwhile are also removed.
+'''
+
+LOCK_FNAME = '.lock'
+# files removed between the checks of the rate and I/O pressure
+BATCH_SIZE = 100
+# reaper pauses if tasks were stalled on I/O for more than this %
+# of the last 10 seconds, see /proc/pressure/io
+IO_PRESSURE_MAX = 10.0
+IO_PRESSURE_PAUSE = 1.0
+
+
+def get_io_pressure():
+    try:
+        with open('/proc/pressure/io') as f:
+            for line in f:
+                if line.startswith('some'):
+                    for field in line.split():
+                        if field.startswith('avg10='):
+                            return float(field[len('avg10='):])
+    except (IOError, OSError, ValueError):
+        pass
+    return 0.0
+
+
+class Reaper(object):
+    def __init__(self, rate=0):
+        # files per second, 0 for unlimited
+        self.__rate = rate
+        self.__count = 0
+        self.__start = time.monotonic()
+
+    def __throttle(self):
+        self.__count += 1
+        if self.__count % BATCH_SIZE:
+            return
+        while get_io_pressure() > IO_PRESSURE_MAX:
+            time.sleep(IO_PRESSURE_PAUSE)
+        if self.__rate:
+            ahead = self.__count / self.__rate - (time.monotonic() - self.__start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    @staticmethod
+    def __remove(func, path):
+        try:
+            func(path)
+        except PermissionError:
+            # read-only directories are common in the build trees
+            parent = os.path.dirname(path)
+            os.chmod(parent, os.stat(parent).st_mode | stat.S_IRWXU)
+            func(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def remove_tree(self, path):
+        if os.path.islink(path) or not os.path.isdir(path):
+            Reaper.__remove(os.remove, path)
+            return
+        os.chmod(path, os.stat(path).st_mode | stat.S_IRWXU)
+        for root, dirs, files in os.walk(path, topdown=False,
+                                         onerror=lambda err: None):
+            for name in files:
+                Reaper.__remove(os.remove, os.path.join(root, name))
+                self.__throttle()
+            for name in dirs:
+                full = os.path.join(root, name)
+                if os.path.islink(full):
+                    Reaper.__remove(os.remove, full)
+                else:
+                    Reaper.__remove(os.rmdir, full)
+                self.__throttle()
+        Reaper.__remove(os.rmdir, path)
+
+    def reap(self, trash):
+        with build_lock.file_lock(os.path.join(trash, LOCK_FNAME), blocking=False) as locked:
+            if not locked:
+                # somebody else is already reaping
+                return
+            while True:
+                entries = [e for e in os.listdir(trash) if e != LOCK_FNAME]
+                if not entries:
+                    return
+                for entry in entries:
+                    self.remove_tree(os.path.join(trash, entry))
+
+
+def reaper_start(trash, rate=0):
+    '''
+    Start the reaper in background, it outlives the build script
+    '''
+    argv = [sys.executable, os.path.abspath(__file__), '--rate', str(rate), trash]
+    if shutil.which('ionice'):
+        # idle I/O class: only gets disk time when nobody else needs it
+        argv = ['ionice', '-c', '3'] + argv
+    subprocess.Popen(argv, start_new_session=True, close_fds=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove trashed workspace directories')
+    parser.add_argument('--rate', type=int, default=0,
+                        dest='rate', required=False,
+                        help='Files removed per second, 0 for unlimited')
+    parser.add_argument('trash', help='Trash directory to empty')
+    args = parser.parse_args()
+    os.nice(19)
+    Reaper(args.rate).reap(args.trash)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import contextlib
+import datetime
+import json
+import os
+import resource
+import socket
+import threading
+import time
+
+import build_transfer
+
+'''
+Build report: timings and resource usage of the build phases.
+For every phase the following is recorded:
+- wall time
+- CPU time (user + system) of the build script and of its child processes
+- peak RSS of the child processes, e.g. the biggest of the children
+waited for so far, as reported by getrusage(RUSAGE_CHILDREN)
+- bytes read from and written to the storage by the build script and
+its waited for children, as reported by /proc/self/io
+CPU time, RSS and bytes are sampled for the whole process, so for the
+phases run at the same time as other phases, e.g. by the pipeline, they
+can't be told apart: such phases are marked as overlapped and only their
+wall time is recorded.
+The report is saved as JSON into the build artifacts.
+'''
+
+REPORT_VERSION = 2
+
+
+def read_proc_io():
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                io[key.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return io
+
+
+class Sample(object):
+    def __init__(self):
+        self.wall = time.monotonic()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = read_proc_io()
+
+    @staticmethod
+    def cpu(usage):
+        return usage.ru_utime + usage.ru_stime
+
+
+class BuildReport(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__phases = []
+        # phases running -> whether another phase ran at the same time
+        self.__running = {}
+        self.__values = {}
+        self.__started = datetime.datetime.now()
+        self.__start = time.monotonic()
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__values[key] = value
+
+    def get(self, key, default=None):
+        with self.__lock:
+            return self.__values.get(key, default)
+
+    def get_phases(self):
+        with self.__lock:
+            return list(self.__phases)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        print('Phase %s started' % name)
+        key = object()
+        with self.__lock:
+            for other in self.__running:
+                self.__running[other] = True
+            self.__running[key] = bool(self.__running)
+        begin = Sample()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            end = Sample()
+            with self.__lock:
+                overlapped = self.__running.pop(key)
+            phase = {
+                'name': name,
+                'status': status,
+                'start': round(begin.wall - self.__start, 3),
+                'wall_time': round(end.wall - begin.wall, 3),
+                'overlapped': overlapped,
+                'cpu_time': None,
+                'children_cpu_time': None,
+                'children_max_rss': None,
+                'read_bytes': None,
+                'write_bytes': None,
+            }
+            if not overlapped:
+                phase.update({
+                    'cpu_time': round(Sample.cpu(end.self_usage) -
+                                      Sample.cpu(begin.self_usage), 3),
+                    'children_cpu_time': round(Sample.cpu(end.children_usage) -
+                                               Sample.cpu(begin.children_usage), 3),
+                    # KiB, see getrusage(2)
+                    'children_max_rss': end.children_usage.ru_maxrss,
+                    'read_bytes': end.io.get('read_bytes', 0) - begin.io.get('read_bytes', 0),
+                    'write_bytes': end.io.get('write_bytes', 0) - begin.io.get('write_bytes', 0),
+                })
+            with self.__lock:
+                self.__phases.append(phase)
+            print('Phase %s %s in %.1fs' % (name, status, phase['wall_time']))
+
+    def as_dict(self):
+        with self.__lock:
+            return {
+                'version': REPORT_VERSION,
+                'host': socket.gethostname(),
+                'cpus': os.cpu_count(),
+                'started': self.__started.isoformat(),
+                'wall_time': round(time.monotonic() - self.__start, 3),
+                'values': dict(self.__values),
+                'phases': list(self.__phases),
+            }
+
+    def print_summary(self):
+        print('Build phases:')
+        for phase in self.get_phases():
+            if phase['overlapped']:
+                print('\t%-28s %-6s wall %8.1fs overlapped' %
+                      (phase['name'], phase['status'], phase['wall_time']))
+                continue
+            print('\t%-28s %-6s wall %8.1fs cpu %8.1fs children cpu %8.1fs '
+                  'read %s written %s' % (phase['name'], phase['status'],
+                                          phase['wall_time'], phase['cpu_time'],
+                                          phase['children_cpu_time'],
+                                          build_transfer.format_size(phase['read_bytes']),
+                                          build_transfer.format_size(phase['write_bytes'])))
+
+    def write(self, path):
+        print('Saving build report to ' + path)
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import threading
+import time
+
+import build_conf
+import build_host
+import build_transfer
+
+'''
+Staging of the I/O heavy parts of the build on tmpfs: TMPDIR (tmp),
+shared_rootfs and deploy of the Yocto build dir are made symlinks to
+directories of a tmpfs ([staging] dir, e.g. /dev/shm), so rootfs assembly
+and packaging happen in memory. The paths seen by the build and by
+the build script stay the same.
+Before the build the free space of the tmpfs and the available memory are
+checked against the space needed (the peak of the previous builds of the same
+product and machine), and the build falls back to the disk if they are not
+enough. During the build memory and the size of the area are watched: TMPDIR
+can not be moved while bitbake runs, so if the memory runs low, the next build
+of the product and machine falls back to the disk.
+Staged deploy is moved to the disk before the artifacts are populated and
+the area is removed once they are, unless the workspace is warm.
+Bitbake time of the builds on tmpfs and on disk is recorded, so the speedup
+is reported.
+'''
+
+MODE_TMPFS = 'tmpfs'
+MODE_DISK = 'disk'
+
+STATS_VERSION = 1
+# bitbake times kept per mode
+STATS_HISTORY = 5
+# margin over the peak use of the previous builds
+SIZE_MARGIN = 1.2
+MONITOR_INTERVAL = 10
+# the size of the area is measured by walking it, the walks take
+# at most this part of the time of the build
+MONITOR_WALK_SHARE = 0.1
+
+
+def get_tree_size(path):
+    '''
+    Space taken by the files of path, the hard links counted once
+    '''
+    size = 0
+    seen = set()
+    dirs = [path]
+    while dirs:
+        try:
+            entries = list(os.scandir(dirs.pop()))
+        except OSError:
+            # removed by the build meanwhile
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            if st.st_nlink > 1 and not entry.is_dir(follow_symlinks=False):
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            size += st.st_blocks * 512
+    return size
+
+
+class Staging(object):
+    def __init__(self, cfg):
+        self.__cfg = cfg
+        self.__mode = MODE_DISK
+        self.__subtrees = []
+        self.__flushed = False
+        self.__reason = None
+        self.__needed = 0
+        self.__peak = 0
+        self.__pressure = False
+        self.__monitor = None
+        self.__stop = threading.Event()
+        self.__stats = self.__stats_load()
+
+    def get_mode(self):
+        return self.__mode
+
+    def get_dir(self):
+        # every workspace has its own area on the tmpfs
+        digest = hashlib.sha1(self.__cfg.get_dir_build().encode()).hexdigest()[:12]
+        return os.path.join(self.__cfg.get_dir_staging(), 'workspace-' + digest)
+
+    def __stats_load(self):
+        try:
+            with open(self.__cfg.get_file_staging_stats()) as f:
+                stats = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if stats.get('version') != STATS_VERSION:
+            return {}
+        return stats
+
+    def __stats_store(self):
+        path = self.__cfg.get_file_staging_stats()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__stats['version'] = STATS_VERSION
+        tmp = '%s.tmp-%d' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.__stats, f)
+        os.rename(tmp, path)
+
+    def __check(self):
+        # reason not to stage, None if it fits
+        if not self.__cfg.get_dir_staging():
+            return 'staging is not configured'
+        if self.__stats.get('pressure'):
+            # staging is tried again by the build after
+            self.__stats['pressure'] = False
+            self.__stats_store()
+            return 'memory ran low during the previous build'
+        os.makedirs(self.__cfg.get_dir_staging(), exist_ok=True)
+        free = build_host.get_disk_free(self.__cfg.get_dir_staging())
+        # the area of the warm workspace is reused, so what it has
+        # already takes is available to the build
+        if os.path.isdir(self.get_dir()):
+            free += get_tree_size(self.get_dir())
+        mem = build_host.get_mem_available()
+        if free < self.__needed:
+            return 'only %s free on %s, %s needed' % (build_transfer.format_size(free),
+                                                      self.__cfg.get_dir_staging(),
+                                                      build_transfer.format_size(self.__needed))
+        if mem - self.__needed < self.__cfg.get_opt_staging_mem_reserve():
+            return 'only %s of memory available, %s needed and %s reserved' % \
+                   (build_transfer.format_size(mem), build_transfer.format_size(self.__needed),
+                    build_transfer.format_size(self.__cfg.get_opt_staging_mem_reserve()))
+        return None
+
+    def setup(self):
+        '''
+        Make the subtrees symlinks to the tmpfs, or the usual directories
+        if they don't fit
+        '''
+        self.__needed = max(self.__cfg.get_opt_staging_size(),
+                            int(self.__stats.get('peak', 0) * SIZE_MARGIN))
+        area = self.get_dir() if self.__cfg.get_dir_staging() else None
+        if area and not (self.__cfg.get_opt_warm_workspace() or
+                         self.__cfg.get_opt_continue_build()):
+            # left by the previous build of the workspace, its symlinks
+            # are gone with the build dir, so it doesn't count against the space
+            shutil.rmtree(area, ignore_errors=True)
+        self.__reason = self.__check()
+        yocto_build = self.__cfg.get_dir_yocto_build()
+        if self.__reason:
+            print('Not staging on tmpfs: ' + self.__reason)
+            for subtree in build_conf.STAGING_SUBTREES:
+                path = os.path.join(yocto_build, subtree)
+                # staged by the previous build of the warm workspace
+                if os.path.islink(path):
+                    target = os.readlink(path)
+                    os.remove(path)
+                    shutil.rmtree(target, ignore_errors=True)
+            if area:
+                shutil.rmtree(area, ignore_errors=True)
+            return
+        for subtree in self.__cfg.get_opt_staging_subtrees():
+            path = os.path.join(yocto_build, subtree)
+            target = os.path.join(area, subtree)
+            if os.path.islink(path):
+                if os.readlink(path) == target:
+                    # the tmpfs may have been emptied, e.g. by a reboot
+                    os.makedirs(target, exist_ok=True)
+                    self.__subtrees.append(subtree)
+                    continue
+                os.remove(path)
+            elif os.path.isdir(path):
+                print('%s is on disk already, not staging it' % path)
+                continue
+            os.makedirs(target, exist_ok=True)
+            os.makedirs(yocto_build, exist_ok=True)
+            os.symlink(target, path)
+            self.__subtrees.append(subtree)
+        if self.__subtrees:
+            self.__mode = MODE_TMPFS
+            print('Staging %s on %s, %s needed' % (' '.join(self.__subtrees), area,
+                                                   build_transfer.format_size(self.__needed)))
+
+    def __watch(self):
+        reserve = self.__cfg.get_opt_staging_mem_reserve()
+        # only the area of the workspace, not those of other workspaces
+        # sharing the tmpfs
+        next_walk = 0
+        while True:
+            if time.monotonic() >= next_walk:
+                start = time.monotonic()
+                self.__peak = max(self.__peak, get_tree_size(self.get_dir()))
+                walk = time.monotonic() - start
+                next_walk = time.monotonic() + walk / MONITOR_WALK_SHARE
+            if not self.__pressure and build_host.get_mem_available() < reserve // 2:
+                print('WARNING: memory is running low with %s staged on tmpfs, '
+                      'the next build will use the disk' %
+                      build_transfer.format_size(self.__peak))
+                self.__pressure = True
+            if self.__stop.wait(MONITOR_INTERVAL):
+                break
+
+    def monitor_start(self):
+        if self.__mode != MODE_TMPFS:
+            return
+        self.__stop.clear()
+        self.__monitor = threading.Thread(target=self.__watch, daemon=True)
+        self.__monitor.start()
+
+    def monitor_stop(self):
+        if not self.__monitor:
+            return
+        self.__stop.set()
+        self.__monitor.join()
+        self.__monitor = None
+
+    def flush(self):
+        '''
+        Move the staged deploy to the disk, so the artifacts
+        are populated from and kept on the persistent storage
+        '''
+        if 'deploy' not in self.__subtrees or self.__flushed:
+            return
+        path = self.__cfg.get_dir_yocto_deploy()
+        target = os.readlink(path)
+        print('Flushing %s to disk' % target)
+        start = time.monotonic()
+        tmp = path + '.flush'
+        shutil.rmtree(tmp, ignore_errors=True)
+        shutil.copytree(target, tmp, symlinks=True)
+        os.remove(path)
+        os.rename(tmp, path)
+        shutil.rmtree(target)
+        self.__flushed = True
+        print('Flushed deploy in %.1fs' % (time.monotonic() - start))
+
+    def cleanup(self):
+        '''
+        Free the tmpfs once the artifacts are populated,
+        the warm workspace keeps its area for the next build
+        '''
+        if self.__mode != MODE_TMPFS or self.__cfg.get_opt_warm_workspace():
+            return
+        print('Removing staging area ' + self.get_dir())
+        for subtree in self.__subtrees:
+            path = os.path.join(self.__cfg.get_dir_yocto_build(), subtree)
+            if os.path.islink(path):
+                os.remove(path)
+        shutil.rmtree(self.get_dir(), ignore_errors=True)
+
+    def finish(self, bitbake_time, report):
+        '''
+        Record bitbake time and the peak use of the tmpfs,
+        report the speedup of the builds on tmpfs
+        '''
+        times = self.__stats.setdefault('bitbake', {})
+        history = times.setdefault(self.__mode, [])
+        speedup = None
+        if self.__mode == MODE_TMPFS:
+            self.__stats['peak'] = self.__peak
+            if self.__pressure:
+                self.__stats['pressure'] = True
+            if times.get(MODE_DISK) and bitbake_time:
+                speedup = round(statistics.median(times[MODE_DISK]) / bitbake_time, 2)
+        history.append(round(bitbake_time, 1))
+        del history[:-STATS_HISTORY]
+        self.__stats_store()
+        values = {
+            'mode': self.__mode,
+            'reason': self.__reason,
+            'subtrees': self.__subtrees,
+            'needed': self.__needed,
+            'peak': self.__peak,
+            'pressure': self.__pressure,
+            'bitbake_time': round(bitbake_time, 1),
+            'speedup': speedup,
+        }
+        report.set('staging', values)
+        if speedup:
+            print('Bitbake on tmpfs took %.0fs, %.2f times faster than on disk '
+                  '(median of the last builds)' % (bitbake_time, speedup))
+
+
+def staging_open(cfg):
+    return Staging(cfg)
@@ -0,0 +1,341 @@
+import argparse
+import bisect
+import json
+import os
+import re
+import sys
+
+import build_conf
+import build_index
+
+'''
+Analysis of the build made by bitbake: buildstats (one file per task run,
+with its start and end time and CPU usage) and the "Sstate summary" lines
+of the console log. The result is saved as compact JSON next to the build
+manifest in the build history and in the build artifacts:
+- sstate hits (setscene tasks run) and misses (tasks which have sstate
+but were run for real) in total and per recipe
+- the most expensive tasks by wall and CPU time
+- the critical path of the tasks, estimated from their timeline as
+buildstats don't have the dependencies: from the task finished last, the
+task finished last before it started is followed back, preferring the
+tasks of the same recipe
+The trend command compares the last builds of a product and machine.
+'''
+
+STATS_FNAME = 'build-stats.json'
+STATS_VERSION = 1
+BUILDSTATS_DIR = 'buildstats'
+
+# number of tasks kept in the lists of the most expensive ones
+TOP_TASKS = 20
+SETSCENE_SUFFIX = '_setscene'
+# tasks which are restored from sstate if their output is there
+SSTATE_TASKS = [
+    'do_populate_sysroot',
+    'do_populate_lic',
+    'do_package',
+    'do_packagedata',
+    'do_package_qa',
+    'do_package_write_ipk',
+    'do_package_write_deb',
+    'do_package_write_rpm',
+    'do_package_write_tar',
+    'do_deploy',
+    'do_deploy_source_date_epoch',
+    'do_shared_workdir',
+    'do_create_spdx',
+    'do_create_runtime_spdx',
+    'do_image_complete',
+    'do_populate_sdk',
+    'do_populate_sdk_ext',
+]
+
+SSTATE_SUMMARY_RE = re.compile(r'Sstate summary: Wanted (\d+) (?:Local|Found) (\d+)'
+                               r'(?: Mirrors (\d+))? Missed (\d+) Current (\d+)')
+
+
+def find_buildstats(path):
+    # every build of the domains may have its own buildstats
+    res = []
+    for root, dirs, files in os.walk(path):
+        if BUILDSTATS_DIR in dirs:
+            res.append(os.path.join(root, BUILDSTATS_DIR))
+            dirs.remove(BUILDSTATS_DIR)
+    return res
+
+
+def read_task(path):
+    values = {}
+    with open(path, errors='replace') as f:
+        for line in f:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                values[key.strip()] = value.strip()
+    try:
+        start = float(values['Started'])
+        end = float(values['Ended'])
+    except (KeyError, ValueError):
+        # the task didn't finish
+        return None
+    cpu = 0.0
+    if 'rusage ru_utime' in values:
+        for key in ['rusage ru_utime', 'rusage ru_stime',
+                    'Child rusage ru_utime', 'Child rusage ru_stime']:
+            cpu += float(values.get(key, 0))
+    else:
+        # clock ticks of /proc/<pid>/stat
+        for key in ['utime', 'stime', 'cutime', 'cstime']:
+            cpu += float(values.get(key, 0))
+        cpu /= os.sysconf('SC_CLK_TCK')
+    return {
+        'start': start,
+        'end': end,
+        'cpu': cpu,
+        'failed': values.get('Status') == 'FAILED',
+    }
+
+
+def read_buildstats(path):
+    '''
+    Tasks of buildstats/<build name>/<recipe>/<task>
+    '''
+    tasks = []
+    for build in sorted(os.listdir(path)):
+        build_dir = os.path.join(path, build)
+        if not os.path.isdir(build_dir):
+            continue
+        for recipe in sorted(os.listdir(build_dir)):
+            recipe_dir = os.path.join(build_dir, recipe)
+            if not os.path.isdir(recipe_dir):
+                continue
+            for name in os.listdir(recipe_dir):
+                if not name.startswith('do_'):
+                    continue
+                task = read_task(os.path.join(recipe_dir, name))
+                if task:
+                    task['recipe'] = recipe
+                    task['task'] = name
+                    tasks.append(task)
+    return tasks
+
+
+def read_sstate_summaries(console_log):
+    summaries = []
+    try:
+        with open(console_log, errors='replace') as f:
+            for line in f:
+                match = SSTATE_SUMMARY_RE.search(line)
+                if match:
+                    wanted, local, mirrors, missed, current = [int(value or 0)
+                                                               for value in match.groups()]
+                    summaries.append({'wanted': wanted, 'local': local, 'mirrors': mirrors,
+                                      'missed': missed, 'current': current})
+    except (IOError, OSError):
+        pass
+    return summaries
+
+
+def critical_path(tasks):
+    if not tasks:
+        return []
+    by_end = sorted(tasks, key=lambda t: t['end'])
+    # position in by_end of every task of a recipe, ordered by end
+    recipes = {}
+    for pos, task in enumerate(by_end):
+        recipes.setdefault(task['recipe'], []).append(pos)
+    ends = [t['end'] for t in by_end]
+    pos = len(by_end) - 1
+    path = [by_end[pos]]
+    while True:
+        task = by_end[pos]
+        # tasks finished before this one started, earlier in by_end
+        # so zero-length tasks don't loop
+        last = min(bisect.bisect_right(ends, task['start']), pos) - 1
+        if last < 0:
+            break
+        same = recipes[task['recipe']]
+        i = bisect.bisect_right(same, last) - 1
+        pos = same[i] if i >= 0 else last
+        path.insert(0, by_end[pos])
+    return path
+
+
+def analyze(tasks, summaries):
+    recipes = {}
+    hits = 0
+    misses = 0
+    for task in tasks:
+        hit = task['task'].endswith(SETSCENE_SUFFIX)
+        miss = task['task'] in SSTATE_TASKS
+        if not (hit or miss):
+            continue
+        counts = recipes.setdefault(task['recipe'], [0, 0])
+        if hit:
+            counts[0] += 1
+            hits += 1
+        else:
+            counts[1] += 1
+            misses += 1
+    first = min([t['start'] for t in tasks]) if tasks else 0
+
+    def task_entry(task, value):
+        return [task['recipe'], task['task'], round(value, 2)]
+
+    return {
+        'version': STATS_VERSION,
+        'tasks': {
+            'count': len(tasks),
+            'failed': len([t for t in tasks if t['failed']]),
+            'wall_time': round(sum([t['end'] - t['start'] for t in tasks]), 1),
+            'cpu_time': round(sum([t['cpu'] for t in tasks]), 1),
+        },
+        'sstate': {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else None,
+            'summaries': summaries,
+        },
+        # recipe -> [hits, misses]
+        'recipes': recipes,
+        'top_wall': [task_entry(t, t['end'] - t['start'])
+                     for t in sorted(tasks, key=lambda t: t['start'] - t['end'])[:TOP_TASKS]],
+        'top_cpu': [task_entry(t, t['cpu'])
+                    for t in sorted(tasks, key=lambda t: -t['cpu'])[:TOP_TASKS]],
+        # recipe, task, start since the first task, wall time
+        'critical_path': [[t['recipe'], t['task'], round(t['start'] - first, 1),
+                           round(t['end'] - t['start'], 1)] for t in critical_path(tasks)],
+    }
+
+
+def stats_collect(log_dir):
+    tasks = []
+    for path in find_buildstats(log_dir):
+        tasks.extend(read_buildstats(path))
+    return analyze(tasks, read_sstate_summaries(os.path.join(log_dir,
+                                                             build_conf.CONSOLE_LOG_FNAME)))
+
+
+def stats_write(stats, path):
+    with open(os.path.join(path, STATS_FNAME), 'w') as f:
+        json.dump(stats, f, separators=(',', ':'), sort_keys=True)
+
+
+def print_stats(stats):
+    sstate = stats['sstate']
+    print('Tasks: %d run, %d failed, wall %.0fs, cpu %.0fs' %
+          (stats['tasks']['count'], stats['tasks']['failed'],
+           stats['tasks']['wall_time'], stats['tasks']['cpu_time']))
+    print('Sstate: %d hits, %d misses, hit ratio %s' %
+          (sstate['hits'], sstate['misses'],
+           '%.1f%%' % (sstate['hit_ratio'] * 100) if sstate['hit_ratio'] is not None else '-'))
+    print('Most expensive tasks (wall):')
+    for recipe, task, value in stats['top_wall'][:10]:
+        print('\t%8.1fs %s:%s' % (value, recipe, task))
+    print('Most expensive tasks (cpu):')
+    for recipe, task, value in stats['top_cpu'][:10]:
+        print('\t%8.1fs %s:%s' % (value, recipe, task))
+    print('Critical path:')
+    for recipe, task, start, wall in stats['critical_path']:
+        print('\t%8.1fs %8.1fs %s:%s' % (start, wall, recipe, task))
+
+
+def stats_load_builds(cfg, rows):
+    '''
+    Stats of the builds found in the index: from the build artifacts,
+    or from the build history checkout if the artifacts are gone
+    '''
+    res = []
+    missing = []
+    for row in rows:
+        path = os.path.join(cfg.get_dir_build_artifacts(), row[0], STATS_FNAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                res.append((row[0], json.load(f)))
+        else:
+            missing.append(row[0])
+    repo_dir = cfg.get_dir_xt_history()
+    if missing and os.path.isdir(os.path.join(repo_dir, '.git')):
+        objects = ['%s:%s/%s' % (build_index.HISTORY_REF, path, STATS_FNAME)
+                   for path in missing]
+        blobs = build_index.git_read_blobs(repo_dir, objects)
+        for path, obj in zip(missing, objects):
+            if obj in blobs:
+                res.append((path, json.loads(blobs[obj])))
+    return sorted(res)
+
+
+def stats_trend(cfg, product, machine, count, build_type=None):
+    index = build_index.history_index_open(cfg)
+    try:
+        rows = index.recent(product, machine, count, build_type)
+    finally:
+        index.close()
+    builds = stats_load_builds(cfg, rows)
+    if not builds:
+        raise Exception('No build stats found for %s %s' % (product, machine))
+    print('%-44s %7s %7s %7s %7s %10s %10s' % ('build', 'tasks', 'hits', 'misses', 'hit %',
+                                              'wall, s', 'cpu, s'))
+    rebuilt = {}
+    for path, stats in builds:
+        sstate = stats['sstate']
+        print('%-44s %7d %7d %7d %7s %10.0f %10.0f' %
+              (path, stats['tasks']['count'], sstate['hits'], sstate['misses'],
+               '%.1f' % (sstate['hit_ratio'] * 100) if sstate['hit_ratio'] is not None else '-',
+               stats['tasks']['wall_time'], stats['tasks']['cpu_time']))
+        for recipe, counts in stats['recipes'].items():
+            if counts[1]:
+                rebuilt[recipe] = rebuilt.get(recipe, 0) + 1
+    if rebuilt:
+        print('Recipes rebuilt most often:')
+        for recipe, times in sorted(rebuilt.items(), key=lambda item: -item[1])[:TOP_TASKS]:
+            print('\t%3d of %d builds %s' % (times, len(builds), recipe))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze buildstats and sstate use of the builds')
+    parser.add_argument('--config',
+                        dest='config_file', required=False,
+                        help="Use configuration file for tuning")
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+    analyze_parser = subparsers.add_parser('analyze', help='Analyze the logs of a build')
+    analyze_parser.add_argument('path', help='Log directory of the build, e.g. build/log')
+    analyze_parser.add_argument('-o', '--output',
+                                dest='output', required=False,
+                                help='Directory to save ' + STATS_FNAME + ' to')
+    show = subparsers.add_parser('show', help='Show the saved stats of a build')
+    show.add_argument('path', help='Build directory with ' + STATS_FNAME)
+    trend = subparsers.add_parser('trend', help='Compare the last builds of a product '
+                                                'and machine, uses the build history index')
+    trend.add_argument('--product',
+                       dest='product_type', required=True, help='Product type')
+    trend.add_argument('--machine',
+                       dest='machine_type', required=True, help='Machine type')
+    trend.add_argument('--build-type', choices=build_conf.TYPE,
+                       dest='build_type', required=False, help='Type of the builds')
+    trend.add_argument('-n', '--count', type=int, default=10,
+                       dest='count', required=False,
+                       help='Number of builds, default is 10')
+    args = parser.parse_args()
+    try:
+        if args.action == 'analyze':
+            stats = stats_collect(args.path)
+            print_stats(stats)
+            if args.output:
+                stats_write(stats, args.output)
+        elif args.action == 'show':
+            with open(os.path.join(args.path, STATS_FNAME)) as f:
+                print_stats(json.load(f))
+        else:
+            stats_trend(build_conf.WorkspaceConf(args.config_file),
+                        'prod-' + args.product_type, args.machine_type,
+                        args.count, args.build_type)
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import errno
+import hashlib
+import os
+import stat
+import sys
+import threading
+
+import build_conf
+import build_transfer
+
+'''
+Content-addressed store of the build artifacts.
+Every file populated into build-artifacts is kept once in the object
+pool, keyed by its SHA-256 and mode:
+
+build-artifacts
+├── .objects
+│   ├── 0a
+│   │   └── 0a1b...-644
+│   └── ...
+└── dailybuild
+    └── ...
+
+The build directories are trees of hardlinks into the pool, so a file
+which is byte-identical to the one of a previous build costs neither
+storage nor copy time. An object is referenced by a build as long as
+its link count is greater than one, so removing old build directories
+is enough to make their objects collectable by the garbage collector.
+NOTE: artifacts must never be modified in place, as all the builds
+share the same inode.
+'''
+
+OBJECTS_DIR = '.objects'
+TMP_SUFFIX = '.tmp-'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ArtifactStore(object):
+    def __init__(self, path):
+        self.__path = path
+
+    def get_dir_objects(self):
+        return os.path.join(self.__path, OBJECTS_DIR)
+
+    def get_object_path(self, digest, mode):
+        return os.path.join(self.get_dir_objects(), digest[:2],
+                            '%s-%o' % (digest, stat.S_IMODE(mode)))
+
+    def ingest(self, src, dst, copy):
+        '''
+        Put src into the pool, if not there yet, and link dst to the object.
+        copy(src, dst) is used to transfer the data of the new objects.
+        Returns the method used, 'dedup' if the object already existed,
+        and the hash of the file
+        '''
+        st = os.stat(src)
+        digest = hash_file(src)
+        obj = self.get_object_path(digest, st.st_mode)
+        method = 'dedup'
+        if not os.path.exists(obj):
+            build_conf.WorkspaceConf.setup_dir(os.path.dirname(obj))
+            # other builders may populate the same object at the same time,
+            # so make it visible atomically
+            tmp = '%s%s%d-%d' % (obj, TMP_SUFFIX, os.getpid(), threading.get_ident())
+            try:
+                method = copy(src, tmp)
+                os.rename(tmp, obj)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        try:
+            os.link(obj, dst)
+        except OSError as err:
+            # too many links to the object or it was just collected:
+            # store this one as a plain file
+            if err.errno not in [errno.EMLINK, errno.ENOENT]:
+                raise
+            method = copy(src, dst)
+        return method, digest
+
+    def gc(self, dry_run=False):
+        '''
+        Remove objects which are not referenced by any build.
+        Returns the number of objects and bytes collected
+        '''
+        count = 0
+        size = 0
+        for root, dirs, files in os.walk(self.get_dir_objects()):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if st.st_nlink > 1 or TMP_SUFFIX in name:
+                    continue
+                count += 1
+                size += st.st_size
+                if not dry_run:
+                    os.remove(path)
+        return count, size
+
+
+def store_gc(cfg, dry_run):
+    store = ArtifactStore(cfg.get_dir_build_artifacts())
+    print('Collecting unreferenced objects in ' + store.get_dir_objects())
+    count, size = store.gc(dry_run)
+    print('%s %d objects, %s' % ('Would remove' if dry_run else 'Removed',
+                                 count, build_transfer.format_size(size)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the artifact store')
+    parser.add_argument('--config',
+                        dest='config_file', required=False,
+                        help="Use configuration file for tuning")
+    parser.add_argument('--dry-run', action='store_true',
+                        dest='dry_run', required=False, default=False,
+                        help='Only report what would be done')
+    parser.add_argument('action', choices=['gc'],
+                        help='gc - remove objects not referenced by any build')
+    args = parser.parse_args()
+    try:
+        cfg = build_conf.WorkspaceConf(args.config_file)
+        store_gc(cfg, args.dry_run)
+    except Exception as e:
+        print(e)
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
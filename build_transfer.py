@@ -0,0 +1,214 @@
+import errno
+import fcntl
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Transfer engine used to populate build artifacts.
+Files are copied concurrently with a bounded pool of workers.
+Depending on the mode, a file is either:
+1. reflinked (FICLONE), e.g. the data blocks are shared between
+source and destination until one of them is modified. This requires
+both to be on the same filesystem which supports it (btrfs, xfs)
+2. hardlinked, e.g. source and destination are the same inode.
+This requires both to be on the same filesystem
+3. copied, e.g. data is streamed from the source to the destination
+'''
+
+# ioctl request code of FICLONE, see linux/fs.h
+FICLONE = 0x40049409
+
+MODE_AUTO = 'auto'
+MODE_HARDLINK = 'hardlink'
+MODE_COPY = 'copy'
+
+MODES = [
+    MODE_AUTO,
+    MODE_HARDLINK,
+    MODE_COPY
+]
+
+# errors meaning reflink/hardlink is not possible for this
+# source/destination pair, so we need to fall back to copy
+LINK_ERRORS = [
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.EPERM,
+    errno.EMLINK
+]
+
+DEFAULT_JOBS = 8
+
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TiB' % size
+
+
+def parse_size(value):
+    # size with optional K, M, G or T suffix (binary units)
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    units = {'K': 1, 'M': 2, 'G': 3, 'T': 4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * 1024 ** units[value[-1]])
+    return int(value)
+
+
+class TransferStats(object):
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        # number of files per method used
+        self.methods = {}
+        self.__lock = threading.Lock()
+
+    def add(self, size, method):
+        with self.__lock:
+            self.files += 1
+            self.bytes += size
+            self.methods[method] = self.methods.get(method, 0) + 1
+
+    def throughput(self):
+        if self.seconds <= 0:
+            return 0
+        return self.bytes / self.seconds
+
+    def __str__(self):
+        methods = ', '.join('%s: %d' % (k, v) for k, v in sorted(self.methods.items()))
+        return '%d files, %s in %.1fs (%s/s) [%s]' % (
+            self.files, format_size(self.bytes), self.seconds,
+            format_size(self.throughput()), methods)
+
+
+class Transfer(object):
+    def __init__(self, jobs=None, mode=MODE_AUTO, store=None, manifest=None):
+        if mode not in MODES:
+            raise Exception('Unknown transfer mode "' + mode + '", use one of ' + ', '.join(MODES))
+        if not jobs:
+            jobs = min(DEFAULT_JOBS, os.cpu_count() or 1)
+        self.__jobs = jobs
+        self.__mode = mode
+        # if set, files are put into the content-addressed store
+        # and linked from there, see build_store.ArtifactStore
+        self.__store = store
+        # if set, every file transferred is recorded with its hash,
+        # see build_manifest.Manifest
+        self.__manifest = manifest
+        # (source device, destination device) pairs for which
+        # reflink is known not to work: do not try it for every file
+        self.__no_reflink = set()
+        self.__lock = threading.Lock()
+
+    def get_jobs(self):
+        return self.__jobs
+
+    def get_mode(self):
+        return self.__mode
+
+    def __reflink(self, src, dst):
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+    def __try_link(self, src, dst, devs, hardlink):
+        if hardlink and devs[0] == devs[1]:
+            try:
+                os.link(src, dst)
+                return 'hardlink'
+            except OSError as err:
+                if err.errno not in LINK_ERRORS:
+                    raise
+        if devs not in self.__no_reflink:
+            try:
+                self.__reflink(src, dst)
+                shutil.copystat(src, dst)
+                return 'reflink'
+            except (IOError, OSError) as err:
+                if err.errno not in LINK_ERRORS:
+                    raise
+                with self.__lock:
+                    self.__no_reflink.add(devs)
+                os.remove(dst)
+        return None
+
+    def __copy_data(self, src, dst, hardlink=False):
+        devs = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+        method = None
+        if self.__mode != MODE_COPY:
+            method = self.__try_link(src, dst, devs, hardlink)
+        if not method:
+            # copyfile uses in-kernel copy (sendfile) where possible
+            shutil.copyfile(src, dst)
+            shutil.copystat(src, dst)
+            method = 'copy'
+        return method
+
+    def __transfer_file(self, src, dst, stats):
+        st = os.stat(src)
+        digest = None
+        if self.__store:
+            # objects of the store must never share the inode with
+            # the build directory, so they are not hardlinked
+            method, digest = self.__store.ingest(src, dst, self.__copy_data)
+        else:
+            method = self.__copy_data(src, dst, self.__mode == MODE_HARDLINK)
+        if self.__manifest:
+            # hashed by the worker, while the data is still in the page cache
+            self.__manifest.add(dst, st.st_size, st.st_mode, digest)
+        stats.add(st.st_size, method)
+
+    def __symlink(self, src, dst):
+        target = os.readlink(src)
+        os.symlink(target, dst)
+        if self.__manifest:
+            self.__manifest.add_link(dst, target)
+
+    def copy_file(self, src, dst):
+        stats = TransferStats()
+        start = time.monotonic()
+        self.__transfer_file(src, dst, stats)
+        stats.seconds = time.monotonic() - start
+        return stats
+
+    def copy_tree(self, src, dst):
+        # same as shutil.copytree(src, dst, symlinks=True), but files
+        # are transferred concurrently
+        stats = TransferStats()
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.__jobs) as pool:
+            futures = []
+            for root, dirs, files in os.walk(src):
+                rel = os.path.relpath(root, src)
+                dst_root = os.path.normpath(os.path.join(dst, rel))
+                os.makedirs(dst_root)
+                for name in dirs:
+                    src_path = os.path.join(root, name)
+                    if os.path.islink(src_path):
+                        self.__symlink(src_path, os.path.join(dst_root, name))
+                for name in files:
+                    src_path = os.path.join(root, name)
+                    dst_path = os.path.join(dst_root, name)
+                    if os.path.islink(src_path):
+                        self.__symlink(src_path, dst_path)
+                    else:
+                        futures.append(pool.submit(self.__transfer_file,
+                                                   src_path, dst_path, stats))
+            for future in futures:
+                # re-raise the first error, if any
+                future.result()
+        # directory stats are copied once all the files are in place
+        for root, dirs, files in os.walk(src):
+            rel = os.path.relpath(root, src)
+            shutil.copystat(root, os.path.normpath(os.path.join(dst, rel)))
+        stats.seconds = time.monotonic() - start
+        return stats
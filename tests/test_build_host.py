@@ -0,0 +1,47 @@
+import unittest
+
+import build_host
+
+
+class TuneParallelTest(unittest.TestCase):
+    def check(self, cpus, mem, domains):
+        values = build_host.tune_parallel(cpus, mem, 0, domains)
+        slots = max(1, min(cpus, mem // build_host.MEM_PER_THREAD))
+        per_domain = max(1, slots // domains)
+        threads = values['BB_NUMBER_THREADS']
+        make = values['PARALLEL_MAKE'].split()
+        make_jobs = int(make[make.index('-j') + 1])
+        make_load = int(make[make.index('-l') + 1])
+        # the single threaded tasks use all the slots of the domain
+        self.assertEqual(threads, per_domain)
+        self.assertGreaterEqual(make_jobs, 1)
+        self.assertLessEqual(make_jobs, per_domain)
+        # concurrent compiles are throttled down to the slots by the load,
+        # not multiplied by the number of tasks
+        self.assertLessEqual(make_load, per_domain)
+        # the domains together do not exceed the CPUs and the memory
+        self.assertLessEqual(domains * threads, max(domains, cpus))
+        self.assertLessEqual(domains * threads,
+                             max(domains, mem // build_host.MEM_PER_THREAD))
+        return threads, make_jobs
+
+    def test_within_host(self):
+        for cpus in [1, 2, 3, 8, 17, 64, 128]:
+            for domains in [1, 2, 3, 5]:
+                for mem in [build_host.GiB, 16 * build_host.GiB, 512 * build_host.GiB]:
+                    self.check(cpus, mem, domains)
+
+    def test_big_host(self):
+        # 64 CPUs for 3 domains: 21 slots per domain
+        self.assertEqual(self.check(64, 256 * build_host.GiB, 3), (21, 21))
+
+    def test_single_domain(self):
+        # no CPUs left idle by single threaded tasks
+        self.assertEqual(self.check(64, 256 * build_host.GiB, 1), (64, 64))
+
+    def test_memory_bound(self):
+        self.assertEqual(self.check(64, 8 * build_host.GiB, 1), (4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
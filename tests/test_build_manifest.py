@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import build_manifest
+
+
+class ManifestVerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ['kept', 'deleted', 'changed']:
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write(name)
+        build_manifest.manifest_scan(self.root).write()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_verify_clean(self):
+        self.assertEqual(build_manifest.manifest_verify(self.root), ([], [], []))
+
+    def test_verify_deleted_and_extra(self):
+        os.remove(os.path.join(self.root, 'deleted'))
+        with open(os.path.join(self.root, 'extra'), 'w') as f:
+            f.write('extra')
+        with open(os.path.join(self.root, 'changed'), 'w') as f:
+            f.write('corrupted')
+        missing, unexpected, corrupted = build_manifest.manifest_verify(self.root)
+        self.assertEqual(missing, ['deleted'])
+        self.assertEqual(unexpected, ['extra'])
+        self.assertEqual(corrupted, ['changed'])
+
+
+if __name__ == '__main__':
+    unittest.main()